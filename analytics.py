@@ -0,0 +1,252 @@
+import argparse
+import itertools
+import json
+import os
+import shutil
+import sqlite3
+import time
+import traceback
+from datetime import datetime
+
+import metrics
+from db import DATABASE_PATH, dict_factory, is_db_initialized
+
+# columnar snapshots of the events and xmatches, for the studies of the xmatch history (delta_t distributions,
+# distance_ratio vs drb, match rate per event, ...) that are slow and memory hungry through fetch_xmatches' dicts,
+# and that shouldn't scan the live database. A snapshot is a directory with one Arrow IPC file per table:
+#   ANALYTICS_DIR/snapshot-YYYYMMDDTHHMMSS.mmm/events.arrow, xmatches.arrow, snapshot.json
+# the files are uncompressed, so that load_snapshot can memory map them: the columns are read from the page cache
+# as they are used, without copying them. A file has a record batch per ANALYTICS_CHUNK_SIZE rows, to_numpy_chunks
+# views the numeric columns of each batch as NumPy arrays for free, to_numpy concatenates them (a copy).
+# The xmatches include the ones in the cold tier (see tiering.py). The TIMESTAMP columns are timestamps[us] (UTC).
+# Run it as a service (python analytics.py, a snapshot every ANALYTICS_INTERVAL seconds) or once (--once), then e.g.:
+#   tables = analytics.load_snapshot()
+#   xmatches = analytics.to_numpy(tables['xmatches'], ['delta_t', 'distance_ratio', 'drb'])
+
+ANALYTICS_DIR = os.getenv('ANALYTICS_DIR', './data/analytics')
+ANALYTICS_INTERVAL = float(os.getenv('ANALYTICS_INTERVAL', 6 * 60 * 60))  # in seconds, between snapshots
+ANALYTICS_KEEP = int(os.getenv('ANALYTICS_KEEP', 3))  # number of snapshots kept
+ANALYTICS_CHUNK_SIZE = int(os.getenv('ANALYTICS_CHUNK_SIZE', 20000))  # rows read (and written as a record batch) at a time
+ANALYTICS_LATEST = os.path.join(ANALYTICS_DIR, 'LATEST')  # name of the latest complete snapshot
+
+SNAPSHOT_TABLES = ['events', 'xmatches']
+
+def _arrow_type(pa, declared_type):
+    from export import arrow_type
+    if 'TIMESTAMP' in (declared_type or '').upper():
+        return pa.timestamp('us')
+    return arrow_type(pa, declared_type)
+
+def _parse_timestamp(value):
+    # sqlite timestamps are ISO strings, in UTC
+    if value is None or isinstance(value, datetime):
+        return value
+    try:
+        return datetime.fromisoformat(str(value).replace('Z', '+00:00')).replace(tzinfo=None)
+    except ValueError:
+        return None
+
+def _record_batch(pa, schema, rows):
+    # rows are dicts, with the columns of the schema (the missing ones are null)
+    arrays = []
+    for field in schema:
+        values = [row.get(field.name) for row in rows]
+        if pa.types.is_timestamp(field.type):
+            values = [_parse_timestamp(value) for value in values]
+        arrays.append(pa.array(values, type=field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+def _iter_rows(conn: sqlite3.Connection, table: str, max_id: int, chunk_size: int):
+    # yields the rows of the table with an id <= max_id, a chunk at a time. Each chunk is its own query,
+    # so that we never hold the database's read lock for longer than it takes to read one
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            f'SELECT * FROM {table} WHERE id > ? AND id <= ? ORDER BY id LIMIT ?',
+            (last_id, max_id, chunk_size)
+        ).fetchall()
+        if not rows:
+            break
+        last_id = rows[-1]['id']
+        yield rows
+
+def _write_table(pa, path: str, schema, chunks) -> int:
+    # returns the number of rows written
+    num_rows = 0
+    with pa.OSFile(path, 'wb') as sink:
+        with pa.ipc.new_file(sink, schema) as writer:
+            for rows in chunks:
+                writer.write_batch(_record_batch(pa, schema, rows))
+                num_rows += len(rows)
+    return num_rows
+
+def _archival_keys(chunks, keys: set):
+    # passes the chunks through, adding the (event_id, candid) of their archival xmatches to keys
+    for rows in chunks:
+        keys.update((row['event_id'], row['candid']) for row in rows if row.get('archival'))
+        yield rows
+
+def _cold_chunks(conn: sqlite3.Connection, cold_events: list, max_event_id: int, written: set, chunk_size: int):
+    # the xmatches in the cold tier, a few events at a time: of the events cold when we started (cold_events)
+    # and of the ones tiered since. The xmatches already written are left out, they are read from the database
+    # if their event was tiered after we read them, or if the transaction that tiered it failed (see tiering.tier_event).
+    # They are matched on (event_id, candid), since the ids of the tiered xmatches can be reused
+    from tiering import read_cold_xmatches
+    events = {event['id']: event for event in cold_events}
+    for event in conn.execute(
+        "SELECT id, obs_start FROM events WHERE tier = 'cold' AND id <= ? ORDER BY id",
+        (max_event_id,)
+    ).fetchall():
+        events.setdefault(event['id'], event)
+    rows = []
+    for event_id in sorted(events):
+        rows += [row for row in read_cold_xmatches([events[event_id]]) if (row['event_id'], row['candid']) not in written]
+        if len(rows) >= chunk_size:
+            yield rows
+            rows = []
+    if rows:
+        yield rows
+
+def write_snapshot(database_path: str = None, chunk_size: int = ANALYTICS_CHUNK_SIZE) -> str:
+    # returns the path of the new snapshot. It is written in a temporary directory renamed once complete,
+    # so a snapshot that is there is always whole
+    import pyarrow as pa
+    conn = sqlite3.connect(database_path or DATABASE_PATH)
+    conn.row_factory = dict_factory
+    now = time.time()
+    name = f"snapshot-{time.strftime('%Y%m%dT%H%M%S', time.gmtime(now))}.{int(now * 1000) % 1000:03d}"
+    tmp_path = os.path.join(ANALYTICS_DIR, f'.{name}.tmp')
+    path = os.path.join(ANALYTICS_DIR, name)
+    try:
+        os.makedirs(tmp_path, exist_ok=True)
+        # the rows that exist when we start, the ones inserted while we read are left for the next snapshot
+        max_ids = {table: conn.execute(f'SELECT COALESCE(MAX(id), 0) AS id FROM {table}').fetchone()['id'] for table in SNAPSHOT_TABLES}
+        cold_events = conn.execute(
+            "SELECT id, obs_start FROM events WHERE tier = 'cold' AND id <= ?", (max_ids['events'],)
+        ).fetchall()
+        num_rows = {}
+        for table in SNAPSHOT_TABLES:
+            columns = conn.execute(f'PRAGMA table_info({table})').fetchall()
+            schema = pa.schema([(column['name'], _arrow_type(pa, column['type'])) for column in columns])
+            chunks = _iter_rows(conn, table, max_ids[table], chunk_size)
+            if table == 'xmatches':
+                written = set()
+                chunks = itertools.chain(
+                    _archival_keys(chunks, written),
+                    _cold_chunks(conn, cold_events, max_ids['events'], written, chunk_size)
+                )
+            num_rows[table] = _write_table(pa, os.path.join(tmp_path, f'{table}.arrow'), schema, chunks)
+        with open(os.path.join(tmp_path, 'snapshot.json'), 'w') as f:
+            json.dump({'created_at': time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime()), 'num_rows': num_rows, 'max_ids': max_ids}, f)
+        os.rename(tmp_path, path)
+    except BaseException:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+    finally:
+        conn.close()
+
+    with open(f'{ANALYTICS_LATEST}.tmp', 'w') as f:
+        f.write(name)
+    os.replace(f'{ANALYTICS_LATEST}.tmp', ANALYTICS_LATEST)
+    prune_snapshots()
+    return path
+
+def list_snapshots() -> list:
+    # the names of the complete snapshots, newest first
+    try:
+        names = [entry.name for entry in os.scandir(ANALYTICS_DIR) if entry.is_dir() and entry.name.startswith('snapshot-')]
+    except FileNotFoundError:
+        return []
+    return sorted(names, reverse=True)
+
+def prune_snapshots(keep: int = ANALYTICS_KEEP) -> None:
+    # a snapshot still memory mapped by a reader stays readable, its files are only freed once unmapped
+    for name in list_snapshots()[keep:]:
+        shutil.rmtree(os.path.join(ANALYTICS_DIR, name), ignore_errors=True)
+
+def latest_snapshot() -> str:
+    # the path of the latest snapshot, or None if there is none yet
+    try:
+        with open(ANALYTICS_LATEST) as f:
+            name = f.read().strip()
+    except FileNotFoundError:
+        return None
+    path = os.path.join(ANALYTICS_DIR, name)
+    return path if os.path.isdir(path) else None
+
+def snapshot_info(path: str = None) -> dict:
+    path = path or latest_snapshot()
+    if path is None:
+        return None
+    with open(os.path.join(path, 'snapshot.json')) as f:
+        return {'path': path, **json.load(f)}
+
+def load_snapshot(path: str = None, tables: list = SNAPSHOT_TABLES) -> dict:
+    # the tables of a snapshot (the latest by default), as memory mapped pyarrow Tables.
+    # Nothing is read until the columns are used, and the data is shared with the page cache (no copy)
+    import pyarrow as pa
+    path = path or latest_snapshot()
+    if path is None:
+        raise FileNotFoundError(f'No analytics snapshot in {ANALYTICS_DIR}, run python analytics.py --once')
+    loaded = {}
+    for table in tables:
+        with pa.memory_map(os.path.join(path, f'{table}.arrow'), 'r') as source:
+            loaded[table] = pa.ipc.open_file(source).read_all()
+    return loaded
+
+def to_numpy(table, columns: list = None) -> dict:
+    # the columns of a table as NumPy arrays (the nulls becoming NaN, or None for the strings). The record batches
+    # are concatenated, so the columns are copied in memory: use to_numpy_chunks to read large ones without a copy
+    return {
+        name: table.column(name).to_numpy()
+        for name in (columns or table.column_names)
+    }
+
+def to_numpy_chunks(table, columns: list = None) -> dict:
+    # the columns of a table as lists of NumPy arrays, one per record batch. The numeric ones without nulls
+    # are views of the memory mapped data, the others are copied (as in to_numpy)
+    return {
+        name: [chunk.to_numpy(zero_copy_only=False) for chunk in table.column(name).chunks]
+        for name in (columns or table.column_names)
+    }
+
+def to_pandas(table, columns: list = None):
+    # the table (or some of its columns) as a pandas DataFrame, requires pandas
+    if columns is not None:
+        table = table.select(columns)
+    return table.to_pandas(split_blocks=True)
+
+def service() -> str:
+    with metrics.timer('analytics_snapshot_seconds'):
+        path = write_snapshot()
+    info = snapshot_info(path)
+    print(f"Wrote snapshot {path} ({info['num_rows']['events']} events, {info['num_rows']['xmatches']} xmatches).")
+    return path
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Columnar snapshots of the events and xmatches')
+    parser.add_argument('--once', action='store_true', help='write a single snapshot and exit')
+    parser.add_argument('--info', action='store_true', help='print the latest snapshot and exit')
+    args = parser.parse_args()
+
+    if args.info:
+        print(json.dumps(snapshot_info(), indent=2))
+        exit(0)
+
+    while not is_db_initialized():
+        print('Waiting for database to be initialized...')
+        time.sleep(15)
+
+    metrics.configure('analytics')
+    if args.once:
+        service()
+        metrics.flush()
+    else:
+        while True:
+            try:
+                service()
+            except Exception as e:
+                traceback.print_exc()
+                print(f'Failed to run service: {e}')
+            metrics.flush()
+            time.sleep(ANALYTICS_INTERVAL)
@@ -1,28 +1,110 @@
+import hashlib
 import json
+import math
 import os
 import re
+import secrets
 import time
+from datetime import datetime, timezone
 from functools import wraps
 
-from gevent import monkey
-monkey.patch_all()
+# the standard library is monkey patched by gunicorn's gevent workers (see supervisord.conf) before this module is imported,
+# the development server below runs with threads
+from flask import Flask, Response, g, request, render_template, redirect, make_response
+from itsdangerous import URLSafeTimedSerializer, BadSignature
 
-from astropy.time import Time
-from flask import Flask, request, render_template, redirect
-
-from db import is_db_initialized, get_db_connection, fetch_event, fetch_events, fetch_xmatches
+import metrics
+from profiling import RequestProfiler, list_profiles
+from cache import TTLCache, PageCache
+from db import is_db_initialized, get_db_connection, fetch_event, fetch_event_by_id, fetch_event_version, fetch_events, fetch_xmatches, fetch_xmatches_since, cone_search_xmatches, cone_search_events
+from db import create_reprocess_job, fetch_reprocess_job, fetch_reprocess_jobs, cancel_reprocess_job, fetch_pipeline_delays
+from db import DT_XMATCH_NONADMIN, fetch_stats, fetch_event_stats
+from export import EXPORT_FORMATS, export_xmatches
+from notify import notify, REPROCESS_CHANNEL
+from timeconv import iso_to_jd, jd_to_datetime, jd_to_isot, now_jd
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__)) + '/data'
 
-DT_XMATCH_NONADMIN = 60.0 # in minutes
-DT_XMATCH_NONADMIN = float(os.getenv('DT_XMATCH_NONADMIN', DT_XMATCH_NONADMIN))
-# convert from minutes to days
-DT_XMATCH_NONADMIN /= 60 * 24
-
 # only allow alphanumeric characters and underscores in the username and password
 username_regex = re.compile(r'^[a-zA-Z0-9_]+$')
 email_regex = re.compile(r'^[a-zA-Z0-9_]+@[a-zA-Z0-9_]+\.[a-zA-Z0-9_]+$')
 
+SESSION_MAX_AGE = 60 * 60 * 24 # 1 day, same as the session cookie
+PRINCIPAL_CACHE_TTL = 300.0 # in seconds
+PRINCIPAL_CACHE_TTL = float(os.getenv('PRINCIPAL_CACHE_TTL', PRINCIPAL_CACHE_TTL))
+
+PAGE_CACHE_TTL = 60.0 # in seconds
+PAGE_CACHE_TTL = float(os.getenv('PAGE_CACHE_TTL', PAGE_CACHE_TTL))
+# directory shared by the gunicorn workers for the page cache, memory only if empty
+PAGE_CACHE_DIR = '/dev/shm/ep-ztf-xmatch-pages' if os.path.isdir('/dev/shm') else ''
+PAGE_CACHE_DIR = os.getenv('PAGE_CACHE_DIR', PAGE_CACHE_DIR)
+
+# max number of xmatches per page, and of events per request, of the batch xmatches endpoint
+XMATCHES_BATCH_LIMIT = int(os.getenv('XMATCHES_BATCH_LIMIT', 1000))
+XMATCHES_BATCH_MAX_EVENTS = int(os.getenv('XMATCHES_BATCH_MAX_EVENTS', 500))
+CONE_SEARCH_MAX_RADIUS = float(os.getenv('CONE_SEARCH_MAX_RADIUS', 600.0)) # in arcmin
+
+# default rolling windows of the pipeline latencies endpoint, and the longest one allowed
+LATENCY_WINDOWS = os.getenv('LATENCY_WINDOWS', '1h,24h,7d')
+LATENCY_MAX_WINDOW = 90 * 24 * 60 * 60 # in seconds
+
+STATS_DAYS = 30 # default number of days of the statistics dashboard
+STATS_MAX_DAYS = 366
+
+# touched whenever the users change, so that every gunicorn worker drops its cached principals
+USERS_VERSION_FILE = os.path.join(BASE_DIR, 'users.version')
+
+# the users we already authenticated, so that authenticated requests don't hit the database
+principals = TTLCache(maxsize=1024, ttl=PRINCIPAL_CACHE_TTL)
+principals_version = None
+
+def get_secret_key():
+    # used to sign the session tokens, it must be the same for all the gunicorn workers
+    secret_key = os.getenv('API_SECRET_KEY')
+    if secret_key:
+        return secret_key
+    # if not provided, we generate one and keep it in the data directory
+    path = os.path.join(BASE_DIR, 'secret_key')
+    if not os.path.exists(path):
+        tmp_path = f'{path}.{os.getpid()}'
+        with open(tmp_path, 'w') as f:
+            f.write(secrets.token_hex(32))
+        try:
+            # atomic, if another worker created it first we use theirs
+            os.link(tmp_path, path)
+        except FileExistsError:
+            pass
+        finally:
+            os.unlink(tmp_path)
+    with open(path) as f:
+        return f.read().strip()
+
+def users_version():
+    try:
+        return os.stat(USERS_VERSION_FILE).st_mtime_ns
+    except FileNotFoundError:
+        return 0
+
+def get_cached_principal(key):
+    global principals_version
+    version = users_version()
+    if version != principals_version:
+        principals.clear()
+        principals_version = version
+    user = principals.get(key)
+    return dict(user) if user is not None else None
+
+def cache_principal(key, user):
+    user = {k: v for k, v in user.items() if k != 'password'}
+    principals.set(key, user)
+    return dict(user)
+
+def invalidate_principals():
+    principals.clear()
+    with open(USERS_VERSION_FILE, 'a'):
+        pass
+    os.utime(USERS_VERSION_FILE, None)
+
 def auth():
     def _auth(f):
         @wraps(f)
@@ -35,25 +117,160 @@ def auth():
                 or not username_regex.match(password)
             ):
                 return 'Unauthorized', 401
-            with get_db_connection() as conn:
-                c = conn.cursor()
-                existing_user = c.execute('SELECT * FROM users WHERE username = ? AND password = ?', (username, password)).fetchone()
-                if existing_user is None:
-                    return 'Unauthorized', 401
-                
-                request.user = existing_user
+            key = ('basic', username, hashlib.sha256(password.encode()).hexdigest())
+            user = get_cached_principal(key)
+            if user is None:
+                with get_db_connection() as conn:
+                    c = conn.cursor()
+                    existing_user = c.execute('SELECT * FROM users WHERE username = ? AND password = ?', (username, password)).fetchone()
+                    if existing_user is None:
+                        return 'Unauthorized', 401
+                user = cache_principal(key, existing_user)
+
+            request.user = user
 
             result = f(*args, **kwargs)
             return result
         return __auth
     return _auth
 
+def event_etag(event_version, is_caltech):
+    # weak ETag of an event as returned by the API: its row, the version of its xmatches, and what the user can see
+    key = f"{event_version['id']}:{event_version['updated_at']}:{event_version['xmatches_version']}:{int(is_caltech)}"
+    return hashlib.sha1(key.encode()).hexdigest()
+
+def event_last_modified(event_version):
+    # the latest of the event's and its xmatches' updated_at (stored in UTC by sqlite)
+    timestamps = [t for t in [event_version['updated_at'], event_version['xmatches_updated_at']] if t]
+    if not timestamps:
+        return None
+    return datetime.strptime(max(timestamps), '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc)
+
+def parse_timestamp(value):
+    # ISO timestamp (UTC if no timezone) to the format sqlite stores the timestamps in, raises a ValueError if invalid
+    timestamp = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp.strftime('%Y-%m-%d %H:%M:%S')
+
+def parse_window(value):
+    # duration like 30m, 24h or 7d to seconds, raises a ValueError if invalid
+    units = {'m': 60, 'h': 60 * 60, 'd': 24 * 60 * 60}
+    value = str(value).strip()
+    if len(value) < 2 or value[-1] not in units or not value[:-1].isdigit() or int(value[:-1]) == 0:
+        raise ValueError(f'invalid window {value}, must be a number of minutes, hours or days (e.g. 30m, 24h, 7d)')
+    return int(value[:-1]) * units[value[-1]]
+
+def latency_summary(delays):
+    # percentiles (nearest rank) of the sorted delays, in seconds
+    if not delays:
+        return {'count': 0, 'p50': None, 'p90': None, 'p99': None, 'max': None}
+    summary = {'count': len(delays)}
+    for percentile in [50, 90, 99]:
+        summary[f'p{percentile}'] = round(delays[max(math.ceil(percentile / 100 * len(delays)) - 1, 0)], 3)
+    summary['max'] = round(delays[-1], 3)
+    return summary
+
+def stats_summary(stats):
+    # the statistics of db.fetch_stats, with what each type of user sees and the Fritz delivery rates
+    totals = stats['totals']
+    delivered = totals['fritz_posted'] + totals['fritz_dead']
+    attempts = totals['fritz_posted'] + totals['fritz_failed']
+    return {
+        **stats,
+        'views': {
+            'caltech': {
+                'events_with_xmatches': totals['events_with_xmatches'],
+                'xmatches': totals['xmatches'],
+                'events_with_archival_xmatches': totals['events_with_archival_xmatches'],
+                'archival_xmatches': totals['archival_xmatches'],
+            },
+            # partner and external users only see the non archival xmatches within DT_XMATCH_NONADMIN of the event
+            'partner': {
+                'events_with_xmatches': totals['events_with_prompt_xmatches'],
+                'xmatches': totals['prompt_xmatches'],
+            },
+        },
+        'rates': {
+            # the deliveries posted to Fritz out of the ones done (posted or given up on), and the attempts that failed
+            'fritz_success_rate': round(totals['fritz_posted'] / delivered, 4) if delivered else None,
+            'fritz_attempt_failure_rate': round(totals['fritz_failed'] / attempts, 4) if attempts else None,
+        },
+    }
+
 def make_app():
     app = Flask(__name__)
 
+    # signed session tokens, issued at login and stored in the Authorization cookie
+    sessions = URLSafeTimedSerializer(get_secret_key(), salt='session')
+
+    # data of the events, event and candidates pages
+    page_cache = PageCache(directory=PAGE_CACHE_DIR or None, ttl=PAGE_CACHE_TTL)
+
+    # latency of each route, labelled with the route's rule (not the path) so that it doesn't grow with the event names
+    metrics.configure('api')
+
+    # every request is profiled while an admin turns it on (see /api/profiling), the streamed responses only up to their first chunk
+    request_profiler = RequestProfiler()
+
+    @app.before_request
+    def start_timer():
+        g.start = time.perf_counter()
+        g.profiler = request_profiler.start()
+
+    @app.after_request
+    def observe_latency(response):
+        if 'start' in g:
+            route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+            metrics.observe('api_request_seconds', time.perf_counter() - g.start, route=route, method=request.method, status=response.status_code)
+        if g.get('profiler') is not None:
+            request_profiler.stop(g.profiler, f'api-{request.method}-{request.path}')
+            g.profiler = None
+        return response
+
     @app.route('/api/ping', methods=['GET'])
     def ping():
         return 'pong'
+
+    # turns the profiling of the API requests on or off for all the workers, with a JSON body like {"enabled": true}
+    # it turns itself off after PROFILE_API_DURATION seconds. A GET returns whether it is on, until when,
+    # and the latest profiles written to log/profiles
+    @app.route('/api/profiling', methods=['GET', 'POST'])
+    @auth()
+    def api_profiling():
+        if request.user.get('type') != 'caltech':
+            return {
+                'message': 'Unauthorized, must be an admin user',
+            }, 401
+        if request.method == 'POST':
+            try:
+                enabled = json.loads(request.data)['enabled']
+                if not isinstance(enabled, bool):
+                    raise ValueError('enabled must be a boolean')
+            except (ValueError, KeyError, TypeError) as e:
+                return {
+                    'message': f'Invalid data: {e}',
+                }, 400
+            request_profiler.set_enabled(enabled)
+        enabled = request_profiler.is_enabled()
+        return {
+            'message': f"Profiling of the API requests is {'on' if enabled else 'off'}",
+            'data': {
+                'enabled': enabled,
+                'expires_at': request_profiler.expires_at() if enabled else None,
+                'profiles': list_profiles(),
+            },
+        }
+
+    # metrics of all the services, in the Prometheus text format (admin only, scrape it with basic auth)
+    @app.route('/metrics', methods=['GET'])
+    @auth()
+    def metrics_page():
+        if request.user.get('type') != 'caltech':
+            return {
+                'message': 'Unauthorized, must be an admin user',
+            }, 401
+        return Response(metrics.prometheus_text(), mimetype='text/plain; version=0.0.4')
     
     @app.route('/api/users', methods=['GET', 'POST'])
     @auth()
@@ -115,6 +332,8 @@ def make_app():
                     return {
                         'message': f'Failed to insert user: {e}',
                     }, 400
+
+            invalidate_principals()
                 
             return {
                 'message': 'User inserted successfully',
@@ -134,30 +353,96 @@ def make_app():
                 }
             }
             
+    # reprocessing runs in the background (reprocess.py): a POST creates a job, which deletes the xmatches
+    # of the events in its scope and queues them for ep_xmatch again. The JSON body is optional, without it all the events
+    # are reprocessed. It can have:
+    # - obs_start_min, obs_start_max: only the events observed in that time range (ISO timestamps)
+    # - event_names: only these events (all their versions)
+    # - archival_only: only delete and query again the archival xmatches
+    # a GET lists the latest jobs and their progress
     @app.route('/api/reprocess', methods=['GET', 'POST'])
     @auth()
     def reprocess():
-        # admin only, we drop all the entries in the xmatches and reprocess all the events
+        # admin only
         if request.user.get('type') != 'caltech':
             return {
                 'message': 'Unauthorized, must be an admin user',
             }, 401
         if request.method == 'POST':
-            # 1. remove all the entries in the xmatches
-            # 2. set the status of all the events to 'reprocess'
+            scope = request.get_json(silent=True) if request.data else {}
+            if not isinstance(scope, dict):
+                return {
+                    'message': 'Invalid JSON body',
+                }, 400
+            unknown_keys = set(scope) - {'obs_start_min', 'obs_start_max', 'event_names', 'archival_only'}
+            if unknown_keys:
+                return {
+                    'message': f'Unknown parameters: {sorted(unknown_keys)}',
+                }, 400
+            try:
+                job = {
+                    'obs_start_min': parse_timestamp(scope['obs_start_min']) if scope.get('obs_start_min') else None,
+                    'obs_start_max': parse_timestamp(scope['obs_start_max']) if scope.get('obs_start_max') else None,
+                    'event_names': None,
+                    'archival_only': 1 if scope.get('archival_only') else 0,
+                    'created_by': request.user.get('username'),
+                }
+                if scope.get('event_names'):
+                    if not isinstance(scope['event_names'], list):
+                        raise ValueError('event_names must be a list')
+                    job['event_names'] = [str(event_name) for event_name in scope['event_names']]
+            except (ValueError, TypeError) as e:
+                return {
+                    'message': f'Invalid parameters: {e}',
+                }, 400
             with get_db_connection() as conn:
                 c = conn.cursor()
-                result1 = c.execute('DELETE FROM xmatches')
-                result2 = c.execute('UPDATE events SET query_status = "reprocess"')
+                job_id = create_reprocess_job(job, c)
                 conn.commit()
+                job = fetch_reprocess_job(job_id, c)
+            notify(REPROCESS_CHANNEL)
             return {
-                'message': 'Reprocessing started',
-                'data': {
-                    'deleted_xmatches_status': str(result1),
-                    'updated_events_status': str(result2),
-                }
-            }
-        
+                'message': 'Reprocessing job created',
+                'data': job,
+            }, 202
+
+        with get_db_connection() as conn:
+            c = conn.cursor()
+            jobs = fetch_reprocess_jobs(c)
+        return {
+            'message': f'Found {len(jobs)} reprocessing jobs',
+            'data': jobs,
+        }
+
+    # status of a reprocessing job (GET), or cancel it (DELETE). Cancelling stops the deletes and resets
+    # that are left, the events that were already reset are still queried again
+    @app.route('/api/reprocess/<int:job_id>', methods=['GET', 'DELETE'])
+    @auth()
+    def reprocess_job(job_id):
+        if request.user.get('type') != 'caltech':
+            return {
+                'message': 'Unauthorized, must be an admin user',
+            }, 401
+        with get_db_connection() as conn:
+            c = conn.cursor()
+            if request.method == 'DELETE':
+                cancelled = cancel_reprocess_job(job_id, c)
+                conn.commit()
+            job = fetch_reprocess_job(job_id, c)
+        if job is None:
+            return {
+                'message': 'Reprocessing job not found',
+            }, 404
+        if request.method == 'DELETE' and not cancelled:
+            return {
+                'message': f"Reprocessing job is already {job['state']}",
+                'data': job,
+            }, 409
+        return {
+            'message': 'Reprocessing job cancelled' if request.method == 'DELETE' else 'Reprocessing job found',
+            'data': job,
+        }
+
     # add an endpoint where given an event's name and version (defaults to latest), we return the event's details
     # and associated xmatches
     # this endpoint should be authenticated
@@ -188,58 +473,291 @@ def make_app():
                 }, 400
         with get_db_connection() as conn:
             c = conn.cursor()
-            event = fetch_event(
+            event_version = fetch_event_version(
                 event_name, c,
                 version=version,
             )
-            if event is None:
+            if event_version is None:
                 return {
                     'message': 'Event not found',
                 }, 404
-            xmatches, _ = fetch_xmatches(
-                [event['id']], c,
-                maxDeltaT=DT_XMATCH_NONADMIN if not is_caltech else None,
-                minDeltaT=-DT_XMATCH_NONADMIN if not is_caltech else None,
-                archival=False
-            )
-            event['xmatches'] = xmatches
-            if is_caltech:
-                archival_xmatches, _ = fetch_xmatches(
+
+            # pollers get a 304 until the event or its xmatches change, without us querying the xmatches
+            etag = event_etag(event_version, is_caltech)
+            last_modified = event_last_modified(event_version)
+            if request.if_none_match:
+                not_modified = request.if_none_match.contains_weak(etag)
+            else:
+                not_modified = (
+                    request.if_modified_since is not None and last_modified is not None
+                    and last_modified <= request.if_modified_since
+                )
+            if not_modified:
+                response = make_response('', 304)
+            else:
+                event = fetch_event_by_id(event_version['id'], c)
+                xmatches, _ = fetch_xmatches(
                     [event['id']], c,
-                    archival=True
+                    maxDeltaT=DT_XMATCH_NONADMIN if not is_caltech else None,
+                    minDeltaT=-DT_XMATCH_NONADMIN if not is_caltech else None,
+                    archival=False
                 )
-                event['archival_xmatches'] = archival_xmatches
+                event['xmatches'] = xmatches
+                if is_caltech:
+                    archival_xmatches, _ = fetch_xmatches(
+                        [event['id']], c,
+                        archival=True
+                    )
+                    event['archival_xmatches'] = archival_xmatches
+                response = make_response({
+                    'message': 'Event found',
+                    'data': event,
+                })
+            response.set_etag(etag, weak=True)
+            if last_modified is not None:
+                response.last_modified = last_modified
+            return response
+
+    # get the new (and updated) xmatches of several events in a single request, for clients tracking many events
+    # the events are given by name (all versions) and/or id, as comma separated query parameters
+    # or as lists in a JSON body (POST), along with an optional cursor:
+    # - since_id: only the xmatches with an id > since_id
+    # - since_seq: only the xmatches created or updated after that change (their change_seq, see migration17)
+    # the response includes the cursor to pass on the next request
+    @app.route('/api/xmatches', methods=['GET', 'POST'])
+    @auth()
+    def api_xmatches():
+        if request.user.get('type') != 'caltech':
             return {
-                'message': 'Event found',
-                'data': event,
+                'message': 'Unauthorized, must be an admin user',
+            }, 401
+        if request.method == 'POST':
+            params = request.get_json(silent=True)
+            if not isinstance(params, dict):
+                return {
+                    'message': 'Invalid JSON body',
+                }, 400
+        else:
+            params = {
+                key: request.args.get(key).split(',') if key in ['event_names', 'event_ids'] else request.args.get(key)
+                for key in ['event_names', 'event_ids', 'since_id', 'since_seq', 'limit']
+                if request.args.get(key) not in [None, '']
             }
 
+        event_names = params.get('event_names') or []
+        event_ids = params.get('event_ids') or []
+        since_id = params.get('since_id')
+        since_seq = params.get('since_seq')
+        limit = params.get('limit', XMATCHES_BATCH_LIMIT)
+        try:
+            if not isinstance(event_names, list) or not isinstance(event_ids, list):
+                raise ValueError('event_names and event_ids must be lists')
+            event_names = [str(event_name).strip() for event_name in event_names if str(event_name).strip()]
+            event_ids = [int(event_id) for event_id in event_ids]
+            since_id = int(since_id) if since_id is not None else None
+            since_seq = int(since_seq) if since_seq is not None else None
+            limit = int(limit)
+            if limit < 1 or limit > XMATCHES_BATCH_LIMIT:
+                raise ValueError(f'limit must be between 1 and {XMATCHES_BATCH_LIMIT}')
+        except (ValueError, TypeError) as e:
+            return {
+                'message': f'Invalid parameters: {e}',
+            }, 400
+        if not event_names and not event_ids:
+            return {
+                'message': 'At least one event name or id is required',
+            }, 400
+        if len(event_names) + len(event_ids) > XMATCHES_BATCH_MAX_EVENTS:
+            return {
+                'message': f'Too many events, at most {XMATCHES_BATCH_MAX_EVENTS} per request',
+            }, 400
+
+        with get_db_connection() as conn:
+            c = conn.cursor()
+            xmatches = fetch_xmatches_since(
+                event_ids, event_names, c,
+                since_id=since_id,
+                since_seq=since_seq,
+                limit=limit,
+            )
+
+        # the cursor of the next request: the last xmatch returned, or the same cursor if there is nothing new
+        cursor = {'since_id': since_id, 'since_seq': since_seq}
+        if xmatches:
+            cursor['since_id'] = xmatches[-1]['id']
+            if since_seq is not None:
+                cursor['since_seq'] = xmatches[-1]['change_seq']
+        return {
+            'message': f'Found {len(xmatches)} xmatches',
+            'data': {
+                'xmatches': xmatches,
+                'cursor': cursor,
+                'has_more': len(xmatches) == limit,
+            },
+        }
+
+    # cone search of the xmatches (and optionally the events) around a position, closest first
+    # query parameters: ra, dec (in degrees), radius (in arcmin), archival (0/1), events (0/1), limit
+    @app.route('/api/xmatches/cone', methods=['GET'])
+    @auth()
+    def api_xmatches_cone():
+        if request.user.get('type') != 'caltech':
+            return {
+                'message': 'Unauthorized, must be an admin user',
+            }, 401
+        missing = [key for key in ['ra', 'dec', 'radius'] if request.args.get(key) in [None, '']]
+        if missing:
+            return {
+                'message': f'Missing required parameters: {missing}',
+            }, 400
+        try:
+            ra = float(request.args.get('ra'))
+            dec = float(request.args.get('dec'))
+            radius = float(request.args.get('radius'))
+            limit = int(request.args.get('limit', XMATCHES_BATCH_LIMIT))
+            archival = request.args.get('archival', None)
+            archival = None if archival in [None, ''] else archival in ['1', 'true', 'True']
+            if not 0 <= ra < 360 or not -90 <= dec <= 90:
+                raise ValueError('ra must be in [0, 360) and dec in [-90, 90]')
+            if not 0 < radius <= CONE_SEARCH_MAX_RADIUS:
+                raise ValueError(f'radius must be in (0, {CONE_SEARCH_MAX_RADIUS}] arcmin')
+            if limit < 1 or limit > XMATCHES_BATCH_LIMIT:
+                raise ValueError(f'limit must be between 1 and {XMATCHES_BATCH_LIMIT}')
+        except (ValueError, TypeError) as e:
+            return {
+                'message': f'Invalid parameters: {e}',
+            }, 400
+
+        with get_db_connection() as conn:
+            c = conn.cursor()
+            data = {
+                'xmatches': cone_search_xmatches(ra, dec, radius, c, archival=archival, limit=limit),
+            }
+            if request.args.get('events', '0') in ['1', 'true', 'True']:
+                data['events'] = cone_search_events(ra, dec, radius, c, limit=limit)
+        return {
+            'message': f"Found {len(data['xmatches'])} xmatches",
+            'data': data,
+        }
+
+    # latencies of the pipeline (see db.PIPELINE_STAGES): for each stage, the p50/p90/p99 of the delay (in seconds) between
+    # ep_listener first seeing an event and the event or its xmatches reaching that stage, over rolling windows
+    # query parameters: windows (comma separated, e.g. 1h,24h,7d), archival (0/1, only the archival or non archival xmatches)
+    @app.route('/api/latency', methods=['GET'])
+    @auth()
+    def api_latency():
+        if request.user.get('type') != 'caltech':
+            return {
+                'message': 'Unauthorized, must be an admin user',
+            }, 401
+        try:
+            windows = [window.strip() for window in request.args.get('windows', LATENCY_WINDOWS).split(',') if window.strip()]
+            durations = [parse_window(window) for window in windows]
+            if not durations or max(durations) > LATENCY_MAX_WINDOW:
+                raise ValueError(f'at least one window is required, and at most {LATENCY_MAX_WINDOW // (24 * 60 * 60)}d')
+            archival = request.args.get('archival', None)
+            archival = None if archival in [None, ''] else archival in ['1', 'true', 'True']
+        except ValueError as e:
+            return {
+                'message': f'Invalid parameters: {e}',
+            }, 400
+
+        now = time.time()
+        data = {}
+        with get_db_connection() as conn:
+            c = conn.cursor()
+            for window, duration in zip(windows, durations):
+                delays = fetch_pipeline_delays(c, now - duration, archival=archival)
+                data[window] = {stage: latency_summary(stage_delays) for stage, stage_delays in delays.items()}
+        return {
+            'message': 'Pipeline latencies (in seconds since the event was first seen)',
+            'data': data,
+        }
+
+    # statistics of the events, xmatches and Fritz deliveries, read from their rollups only (see db.fetch_stats)
+    # query parameters: days (number of days of daily counters, 30 by default)
+    @app.route('/api/stats', methods=['GET'])
+    @auth()
+    def api_stats():
+        if request.user.get('type') != 'caltech':
+            return {
+                'message': 'Unauthorized, must be an admin user',
+            }, 401
+        try:
+            days = int(request.args.get('days', STATS_DAYS))
+            if days < 1 or days > STATS_MAX_DAYS:
+                raise ValueError(f'days must be between 1 and {STATS_MAX_DAYS}')
+        except ValueError as e:
+            return {
+                'message': f'Invalid parameters: {e}',
+            }, 400
+        with get_db_connection() as conn:
+            stats = fetch_stats(conn.cursor(), days=days)
+        return {
+            'message': f'Statistics of the last {days} days',
+            'data': stats_summary(stats),
+        }
+
+    # export the xmatches (optionally with their event) as NDJSON, CSV or Arrow IPC, streamed as they are read
+    # query parameters: format (ndjson, csv, arrow), with_events (0/1), event_names (comma separated), archival (0/1), since_id
+    @app.route('/api/export/xmatches', methods=['GET'])
+    @auth()
+    def api_export_xmatches():
+        if request.user.get('type') != 'caltech':
+            return {
+                'message': 'Unauthorized, must be an admin user',
+            }, 401
+        format = request.args.get('format', 'ndjson')
+        archival = request.args.get('archival', None)
+        event_names = request.args.get('event_names', None)
+        try:
+            since_id = request.args.get('since_id', None)
+            since_id = int(since_id) if since_id not in [None, ''] else None
+            stream = export_xmatches(
+                format=format,
+                with_events=request.args.get('with_events', '0') in ['1', 'true', 'True'],
+                event_names=[name for name in event_names.split(',') if name] if event_names else None,
+                archival=None if archival in [None, ''] else archival in ['1', 'true', 'True'],
+                since_id=since_id,
+            )
+        except ValueError as e:
+            return {
+                'message': f'Invalid parameters: {e}',
+            }, 400
+        mimetype, extension = EXPORT_FORMATS[format]
+        return Response(
+            stream,
+            mimetype=mimetype,
+            headers={'Content-Disposition': f'attachment; filename=xmatches.{extension}'},
+        )
+
     # we want an auth frontend decorator, so that if you are not authenticated, you are redirected to the login page
     def auth_frontend():
         def _auth_frontend(f):
             @wraps(f)
             def __auth_frontend(*args, **kwargs):
-                # check if we have a cookie with the Authorization
-                username, password = None, None
-                if 'Authorization' in request.cookies:
-                    username, password = request.cookies['Authorization'].split(':')
-
-                if not username or not password:
+                # check if we have a cookie with a valid session token
+                token = request.cookies.get('Authorization')
+                if not token:
                     return render_template('login.html', error='Unauthorized, please login')
 
-                if (
-                    not username_regex.match(username)
-                    or not username_regex.match(password)
-                ):
-                    render_template('login.html', error='Invalid username or password')
-                with get_db_connection() as conn:
-                    c = conn.cursor()
-                    existing_user = c.execute('SELECT * FROM users WHERE username = ? AND password = ?', (username, password)).fetchone()
-                    if existing_user is None:
-                        return render_template('login.html', error='Invalid username or password')
-                    
-                    request.user = existing_user
-                    
+                try:
+                    session = sessions.loads(token, max_age=SESSION_MAX_AGE)
+                except BadSignature:
+                    return render_template('login.html', error='Session expired, please login')
+
+                key = ('session', session.get('id'), session.get('username'))
+                user = get_cached_principal(key)
+                if user is None:
+                    with get_db_connection() as conn:
+                        c = conn.cursor()
+                        existing_user = c.execute('SELECT * FROM users WHERE id = ? AND username = ?', (session.get('id'), session.get('username'))).fetchone()
+                        if existing_user is None:
+                            return render_template('login.html', error='Invalid username or password')
+                    user = cache_principal(key, existing_user)
+
+                request.user = user
+
                 result = f(*args, **kwargs)
                 return result
             return __auth_frontend
@@ -278,36 +796,44 @@ def make_app():
             matchesOnly = True
             matchesOnlyIgnoreArchival = True
         
-        now = Time.now().jd
-        with get_db_connection() as conn:
-            c = conn.cursor()
-            events, totalMatches = fetch_events(
-                None, c, pageNumber=pageNumber, numPerPage=numPerPage, order_by='obs_start DESC',
-                matchesOnly=matchesOnly,
-                matchesOnlyIgnoreArchival=matchesOnlyIgnoreArchival,
-                matchesMaxDeltaT=DT_XMATCH_NONADMIN if user_type not in ["caltech"] else None,
-                latestOnly=latestOnly,
-                user_type=user_type,
-            )
-            if events is None:
-                events = []
-            for event in events:
-                if user_type not in ["caltech"]:
-                    # for non admins we don't show archival xmatches
-                    # and we limit to matches where the delta T is <= MAX_DT_XMATCH_NONADMIN
-                    count = c.execute('SELECT COUNT(*) FROM xmatches WHERE event_id = ? AND abs(delta_t) <= ? AND archival = 0', (event['id'], DT_XMATCH_NONADMIN)).fetchone()['COUNT(*)']
-                    event['num_xmatches'] = count
-                else:
-                    count = c.execute('SELECT COUNT(*) FROM xmatches WHERE event_id = ? AND archival = 0', (event['id'],)).fetchone()['COUNT(*)']
-                    event['num_xmatches'] = count
-                    count = c.execute('SELECT COUNT(*) FROM xmatches WHERE event_id = ? AND archival = 1', (event['id'],)).fetchone()['COUNT(*)']
-                    event['num_archival_xmatches'] = count
+        # the page's data is cached until the events or xmatches change (and at most PAGE_CACHE_TTL seconds,
+        # as the age of the events shown is relative to now)
+        cache_version, page = page_cache.get(('events', pageNumber, numPerPage, matchesOnly, matchesOnlyIgnoreArchival, latestOnly, user_type))
+        if page is None:
+            now = now_jd()
+            with get_db_connection() as conn:
+                c = conn.cursor()
+                events, totalMatches = fetch_events(
+                    None, c, pageNumber=pageNumber, numPerPage=numPerPage, order_by='obs_start DESC',
+                    matchesOnly=matchesOnly,
+                    matchesOnlyIgnoreArchival=matchesOnlyIgnoreArchival,
+                    matchesMaxDeltaT=DT_XMATCH_NONADMIN if user_type not in ["caltech"] else None,
+                    latestOnly=latestOnly,
+                    user_type=user_type,
+                )
+                if events is None:
+                    events = []
+                # the numbers of xmatches of the events, from their rollups (see db.refresh_event_stats)
+                event_stats = fetch_event_stats([event['id'] for event in events], c)
+                for event in events:
+                    stats = event_stats.get(event['id'], {})
+                    if user_type not in ["caltech"]:
+                        # for non admins we don't show archival xmatches
+                        # and we limit to matches where the delta T is <= MAX_DT_XMATCH_NONADMIN
+                        event['num_xmatches'] = stats.get('num_prompt_xmatches', 0)
+                    else:
+                        event['num_xmatches'] = stats.get('num_xmatches', 0)
+                        # including the ones in the cold tier (see tiering.py)
+                        event['num_archival_xmatches'] = stats.get('num_archival_xmatches', 0)
                 
-                dt = (now - Time(event['obs_start']).jd) * 24
-                if dt < 24:
-                    event['delta_t'] = f"<{int(dt + 0.5)}h"
-                else:
-                    event['delta_t'] = ">24h"
+                    dt = (now - iso_to_jd(event['obs_start'])) * 24
+                    if dt < 24:
+                        event['delta_t'] = f"<{int(dt + 0.5)}h"
+                    else:
+                        event['delta_t'] = ">24h"
+            page = {'events': events, 'totalMatches': totalMatches}
+            page_cache.set(cache_version, page)
+        events, totalMatches = page['events'], page['totalMatches']
 
         try:
             template_rendered = render_template(
@@ -353,84 +879,113 @@ def make_app():
                     'message': 'Invalid version',
                 }, 400
 
-        with get_db_connection() as conn:
-            c = conn.cursor()
-            event = fetch_event(
-                event_name, c,
-                version=version,
-            )
-            if event is None:
-                return {
-                    'message': 'Event not found',
-                }, 404
+        cache_version, page = page_cache.get(('event', event_name, version, user_type))
+        if page is None:
+            with get_db_connection() as conn:
+                c = conn.cursor()
+                event = fetch_event(
+                    event_name, c,
+                    version=version,
+                )
+                if event is None:
+                    return {
+                        'message': 'Event not found',
+                    }, 404
             
-            # to the event, we add the time in JD
-            event['obs_start_jd'] = Time(event['obs_start']).jd
+                # to the event, we add the time in JD
+                event['obs_start_jd'] = iso_to_jd(event['obs_start'])
             
-            versions = c.execute('SELECT version FROM events WHERE name = ? ORDER BY version DESC', (event_name,)).fetchall()
-            versions = [v['version'] for v in versions]
+                versions = c.execute('SELECT version FROM events WHERE name = ? ORDER BY version DESC', (event_name,)).fetchall()
+                versions = [v['version'] for v in versions]
             
-            xmatches, _ = fetch_xmatches(
-                [event['id']], c,
-                maxDeltaT=DT_XMATCH_NONADMIN if user_type not in ["caltech"] else None,
-                archival=False
-            )
-            for xmatch in xmatches:
-                dt = float(xmatch['delta_t'])
-                dt_abs = abs(dt)
-                dt_text = None
-                # if it's less than 1 minute, show in seconds
-                if dt_abs < 1/24/60:
-                    dt_text = f"{int(dt_abs * 24 * 60 * 60 + 0.5)}s"
-                # if it's less than 1 hour, show in minutes
-                if dt_abs < 1/24:
-                    dt_text = f"{int(dt_abs * 24 * 60 + 0.5)}m"
-                # if it's less than 1 day, show in hours
-                elif dt_abs < 1:
-                    dt_text = f"{int(dt_abs * 24 + 0.5)}h"
-                # else show in days
-                else:
-                    dt_text = f"{int(dt_abs + 0.5)}d"
-
-                if dt < 0:
-                    dt_text = f"-{dt_text}"
-                xmatch['delta_t'] = dt_text
-
-                # we add the time in UTC
-                xmatch['utc'] = Time(xmatch['jd'], format='jd').to_datetime().strftime('%Y-%m-%d %H:%M:%S')
-
-            # same with archival xmatches
-            archival_xmatches = []
-            if user_type in ["caltech"]:
-                archival_xmatches, _ = fetch_xmatches(
+                xmatches, _ = fetch_xmatches(
                     [event['id']], c,
-                    archival=True
+                    maxDeltaT=DT_XMATCH_NONADMIN if user_type not in ["caltech"] else None,
+                    archival=False
                 )
-                for xmatch in archival_xmatches:
+                for xmatch in xmatches:
                     dt = float(xmatch['delta_t'])
+                    dt_abs = abs(dt)
+                    dt_text = None
+                    # if it's less than 1 minute, show in seconds
+                    if dt_abs < 1/24/60:
+                        dt_text = f"{int(dt_abs * 24 * 60 * 60 + 0.5)}s"
                     # if it's less than 1 hour, show in minutes
-                    if abs(dt) < 1/24:
-                        xmatch['delta_t'] = f"{int(dt * 24 * 60 + 0.5)}m"
+                    if dt_abs < 1/24:
+                        dt_text = f"{int(dt_abs * 24 * 60 + 0.5)}m"
                     # if it's less than 1 day, show in hours
-                    elif abs(dt) < 1:
-                        xmatch['delta_t'] = f"{int(dt * 24 + 0.5)}h"
+                    elif dt_abs < 1:
+                        dt_text = f"{int(dt_abs * 24 + 0.5)}h"
                     # else show in days
                     else:
-                        xmatch['delta_t'] = f"{int(dt + 0.5)}d"
+                        dt_text = f"{int(dt_abs + 0.5)}d"
+
+                    if dt < 0:
+                        dt_text = f"-{dt_text}"
+                    xmatch['delta_t'] = dt_text
 
                     # we add the time in UTC
-                    xmatch['utc'] = Time(xmatch['jd'], format='jd').utc.isot
-
-            return render_template(
-                'event.html',
-                event=event,
-                versions=versions,
-                xmatches=xmatches,
-                archival_xmatches=archival_xmatches,
-                username=request.user.get('username'),
-                user_type=user_type,
-            )
+                    xmatch['utc'] = jd_to_datetime(xmatch['jd']).strftime('%Y-%m-%d %H:%M:%S')
+
+                # same with archival xmatches
+                archival_xmatches = []
+                if user_type in ["caltech"]:
+                    archival_xmatches, _ = fetch_xmatches(
+                        [event['id']], c,
+                        archival=True
+                    )
+                    for xmatch in archival_xmatches:
+                        dt = float(xmatch['delta_t'])
+                        # if it's less than 1 hour, show in minutes
+                        if abs(dt) < 1/24:
+                            xmatch['delta_t'] = f"{int(dt * 24 * 60 + 0.5)}m"
+                        # if it's less than 1 day, show in hours
+                        elif abs(dt) < 1:
+                            xmatch['delta_t'] = f"{int(dt * 24 + 0.5)}h"
+                        # else show in days
+                        else:
+                            xmatch['delta_t'] = f"{int(dt + 0.5)}d"
+
+                        # we add the time in UTC
+                        xmatch['utc'] = jd_to_isot(xmatch['jd'])
+            page = {'event': event, 'versions': versions, 'xmatches': xmatches, 'archival_xmatches': archival_xmatches}
+            page_cache.set(cache_version, page)
+
+        return render_template(
+            'event.html',
+            event=page['event'],
+            versions=page['versions'],
+            xmatches=page['xmatches'],
+            archival_xmatches=page['archival_xmatches'],
+            username=request.user.get('username'),
+            user_type=user_type,
+        )
     
+    @app.route('/stats', methods=['GET'])
+    @auth_frontend()
+    def stats_page():
+        # the statistics dashboard (admin only), see /api/stats
+        user_type = request.user.get('type')
+        if user_type != 'caltech':
+            return {
+                'message': 'Unauthorized, must be an admin user',
+            }, 401
+        try:
+            days = min(max(int(request.args.get('days', STATS_DAYS)), 1), STATS_MAX_DAYS)
+        except ValueError:
+            return {
+                'message': 'Invalid query parameters',
+            }, 400
+        with get_db_connection() as conn:
+            stats = fetch_stats(conn.cursor(), days=days)
+        return render_template(
+            'stats.html',
+            stats=stats_summary(stats),
+            days=days,
+            username=request.user.get('username'),
+            user_type=user_type,
+        )
+
     @app.route('/candidates', methods=['GET'])
     @auth_frontend()
     def candidates_page():
@@ -452,70 +1007,75 @@ def make_app():
                 'message': 'Invalid query parameters',
             }, 400
     
-        with get_db_connection() as conn:
-            c = conn.cursor()
-            candidates, totalMatches = fetch_xmatches(
-                None, c,
-                pageNumber=pageNumber,
-                numPerPage=numPerPage,
-                deduplicateByEventName=True,
-            )
-            if candidates is None:
-                candidates = []
-            event_ids = set() # to fetch event information for the candidates
-            for candidate in candidates:
-                # collect the event ids for the candidates
-                if 'event_id' in candidate:
-                    event_ids.add(candidate['event_id'])
-
-            events, _ = fetch_events(
-                None, c, 
-                latestOnly=True, # we want all events, not just the latest
-                event_ids=list(event_ids), # only fetch events that are in the candidates
-            )
+        cache_version, page = page_cache.get(('candidates', pageNumber, numPerPage, user_type))
+        if page is None:
+            with get_db_connection() as conn:
+                c = conn.cursor()
+                candidates, totalMatches = fetch_xmatches(
+                    None, c,
+                    pageNumber=pageNumber,
+                    numPerPage=numPerPage,
+                    deduplicateByEventName=True,
+                )
+                if candidates is None:
+                    candidates = []
+                event_ids = set() # to fetch event information for the candidates
+                for candidate in candidates:
+                    # collect the event ids for the candidates
+                    if 'event_id' in candidate:
+                        event_ids.add(candidate['event_id'])
 
-            # convert to a hashmap for quick access
-            events = {
-                event['id']: event
-                for event in events
-            }
-            # add event information to each candidate
-            for candidate in candidates:
-                candidate['event'] = events.get(candidate['event_id'], None)
-
-                dt = float(candidate['delta_t'])
-                dt_abs = abs(dt)
-                dt_text = None
-                # if it's less than 1 minute, show in seconds
-                if dt_abs < 1/24/60:
-                    dt_text = f"{int(dt_abs * 24 * 60 * 60 + 0.5)}s"
-                # if it's less than 1 hour, show in minutes
-                if dt_abs < 1/24:
-                    dt_text = f"{int(dt_abs * 24 * 60 + 0.5)}m"
-                # if it's less than 1 day, show in hours
-                elif dt_abs < 1:
-                    dt_text = f"{int(dt_abs * 24 + 0.5)}h"
-                # else show in days
-                else:
-                    dt_text = f"{int(dt_abs + 0.5)}d"
-
-                if dt < 0:
-                    dt_text = f"-{dt_text}"
-                candidate['delta_t_str'] = dt_text
-
-                # we add the time in UTC
-                candidate['utc'] = Time(candidate['jd'], format='jd').to_datetime().strftime('%Y-%m-%d %H:%M:%S')
-            
-            return render_template(
-                'candidates.html',
-                candidates=candidates,
-                pageNumber=pageNumber,
-                numPerPage=numPerPage,
-                totalMatches=totalMatches,
-                totalPages=(totalMatches + numPerPage - 1) // numPerPage,
-                username=request.user.get('username'),
-                user_type=user_type,
-            )
+                events, _ = fetch_events(
+                    None, c, 
+                    latestOnly=True, # we want all events, not just the latest
+                    event_ids=list(event_ids), # only fetch events that are in the candidates
+                )
+
+                # convert to a hashmap for quick access
+                events = {
+                    event['id']: event
+                    for event in events
+                }
+                # add event information to each candidate
+                for candidate in candidates:
+                    candidate['event'] = events.get(candidate['event_id'], None)
+
+                    dt = float(candidate['delta_t'])
+                    dt_abs = abs(dt)
+                    dt_text = None
+                    # if it's less than 1 minute, show in seconds
+                    if dt_abs < 1/24/60:
+                        dt_text = f"{int(dt_abs * 24 * 60 * 60 + 0.5)}s"
+                    # if it's less than 1 hour, show in minutes
+                    if dt_abs < 1/24:
+                        dt_text = f"{int(dt_abs * 24 * 60 + 0.5)}m"
+                    # if it's less than 1 day, show in hours
+                    elif dt_abs < 1:
+                        dt_text = f"{int(dt_abs * 24 + 0.5)}h"
+                    # else show in days
+                    else:
+                        dt_text = f"{int(dt_abs + 0.5)}d"
+
+                    if dt < 0:
+                        dt_text = f"-{dt_text}"
+                    candidate['delta_t_str'] = dt_text
+
+                    # we add the time in UTC
+                    candidate['utc'] = jd_to_datetime(candidate['jd']).strftime('%Y-%m-%d %H:%M:%S')
+            page = {'candidates': candidates, 'totalMatches': totalMatches}
+            page_cache.set(cache_version, page)
+        candidates, totalMatches = page['candidates'], page['totalMatches']
+
+        return render_template(
+            'candidates.html',
+            candidates=candidates,
+            pageNumber=pageNumber,
+            numPerPage=numPerPage,
+            totalMatches=totalMatches,
+            totalPages=(totalMatches + numPerPage - 1) // numPerPage,
+            username=request.user.get('username'),
+            user_type=user_type,
+        )
         
     @app.route('/login', methods=['POST'])
     # this route should get the username and password from the request, check if they are in the database, and if so set a cookie and redirect to the events page
@@ -531,12 +1091,15 @@ def make_app():
         with get_db_connection() as conn:
             c = conn.cursor()
             c.execute('SELECT * FROM users WHERE username = ? AND password = ?', (username, password))
-            if c.fetchone() is None:
+            user = c.fetchone()
+            if user is None:
                 return render_template('login.html', error='Invalid username or password')
-        
-        # set a cookie for the Authorization
+
+        # set a cookie with a signed session token, the password is never stored in it
+        token = sessions.dumps({'id': user['id'], 'username': user['username']})
+        cache_principal(('session', user['id'], user['username']), user)
         response = app.make_response(redirect('/'))
-        response.set_cookie('Authorization', f'{username}:{password}', max_age=60*60*24) # 1 day
+        response.set_cookie('Authorization', token, max_age=SESSION_MAX_AGE, httponly=True)
         return response
     
     @app.route('/logout', methods=['POST'])
@@ -549,7 +1112,6 @@ def make_app():
     return app
 
 if __name__ == "__main__":
-
     while not is_db_initialized():
         print('Waiting for database to be initialized...')
         time.sleep(15)
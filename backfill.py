@@ -0,0 +1,381 @@
+import argparse
+import json
+import os
+import sqlite3
+import time
+from multiprocessing import Pool
+
+from db import (
+    DATABASE_PATH, DT_XMATCH_NONADMIN, dict_factory, is_db_initialized,
+    index_positions, enqueue_fritz_outbox, bump_stats, refresh_event_stats,
+)
+from ep_xmatch import (
+    ALERT_FIELDS, FILTER_ONLY_FIELDS, DELTA_T, DELTA_T_ARCHIVAL,
+    search_window, search_radius, passes_alert_filter, project_alert, format_match, is_red_star, great_circle_distance,
+)
+from tiering import drop_cold, delete_partitions
+
+# offline rematch of the events against local dumps of ZTF alerts (Parquet, Avro or JSON/NDJSON files of alert packets),
+# e.g. after changing the filters of the cone searches (see ep_xmatch.alert_filter, RADIUS_MULTIPLIER, DELTA_T...),
+# instead of querying Kowalski again for every event with /api/reprocess:
+#   python backfill.py /data/ztf_alerts/ --workers 16 [--dry-run]
+# the dumps are split in shards (a file, or a row group of a Parquet file, dumps being usually nightly: a shard is a
+# time range), matched against all the events by a pool of processes with the same filters and formatting as ep_xmatch,
+# and the matches are written to a staging table. They are then swapped in, in a single transaction: for each event,
+# its xmatches that the rematch doesn't find anymore are deleted (including the archival ones in the cold tier),
+# the new ones are inserted, and the ones found again are left untouched (with their Fritz deliveries).
+# Only the events that ep_xmatch is done with and whose search windows are within the time range of the dumps
+# are swapped, the others are left as they are. That time range is the union of the ones of the shards, merged when
+# they are less than BACKFILL_GAP_TOLERANCE days apart: a gap (e.g. a missing nightly dump) is reported, and the
+# events whose search windows overlap it are left out too
+
+BACKFILL_WORKERS = int(os.getenv('BACKFILL_WORKERS', os.cpu_count() or 1))
+BACKFILL_BATCH_SIZE = int(os.getenv('BACKFILL_BATCH_SIZE', 50000))  # alerts read at a time from a dump
+BACKFILL_STAGING_TABLE = 'backfill_xmatches'
+# in days, the time between the shards that is not a gap in the dumps: there are no alerts during the day, raise it
+# if the dumps skip the nights without any (e.g. bad weather)
+BACKFILL_GAP_TOLERANCE = float(os.getenv('BACKFILL_GAP_TOLERANCE', 1.0))
+
+DUMP_FORMATS = {
+    '.parquet': 'parquet',
+    '.avro': 'avro',
+    '.json': 'json',
+    '.ndjson': 'json',
+    '.jsonl': 'json',
+}
+
+# the columns of the xmatches set by the backfill (see ep_xmatch.format_match), the others keep their default
+MATCH_COLUMNS = [
+    'candid',
+    *[name for name in ALERT_FIELDS if name not in FILTER_ONLY_FIELDS and name != 'jdstarthist'],
+    'delta_t', 'distance_arcmin', 'distance_ratio', 'age', 'archival', 'event_id',
+]
+
+def list_shards(paths: list) -> list:
+    # (path, Parquet row group or None) of the dumps, the directories are searched recursively
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                files += [os.path.join(root, name) for name in names]
+        else:
+            files.append(path)
+    shards = []
+    for path in sorted(files):
+        format = DUMP_FORMATS.get(os.path.splitext(path)[1].lower())
+        if format is None:
+            continue
+        if format == 'parquet':
+            import pyarrow.parquet as pq
+            shards += [(path, row_group) for row_group in range(pq.ParquetFile(path).num_row_groups)]
+        else:
+            shards.append((path, None))
+    return shards
+
+def _nest(row: dict) -> dict:
+    # flattened columns (candidate.jd, ...) back into the alert packet structure
+    alert = {}
+    for key, value in row.items():
+        if key.startswith('candidate.'):
+            alert.setdefault('candidate', {})[key[len('candidate.'):]] = value
+        else:
+            alert[key] = value
+    return alert
+
+def read_alerts(path: str, row_group: int = None, batch_size: int = BACKFILL_BATCH_SIZE):
+    # yields lists of alert packets (dicts with objectId, candid and candidate), batch_size at a time
+    format = DUMP_FORMATS[os.path.splitext(path)[1].lower()]
+    if format == 'parquet':
+        import pyarrow.parquet as pq
+        dump = pq.ParquetFile(path)
+        columns = [name for name in dump.schema_arrow.names if name in ['objectId', 'candid', 'candidate'] or name.startswith('candidate.')]
+        for batch in dump.iter_batches(batch_size=batch_size, row_groups=[row_group], columns=columns):
+            yield [_nest(row) for row in batch.to_pylist()]
+    elif format == 'avro':
+        try:
+            import fastavro
+        except ImportError:
+            raise ValueError('Reading Avro dumps requires fastavro to be installed')
+        with open(path, 'rb') as f:
+            batch = []
+            for alert in fastavro.reader(f):
+                batch.append(alert)
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+    else:
+        with open(path) as f:
+            if f.read(1) == '[':
+                # a single JSON array
+                f.seek(0)
+                alerts = json.load(f)
+                for i in range(0, len(alerts), batch_size):
+                    yield alerts[i:i + batch_size]
+                return
+            f.seek(0)
+            batch = []
+            for line in f:
+                if line.strip():
+                    batch.append(json.loads(line))
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+
+_events = None
+
+def _init_worker(events: list) -> None:
+    global _events
+    _events = [
+        {
+            **event,
+            'windows': [(True, *search_window(event, archival=True)), (False, *search_window(event))],
+            'radius': search_radius(event) / 3600, # in degrees
+        }
+        for event in events
+    ]
+
+def match_shard(shard: tuple) -> dict:
+    # the matches of the events in a shard of the dumps, and the time range it covers
+    import numpy as np
+    path, row_group = shard
+    alerts = []
+    num_alerts = 0
+    jd_min, jd_max = float('inf'), float('-inf')
+    for batch in read_alerts(path, row_group):
+        num_alerts += len(batch)
+        for alert in batch:
+            candidate = alert.get('candidate') or {}
+            jd = candidate.get('jd')
+            if jd is None:
+                continue
+            jd_min, jd_max = min(jd_min, jd), max(jd_max, jd)
+            if passes_alert_filter(candidate):
+                alerts.append(project_alert(alert))
+
+    matches = []
+    if alerts:
+        alerts.sort(key=lambda alert: alert['jd'])
+        jds = np.array([alert['jd'] for alert in alerts])
+        ras = np.array([alert['ra'] for alert in alerts])
+        decs = np.array([alert['dec'] for alert in alerts])
+        for event in _events:
+            # like ep_xmatch, the archival search goes first, and an alert matched by both is an archival match
+            found = set()
+            for archival, jd_start, jd_end in event['windows']:
+                start, end = np.searchsorted(jds, jd_start, side='left'), np.searchsorted(jds, jd_end, side='right')
+                if start == end:
+                    continue
+                distances = great_circle_distance(event['ra'], event['dec'], ras[start:end], decs[start:end])
+                for i in np.nonzero(distances <= event['radius'])[0]:
+                    match = dict(alerts[start + i])
+                    if match['candid'] in found or is_red_star(match):
+                        continue
+                    found.add(match['candid'])
+                    matches.append(format_match(match, event, archival))
+    return {'shard': shard, 'alerts': num_alerts, 'filtered': len(alerts), 'jd_min': jd_min, 'jd_max': jd_max, 'matches': matches}
+
+def fetch_backfill_events(c: sqlite3.Cursor, event_names: list = None, obs_start_min: str = None, obs_start_max: str = None) -> list:
+    # the events that ep_xmatch is done with, in the scope of the backfill
+    conditions = ["query_status = 'done'"]
+    parameters = []
+    if event_names:
+        conditions.append('name IN ({})'.format(','.join('?'*len(event_names))))
+        parameters += event_names
+    if obs_start_min:
+        conditions.append('obs_start >= ?')
+        parameters.append(obs_start_min)
+    if obs_start_max:
+        conditions.append('obs_start <= ?')
+        parameters.append(obs_start_max)
+    return c.execute(
+        f"SELECT id, name, version, ra, dec, pos_err, obs_start FROM events WHERE {' AND '.join(conditions)} ORDER BY id",
+        tuple(parameters)
+    ).fetchall()
+
+def create_staging_table(c: sqlite3.Cursor) -> None:
+    types = {row['name']: row['type'] for row in c.execute('PRAGMA table_info(xmatches)').fetchall()}
+    c.execute(f'DROP TABLE IF EXISTS {BACKFILL_STAGING_TABLE}')
+    c.execute(f'''
+        CREATE TABLE {BACKFILL_STAGING_TABLE} (
+            {', '.join(f'{column} {types[column]}' for column in MATCH_COLUMNS)},
+            UNIQUE (event_id, candid)
+        )
+    ''')
+
+def stage_matches(matches: list, c: sqlite3.Cursor) -> None:
+    c.executemany(
+        f"INSERT OR IGNORE INTO {BACKFILL_STAGING_TABLE} ({', '.join(MATCH_COLUMNS)}) VALUES ({', '.join('?'*len(MATCH_COLUMNS))})",
+        [tuple(match.get(column, 0 if column == 'archival' else None) for column in MATCH_COLUMNS) for match in matches]
+    )
+
+def merge_ranges(ranges: list, tolerance: float = BACKFILL_GAP_TOLERANCE) -> list:
+    # the [jd_min, jd_max] of the shards merged in the time ranges covered by the dumps, sorted. The shards without
+    # any alert are left out, and the ones less than tolerance days apart are merged
+    merged = []
+    for jd_min, jd_max in sorted(r for r in ranges if r[0] <= r[1]):
+        if merged and jd_min <= merged[-1][1] + tolerance:
+            merged[-1][1] = max(merged[-1][1], jd_max)
+        else:
+            merged.append([jd_min, jd_max])
+    return merged
+
+def is_covered(event: dict, ranges: list) -> bool:
+    # whether both search windows of the event (one after the other) are within one of the time ranges of the dumps
+    start, _ = search_window(event, archival=True)
+    _, end = search_window(event)
+    return any(jd_min <= start and end <= jd_max for jd_min, jd_max in ranges)
+
+# the xmatches of the swapped events that the rematch didn't find (again, or with the same archival flag),
+# and the matches of the rematch that aren't xmatches yet
+_GONE = f'''
+    xmatches.event_id IN (SELECT event_id FROM temp.backfill_events)
+    AND NOT EXISTS (
+        SELECT 1 FROM {BACKFILL_STAGING_TABLE} AS staged
+        WHERE staged.event_id = xmatches.event_id AND staged.candid = xmatches.candid AND staged.archival = xmatches.archival
+    )
+'''
+_NEW = f'''
+    staged.event_id IN (SELECT event_id FROM temp.backfill_events)
+    AND NOT EXISTS (
+        SELECT 1 FROM xmatches WHERE xmatches.event_id = staged.event_id AND xmatches.candid = staged.candid
+    )
+'''
+
+def swap(event_ids: list, conn: sqlite3.Connection, dry_run: bool = False, enqueue_fritz: bool = False) -> dict:
+    # swaps the staged matches of the events in, in a single transaction (rolled back for a dry run)
+    c = conn.cursor()
+    c.execute('BEGIN IMMEDIATE')
+    try:
+        c.execute('CREATE TEMP TABLE IF NOT EXISTS backfill_events (event_id INTEGER PRIMARY KEY)')
+        c.execute('DELETE FROM temp.backfill_events')
+        c.executemany('INSERT INTO temp.backfill_events (event_id) VALUES (?)', [(event_id,) for event_id in event_ids])
+        cold_xmatches = c.execute(
+            "SELECT COALESCE(SUM(cold_archival_xmatches), 0) AS count FROM events WHERE id IN (SELECT event_id FROM temp.backfill_events) AND tier = 'cold'"
+        ).fetchone()['count']
+        # the cold tier of the events is dropped, its xmatches that are found again are inserted back in the database.
+        # Its files are only deleted once committed (for a dry run, they are counted as dropped, and the ones found again as inserted)
+        cold_paths = []
+        if not dry_run:
+            for i in range(0, len(event_ids), 500):
+                cold_paths += drop_cold(event_ids[i:i + 500], c)
+        c.execute(f'DELETE FROM xmatches WHERE {_GONE}')
+        deleted = c.rowcount
+        max_id = c.execute('SELECT COALESCE(MAX(id), 0) AS id FROM xmatches').fetchone()['id']
+        columns = ', '.join(MATCH_COLUMNS)
+        c.execute(f'INSERT INTO xmatches ({columns}) SELECT {columns} FROM {BACKFILL_STAGING_TABLE} AS staged WHERE {_NEW} ORDER BY staged.event_id, staged.jd')
+        inserted = c.execute('SELECT id, ra, dec, archival, delta_t FROM xmatches WHERE id > ?', (max_id,)).fetchall()
+        index_positions('xmatches', [(row['id'], row['ra'], row['dec']) for row in inserted], c)
+        if enqueue_fritz:
+            enqueue_fritz_outbox([row['id'] for row in inserted], c)
+        bump_stats({
+            'xmatches_inserted': sum(1 for row in inserted if not row['archival']),
+            'archival_xmatches_inserted': sum(1 for row in inserted if row['archival']),
+            'prompt_xmatches_inserted': sum(1 for row in inserted if not row['archival'] and row['delta_t'] is not None and abs(row['delta_t']) <= DT_XMATCH_NONADMIN),
+        }, c)
+        for i in range(0, len(event_ids), 500):
+            refresh_event_stats(event_ids[i:i + 500], c)
+        summary = {'events': len(event_ids), 'deleted': deleted, 'cold_dropped': cold_xmatches, 'inserted': len(inserted)}
+        c.execute('ROLLBACK' if dry_run else 'COMMIT')
+    except BaseException:
+        if conn.in_transaction:
+            c.execute('ROLLBACK')
+        raise
+    delete_partitions(cold_paths)
+    return summary
+
+def backfill(paths: list, workers: int = BACKFILL_WORKERS, event_names: list = None, obs_start_min: str = None, obs_start_max: str = None,
+             jd_min: float = None, jd_max: float = None, dry_run: bool = False, enqueue_fritz: bool = False) -> dict:
+    # the transactions are explicit (isolation_level=None), so that the swap is a single one
+    conn = sqlite3.connect(DATABASE_PATH, isolation_level=None)
+    conn.row_factory = dict_factory
+    try:
+        c = conn.cursor()
+        events = fetch_backfill_events(c, event_names, obs_start_min, obs_start_max)
+        shards = list_shards(paths)
+        print(f'Matching {len(events)} events against {len(shards)} shards of the dumps with {workers} workers...')
+        if not events or not shards:
+            return None
+        create_staging_table(c)
+
+        start = time.time()
+        num_alerts, num_filtered, num_matches = 0, 0, 0
+        shard_ranges = []
+        # the events are only sent once to each worker, the matches of each shard are staged as they come
+        with Pool(workers, initializer=_init_worker, initargs=([dict(event) for event in events],)) as pool:
+            for i, result in enumerate(pool.imap_unordered(match_shard, shards), start=1):
+                num_alerts += result['alerts']
+                num_filtered += result['filtered']
+                num_matches += len(result['matches'])
+                shard_ranges.append((result['jd_min'], result['jd_max']))
+                c.execute('BEGIN IMMEDIATE')
+                stage_matches(result['matches'], c)
+                c.execute('COMMIT')
+                print(f"[{i}/{len(shards)}] {result['shard'][0]}: {result['alerts']} alerts, {len(result['matches'])} matches")
+        print(f'Read {num_alerts} alerts ({num_filtered} passing the filters), found {num_matches} matches in {time.time() - start:.1f}s.')
+
+        # the events whose search windows the dumps don't cover would lose some of their xmatches, they are left out
+        ranges = merge_ranges(shard_ranges)
+        if jd_min is not None:
+            ranges = [r for r in ranges if r[1] >= jd_min]
+            if ranges:
+                ranges[0][0] = jd_min
+        if jd_max is not None:
+            ranges = [r for r in ranges if r[0] <= jd_max]
+            if ranges:
+                ranges[-1][1] = jd_max
+        if not ranges:
+            print('The dumps have no alerts in the time range, no event is swapped.')
+            return None
+        for (_, gap_start), (gap_end, _) in zip(ranges, ranges[1:]):
+            print(f'Warning: no alerts in the dumps from jd {gap_start} to {gap_end}, the events whose search windows overlap it are left out.')
+        event_ids = [event['id'] for event in events if is_covered(event, ranges)]
+        print(
+            f'{len(event_ids)} events are within the time range of the dumps ({ranges[0][0]} to {ranges[-1][1]}, '
+            f'{len(ranges) - 1} gaps), {len(events) - len(event_ids)} are left out.'
+        )
+        if not event_ids:
+            return None
+
+        summary = swap(event_ids, conn, dry_run=dry_run, enqueue_fritz=enqueue_fritz)
+        print(
+            f"{'Would swap' if dry_run else 'Swapped'} the xmatches of {summary['events']} events: "
+            f"{summary['deleted']} deleted, {summary['cold_dropped']} dropped from the cold tier, {summary['inserted']} inserted."
+        )
+        c.execute(f'DROP TABLE IF EXISTS {BACKFILL_STAGING_TABLE}')
+        return summary
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Rematch the events against local dumps of ZTF alerts')
+    parser.add_argument('dumps', nargs='+', help='dump files (.parquet, .avro, .json, .ndjson, .jsonl) or directories')
+    parser.add_argument('--workers', type=int, default=BACKFILL_WORKERS, help='number of processes matching the dumps')
+    parser.add_argument('--event-names', nargs='*', default=None, help='only rematch these events')
+    parser.add_argument('--obs-start-min', default=None, help='only rematch the events observed since (YYYY-MM-DD HH:MM:SS)')
+    parser.add_argument('--obs-start-max', default=None, help='only rematch the events observed until (YYYY-MM-DD HH:MM:SS)')
+    parser.add_argument('--jd-min', type=float, default=None, help='start of the time range of the dumps, if not the first alert')
+    parser.add_argument('--jd-max', type=float, default=None, help='end of the time range of the dumps, if not the last alert')
+    parser.add_argument('--enqueue-fritz', action='store_true', help='queue the new xmatches for delivery to Fritz')
+    parser.add_argument('--dry-run', action='store_true', help='report what would change without swapping the xmatches in')
+    args = parser.parse_args()
+
+    if not is_db_initialized():
+        print('The database is not initialized, run migrate.py first.')
+        exit(1)
+
+    print(f'Search windows: {DELTA_T} days before the events (archival: {DELTA_T_ARCHIVAL} more), {DELTA_T_ARCHIVAL} days after.')
+    backfill(
+        args.dumps,
+        workers=args.workers,
+        event_names=args.event_names,
+        obs_start_min=args.obs_start_min,
+        obs_start_max=args.obs_start_max,
+        jd_min=args.jd_min,
+        jd_max=args.jd_max,
+        dry_run=args.dry_run,
+        enqueue_fritz=args.enqueue_fritz,
+    )
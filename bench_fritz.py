@@ -0,0 +1,154 @@
+import argparse
+import logging
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+# end-to-end load benchmark of the ep_fritz poster, against the local SkyPortal stand-in (fake_skyportal.py)
+# pushes N synthetic xmatches through the outbox and reports the throughput, the per-call latency
+# and the number of requests made per candidate
+
+def percentile(values, q):
+    if len(values) == 0:
+        return float('nan')
+    values = sorted(values)
+    index = min(int(round(q / 100 * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+def jd_from_datetime(dt: datetime) -> float:
+    return dt.timestamp() / 86400.0 + 2440587.5
+
+def populate(n: int, n_events: int, n_objects: int, seed: int = None) -> list:
+    # insert the synthetic events and xmatches, and queue the xmatches for delivery
+    from db import get_db_connection, insert_xmatches, enqueue_fritz_outbox
+
+    rng = random.Random(seed)
+    now = datetime.now(timezone.utc)
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        event_ids = []
+        for i in range(n_events):
+            obs_start = now - timedelta(hours=rng.uniform(1, 48))
+            c.execute(
+                'INSERT INTO events (name, ra, dec, pos_err, obs_start, version, query_status) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (f'EPBENCH{i}', rng.uniform(0, 360), rng.uniform(-30, 90), 0.05, obs_start.strftime('%Y-%m-%d %H:%M:%S'), 'v1', 'done')
+            )
+            event_ids.append((c.lastrowid, jd_from_datetime(obs_start)))
+
+        xmatch_ids = []
+        for i in range(n):
+            event_id, event_jd = event_ids[i % n_events]
+            jd = event_jd + rng.uniform(0, 1)
+            xmatch_ids += insert_xmatches([{
+                'event_id': event_id,
+                'candid': 3000000000000000000 + i,
+                'object_id': f'ZTF26bench{i % n_objects:05d}',
+                'jd': jd,
+                'ra': rng.uniform(0, 360),
+                'dec': rng.uniform(-30, 90),
+                'fid': rng.choice([1, 2]),
+                'magpsf': rng.uniform(17, 21),
+                'sigmapsf': rng.uniform(0.01, 0.2),
+                'drb': rng.uniform(0.5, 1.0),
+                'delta_t': jd - event_jd,
+                'distance_arcmin': rng.uniform(0, 3),
+                'distance_ratio': rng.uniform(0, 1),
+                'age': rng.uniform(0, 10),
+                'sgscore': rng.uniform(0, 1),
+                'distpsnr': rng.uniform(0, 10),
+                'ssdistnr': -999.0,
+                'ssmagnr': -999.0,
+                'ndethist': rng.randint(1, 20),
+            }], c)
+        enqueue_fritz_outbox(xmatch_ids, c)
+        conn.commit()
+    return xmatch_ids
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the ep_fritz poster against a local SkyPortal stand-in.')
+    parser.add_argument('-n', type=int, default=200, help='Number of synthetic xmatches to post.')
+    parser.add_argument('--events', type=int, default=10, help='Number of synthetic events the xmatches belong to.')
+    parser.add_argument('--objects', type=int, default=None, help='Number of distinct object ids (defaults to n).')
+    parser.add_argument('--port', type=int, default=5051, help='Port of the local SkyPortal stand-in.')
+    parser.add_argument('--latency', type=float, default=0.0, help='Latency added to every request, in seconds.')
+    parser.add_argument('--latency-jitter', type=float, default=0.0, help='Random +/- jitter on the latency, in seconds.')
+    parser.add_argument('--rate-429', type=float, default=0.0, help='Fraction of requests answered with a 429.')
+    parser.add_argument('--rate-503', type=float, default=0.0, help='Fraction of requests answered with a 503.')
+    parser.add_argument('--duplicate-rate', type=float, default=0.0, help='Fraction of new candidates reported as duplicates.')
+    parser.add_argument('--batch-size', type=int, default=10, help='Number of deliveries claimed at once.')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed.')
+    args = parser.parse_args()
+
+    # the services read their configuration from the environment at import time,
+    # so we point them to a scratch database and to the stand-in before importing them
+    workdir = tempfile.mkdtemp(prefix='bench_fritz_')
+    os.environ['DATABASE_PATH'] = os.path.join(workdir, 'database.db')
+    os.environ['FRITZ_HOST'] = f'http://127.0.0.1:{args.port}'
+    os.environ['FRITZ_TOKEN'] = 'bench'
+    os.environ['FRITZ_FILTER_ID'] = '1'
+    os.environ['FRITZ_IMPORT_GROUP_ID'] = '1'
+    os.environ['FRITZ_POST_INTERVAL'] = '0'
+    os.environ['FRITZ_BATCH_SIZE'] = str(args.batch_size)
+
+    from werkzeug.serving import make_server
+    import fake_skyportal
+    import migrate
+    import ep_fritz
+    from db import get_db_connection
+
+    app = fake_skyportal.make_app(
+        latency=args.latency,
+        latency_jitter=args.latency_jitter,
+        rate_429=args.rate_429,
+        rate_503=args.rate_503,
+        duplicate_rate=args.duplicate_rate,
+        seed=args.seed,
+    )
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', args.port, app, threaded=True)
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+
+    try:
+        migrate.run_migrations()
+        xmatch_ids = populate(args.n, args.events, args.objects or args.n, seed=args.seed)
+
+        latencies = []
+        class TimedSkyPortal(ep_fritz.SkyPortal):
+            def api(self, *a, **kw):
+                start = time.perf_counter()
+                try:
+                    return super().api(*a, **kw)
+                finally:
+                    latencies.append(time.perf_counter() - start)
+
+        ep_fritz.sp = TimedSkyPortal(host=os.environ['FRITZ_HOST'], token=os.environ['FRITZ_TOKEN'])
+        latencies.clear()
+        app.config['STATS'].clear()
+
+        start = time.perf_counter()
+        with get_db_connection() as conn:
+            processed = ep_fritz.service(conn)
+            states = conn.execute('SELECT state, COUNT(*) AS count FROM fritz_outbox GROUP BY state').fetchall()
+        elapsed = time.perf_counter() - start
+    finally:
+        server.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    stats = dict(app.config['STATS'])
+    total_requests = stats.pop('total', 0)
+    print('---ep_fritz benchmark---')
+    print(f'xmatches queued: {len(xmatch_ids)}, posted: {processed}')
+    print('outbox states: ' + ', '.join(f"{s['state']}={s['count']}" for s in states))
+    print(f'elapsed: {elapsed:.2f}s, throughput: {processed / elapsed if elapsed > 0 else float("nan"):.2f} xmatches/s')
+    print(f'api calls: {len(latencies)}, p50: {percentile(latencies, 50) * 1000:.1f}ms, p99: {percentile(latencies, 99) * 1000:.1f}ms')
+    print(f'http requests: {total_requests}, per candidate: {total_requests / max(len(xmatch_ids), 1):.2f}')
+    for key, count in sorted(stats.items()):
+        print(f'  {key}: {count}')
+
+if __name__ == "__main__":
+    main()
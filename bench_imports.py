@@ -0,0 +1,86 @@
+import argparse
+import os
+import subprocess
+import sys
+
+# startup benchmark of the entry points: imports each of them in a fresh interpreter with `python -X importtime`,
+# and fails (exit code 1) if one takes longer than the budget or loads one of the heavy modules that must stay lazy.
+# Run it after changing imports, e.g. python bench_imports.py --budget 300. The same checks run in tests/test_import_budget.py
+
+ENTRY_POINTS = ['api', 'ep_listener', 'ep_xmatch', 'ep_fritz', 'reprocess', 'runtime', 'tiering', 'analytics', 'backfill']
+
+# the modules that must not be loaded when importing an entry point (they are imported where they are used)
+FORBIDDEN_MODULES = ['astropy', 'numpy', 'pyarrow']
+FORBIDDEN_MODULES_API = FORBIDDEN_MODULES + ['penquins', 'gevent']
+
+IMPORT_BUDGET_MS = float(os.getenv('IMPORT_BUDGET_MS', 500.0))  # per entry point, in milliseconds
+
+# the services check their configuration when imported, placeholders are enough to import them
+PLACEHOLDER_ENV = {
+    'FRITZ_HOST': 'http://localhost',
+    'FRITZ_TOKEN': 'token',
+    'FRITZ_FILTER_ID': '1',
+    'FRITZ_IMPORT_GROUP_ID': '1',
+    'API_SECRET_KEY': 'secret',
+}
+
+def import_times(module: str) -> tuple:
+    # the cumulative import time of the module (in ms), the times of its direct imports, and all the modules it loaded
+    env = {**PLACEHOLDER_ENV, **os.environ}
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        capture_output=True, text=True, env=env, cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f'Failed to import {module}:\n{result.stderr[-2000:]}')
+    # import time: self [us] | cumulative | imported package, the imports are listed after the ones they triggered
+    # (indented by 2 spaces per level), so the subtree of the module is made of the lines just before it
+    lines = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip(' ')) - 1) // 2
+        lines.append((depth, name.strip(), int(cumulative) / 1000))
+    index = max(i for i, (depth, name, _) in enumerate(lines) if depth == 0 and name == module)
+    direct, loaded = [], set()
+    for depth, name, ms in reversed(lines[:index]):
+        if depth == 0:
+            break
+        loaded.add(name.split('.')[0])
+        if depth == 1:
+            direct.append((name, ms))
+    return lines[index][2], direct, loaded
+
+def main():
+    parser = argparse.ArgumentParser(description='Startup benchmark of the entry points')
+    parser.add_argument('modules', nargs='*', default=ENTRY_POINTS, help='entry points to import')
+    parser.add_argument('--budget', type=float, default=IMPORT_BUDGET_MS, help='max import time of each entry point, in ms')
+    parser.add_argument('--runs', type=int, default=3, help='imports of each entry point, the fastest is kept')
+    parser.add_argument('--top', type=int, default=5, help='number of slowest direct imports shown')
+    args = parser.parse_args()
+
+    failures = []
+    print('---import times---')
+    for module in args.modules:
+        total, direct, loaded = min([import_times(module) for _ in range(args.runs)], key=lambda run: run[0])
+        print(f'{module}: {total:.0f}ms (budget {args.budget:.0f}ms)')
+        for name, ms in sorted(direct, key=lambda item: item[1], reverse=True)[:args.top]:
+            print(f'  {name}: {ms:.0f}ms')
+
+        if total > args.budget:
+            failures.append(f'{module} took {total:.0f}ms to import, more than the {args.budget:.0f}ms budget')
+        forbidden = FORBIDDEN_MODULES_API if module == 'api' else FORBIDDEN_MODULES
+        forbidden = [name for name in forbidden if name in loaded]
+        if forbidden:
+            failures.append(f'{module} imports {", ".join(forbidden)} at startup, it must be imported lazily')
+
+    if failures:
+        print('---failed---')
+        for failure in failures:
+            print(failure)
+        sys.exit(1)
+    print('---ok---')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+import hashlib
+import json
+import os
+import sqlite3
+import stat
+import threading
+import time
+from collections import OrderedDict
+
+# small caches used by the API
+
+class TTLCache():
+    # bounded LRU cache whose entries expire after ttl seconds
+    def __init__(self, maxsize=1024, ttl=300.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            value, expires_at = item
+            if time.monotonic() >= expires_at:
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+class ChangeTracker():
+    # tells if the events or xmatches changed, using a long lived connection per process:
+    # PRAGMA data_version only changes when another connection commits, in which case
+    # we read the change counters (maintained by triggers, see migration9)
+    def __init__(self, database_path=None):
+        self.database_path = database_path
+        self._conn = None
+        self._data_version = None
+        self._version = None
+        self._lock = threading.Lock()
+
+    def version(self):
+        # returns None if the changes can't be tracked (e.g. the database isn't migrated yet)
+        with self._lock:
+            try:
+                if self._conn is None:
+                    from db import DATABASE_PATH
+                    self._conn = sqlite3.connect(self.database_path or DATABASE_PATH, check_same_thread=False)
+                data_version = self._conn.execute('PRAGMA data_version').fetchone()[0]
+                if self._version is None or data_version != self._data_version:
+                    self._version = tuple(
+                        row[0] for row in self._conn.execute('SELECT version FROM change_counters ORDER BY name').fetchall()
+                    )
+                    self._data_version = data_version
+                return self._version
+            except sqlite3.Error as e:
+                print(f'Failed to read the change counters: {e}')
+                self._version = None
+                return None
+
+class PageCache():
+    # cache of the data behind the API pages, keyed by route + parameters + user type and
+    # invalidated as soon as the events or xmatches change. Entries live in memory, and
+    # optionally in a directory shared by all the gunicorn workers (e.g. in /dev/shm), as JSON files.
+    # The directory is private to our user: if it is owned by someone else or writable by others,
+    # it isn't used (the entries are then only cached in memory)
+    def __init__(self, directory=None, maxsize=256, ttl=60.0, tracker=None):
+        self.directory = directory
+        self.ttl = ttl
+        self.memory = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.tracker = tracker or ChangeTracker()
+        self._writes = 0
+        if self.directory is not None and not self._is_private_directory(self.directory):
+            print(f'Page cache directory {self.directory} is not private to this user, caching the pages in memory only.')
+            self.directory = None
+
+    @staticmethod
+    def _is_private_directory(directory):
+        try:
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+            # not following symlinks, the directory itself must be ours and closed to the others
+            st = os.lstat(directory)
+        except OSError:
+            return False
+        return stat.S_ISDIR(st.st_mode) and st.st_uid == os.getuid() and not st.st_mode & 0o077
+
+    def _full_key(self, key):
+        version = self.tracker.version()
+        if version is None:
+            return None
+        return (key, version)
+
+    def _path(self, full_key):
+        return os.path.join(self.directory, hashlib.sha256(repr(full_key).encode()).hexdigest() + '.json')
+
+    def get(self, key):
+        # returns (full_key, value): the full key includes the current version of the data, and is
+        # the one to pass to set(), so that a page computed while the data changed is stored under
+        # the version it started from. full_key is None if the changes can't be tracked
+        full_key = self._full_key(key)
+        if full_key is None:
+            return None, None
+        value = self.memory.get(full_key)
+        if value is not None or self.directory is None:
+            return full_key, value
+        try:
+            with open(self._path(full_key)) as f:
+                expires_at, value = json.load(f)
+        except (OSError, ValueError):
+            return full_key, None
+        if time.time() >= expires_at:
+            return full_key, None
+        self.memory.set(full_key, value, ttl=expires_at - time.time())
+        return full_key, value
+
+    def set(self, full_key, value):
+        if full_key is None:
+            return
+        self.memory.set(full_key, value)
+        if self.directory is None:
+            return
+        path = self._path(full_key)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump([time.time() + self.ttl, value], f)
+            os.replace(tmp_path, path)
+        except (OSError, TypeError, ValueError) as e:
+            print(f'Failed to write page cache entry: {e}')
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            return
+        self._writes += 1
+        if self._writes % 100 == 0:
+            self.prune()
+
+    def prune(self):
+        # remove the entries that expired (and those of older versions of the data, which are never read again),
+        # including the ones left by the versions that pickled them
+        now = time.time()
+        try:
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith(('.json', '.pkl')) and entry.stat().st_mtime < now - self.ttl:
+                    os.unlink(entry.path)
+        except OSError:
+            pass
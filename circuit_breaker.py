@@ -0,0 +1,143 @@
+import os
+import threading
+import time
+from collections import deque
+
+# a small circuit breaker shared by the services that talk to remote APIs (Fritz, Kowalski)
+# each endpoint has its own circuit:
+# - closed: requests go through, and we keep track of the recent successes and failures
+# - open: too many recent failures, requests fail fast (CircuitOpenError) until the cooldown is over
+# - half_open: the cooldown is over, a few probe requests are let through. If they succeed
+#   the circuit closes again, if they fail it re-opens
+
+CIRCUIT_BREAKER_ERROR_RATE = float(os.getenv('CIRCUIT_BREAKER_ERROR_RATE', 0.5))  # error rate that opens the circuit
+CIRCUIT_BREAKER_MIN_REQUESTS = int(os.getenv('CIRCUIT_BREAKER_MIN_REQUESTS', 5))  # min number of requests in the window before the error rate is used
+CIRCUIT_BREAKER_CONSECUTIVE_FAILURES = int(os.getenv('CIRCUIT_BREAKER_CONSECUTIVE_FAILURES', 3))  # consecutive failures that open the circuit
+CIRCUIT_BREAKER_WINDOW = float(os.getenv('CIRCUIT_BREAKER_WINDOW', 60.0))  # in seconds
+CIRCUIT_BREAKER_COOLDOWN = float(os.getenv('CIRCUIT_BREAKER_COOLDOWN', 30.0))  # in seconds, before probing again
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+class ServiceUnavailableError(Exception):
+    # the remote service failed to answer (timeout, connection error, 5xx...), retry_after is
+    # how long it asked us to wait (in seconds) if it did
+    def __init__(self, endpoint, message=None, retry_after=None):
+        self.endpoint = endpoint
+        self.retry_after = retry_after
+        super().__init__(message or f"Service unavailable: {endpoint}")
+
+class CircuitOpenError(ServiceUnavailableError):
+    # the circuit of the endpoint is open, we fail fast without calling the remote service
+    def __init__(self, endpoint, retry_after):
+        super().__init__(endpoint, f"Circuit open for {endpoint}, retry in {retry_after:.0f}s", retry_after=retry_after)
+
+class CircuitBreaker():
+    def __init__(
+        self,
+        name,
+        error_rate=CIRCUIT_BREAKER_ERROR_RATE,
+        min_requests=CIRCUIT_BREAKER_MIN_REQUESTS,
+        consecutive_failures=CIRCUIT_BREAKER_CONSECUTIVE_FAILURES,
+        window=CIRCUIT_BREAKER_WINDOW,
+        cooldown=CIRCUIT_BREAKER_COOLDOWN,
+        half_open_max=1,
+    ):
+        self.name = name
+        self.error_rate = error_rate
+        self.min_requests = min_requests
+        self.consecutive_failures = consecutive_failures
+        self.window = window
+        self.cooldown = cooldown
+        self.half_open_max = half_open_max
+        self._circuits = {}
+        self._lock = threading.Lock()
+
+    def _circuit(self, endpoint):
+        if endpoint not in self._circuits:
+            self._circuits[endpoint] = {
+                'state': CLOSED,
+                'results': deque(),  # (timestamp, success)
+                'consecutive_failures': 0,
+                'opened_at': None,
+                'probes': 0,
+            }
+        return self._circuits[endpoint]
+
+    def _prune(self, circuit, now):
+        while circuit['results'] and circuit['results'][0][0] < now - self.window:
+            circuit['results'].popleft()
+
+    def state(self, endpoint):
+        with self._lock:
+            circuit = self._circuit(endpoint)
+            if circuit['state'] == OPEN and time.monotonic() - circuit['opened_at'] >= self.cooldown:
+                return HALF_OPEN
+            return circuit['state']
+
+    def retry_after(self, endpoint):
+        # seconds until the endpoint can be probed again (0 if it is not open)
+        with self._lock:
+            circuit = self._circuit(endpoint)
+            if circuit['state'] != OPEN:
+                return 0.0
+            return max(self.cooldown - (time.monotonic() - circuit['opened_at']), 0.0)
+
+    def before_request(self, endpoint):
+        # raises CircuitOpenError if the request should not be sent
+        with self._lock:
+            circuit = self._circuit(endpoint)
+            now = time.monotonic()
+            if circuit['state'] == OPEN:
+                elapsed = now - circuit['opened_at']
+                if elapsed < self.cooldown:
+                    raise CircuitOpenError(f"{self.name}/{endpoint}", self.cooldown - elapsed)
+                print(f"Circuit {self.name}/{endpoint} is half-open, probing...")
+                circuit['state'] = HALF_OPEN
+                circuit['probes'] = 0
+            if circuit['state'] == HALF_OPEN:
+                if circuit['probes'] >= self.half_open_max:
+                    raise CircuitOpenError(f"{self.name}/{endpoint}", self.cooldown)
+                circuit['probes'] += 1
+
+    def record_success(self, endpoint):
+        with self._lock:
+            circuit = self._circuit(endpoint)
+            now = time.monotonic()
+            if circuit['state'] == HALF_OPEN:
+                print(f"Circuit {self.name}/{endpoint} is closed again.")
+                circuit['results'].clear()
+            circuit['state'] = CLOSED
+            circuit['consecutive_failures'] = 0
+            circuit['probes'] = 0
+            circuit['results'].append((now, True))
+            self._prune(circuit, now)
+
+    def record_failure(self, endpoint):
+        with self._lock:
+            circuit = self._circuit(endpoint)
+            now = time.monotonic()
+            circuit['consecutive_failures'] += 1
+            circuit['results'].append((now, False))
+            self._prune(circuit, now)
+
+            if circuit['state'] == HALF_OPEN:
+                self._open(endpoint, circuit, now)
+                return
+            if circuit['state'] == OPEN:
+                return
+
+            failures = sum(1 for _, success in circuit['results'] if not success)
+            total = len(circuit['results'])
+            if (
+                circuit['consecutive_failures'] >= self.consecutive_failures
+                or (total >= self.min_requests and failures / total >= self.error_rate)
+            ):
+                self._open(endpoint, circuit, now)
+
+    def _open(self, endpoint, circuit, now):
+        print(f"Circuit {self.name}/{endpoint} is open, failing fast for {self.cooldown:.0f}s.")
+        circuit['state'] = OPEN
+        circuit['opened_at'] = now
+        circuit['probes'] = 0
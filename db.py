@@ -1,7 +1,21 @@
+import json
+import math
+import os
 import sqlite3
+import threading
+import time
 from datetime import datetime, timedelta
 from typing import Tuple
 
+import metrics
+
+DATABASE_PATH = os.getenv('DATABASE_PATH', './data/database.db')
+
+DT_XMATCH_NONADMIN = 60.0 # in minutes
+DT_XMATCH_NONADMIN = float(os.getenv('DT_XMATCH_NONADMIN', DT_XMATCH_NONADMIN))
+# convert from minutes to days
+DT_XMATCH_NONADMIN /= 60 * 24
+
 def dict_factory(cursor, row):
     d = {}
     for idx, col in enumerate(cursor.description):
@@ -9,18 +23,19 @@ def dict_factory(cursor, row):
     return d
 
 def is_db_initialized():
+    # the database is ready once all the migrations are applied (see migrate.run_migrations)
+    from migrate import SCHEMA_VERSION
+    conn = sqlite3.connect(DATABASE_PATH)
     try:
-        conn = sqlite3.connect('./data/database.db')
-        c = conn.cursor()
-        c.execute('SELECT * FROM users')
-        conn.close()
-        return True
+        return conn.execute('SELECT 1 FROM schema_version WHERE version = ?', (SCHEMA_VERSION,)).fetchone() is not None
     except sqlite3.OperationalError:
         return False
+    finally:
+        conn.close()
 
 def db_init(username, password):
     # create the database
-    conn = sqlite3.connect('./data/database.db')
+    conn = sqlite3.connect(DATABASE_PATH)
     c = conn.cursor()
 
     # check if the database is already initialized
@@ -32,12 +47,12 @@ def db_init(username, password):
         print("Database already initialized. Skipping table creation.")
 
     # if there is no admin user yet, create one
-    existing_user = c.execute('SELECT * FROM users WHERE username = ? AND type = ?', (username, 'admin')).fetchone()
+    existing_user = c.execute('SELECT * FROM users WHERE username = ? AND type = ?', (username, 'caltech')).fetchone()
     if existing_user is None:
         c.execute('''
             INSERT INTO users (username, password, email, type)
             VALUES (?, ?, ?, ?)
-        ''', (username, password, '', 'admin'))
+        ''', (username, password, '', 'caltech'))
     else:
         print("Admin user already exists.")
 
@@ -50,13 +65,41 @@ def db_init(username, password):
 from contextlib import contextmanager
 @contextmanager
 def get_db_connection():
-    conn = sqlite3.connect('./data/database.db')
+    if _thread_connections is not None:
+        with _reused_connection() as conn:
+            yield conn
+        return
+    conn = sqlite3.connect(DATABASE_PATH)
     conn.row_factory = dict_factory
     try:
         yield conn
     finally:
         conn.close()
 
+# when enabled (see runtime.py, where each service runs in its own thread), get_db_connection
+# hands out one long-lived connection per thread instead of opening and closing one every time
+_thread_connections = None
+
+def reuse_connections() -> None:
+    global _thread_connections
+    _thread_connections = threading.local()
+
+@contextmanager
+def _reused_connection():
+    state = _thread_connections
+    if getattr(state, 'conn', None) is None:
+        state.conn = sqlite3.connect(DATABASE_PATH)
+        state.conn.row_factory = dict_factory
+        state.depth = 0
+    state.depth += 1
+    try:
+        yield state.conn
+    finally:
+        state.depth -= 1
+        # like closing a connection, leaving the outermost block drops what wasn't committed
+        if state.depth == 0 and state.conn.in_transaction:
+            state.conn.rollback()
+
 ALLOWED_EVENT_COLUMNS = [
     'name',
     'ra',
@@ -73,7 +116,165 @@ ALLOWED_EVENT_COLUMNS = [
     'version'
 ]
 
+# spatial index of the events and xmatches positions: each position is stored in an R*Tree
+# (events_rtree, xmatches_rtree, see migration12) as a point on the unit sphere, so a cone search
+# is a lookup of the box around the cone, followed by an exact distance cut on the few rows left
+def unit_vector(ra: float, dec: float) -> Tuple[float, float, float]:
+    ra, dec = math.radians(ra), math.radians(dec)
+    return math.cos(dec) * math.cos(ra), math.cos(dec) * math.sin(ra), math.sin(dec)
+
+def index_positions(table: str, positions: list, c: sqlite3.Cursor) -> None:
+    # positions is a list of (id, ra, dec) of the rows of the events or xmatches table
+    rows = []
+    for row_id, ra, dec in positions:
+        if ra is None or dec is None:
+            continue
+        x, y, z = unit_vector(float(ra), float(dec))
+        rows.append((row_id, x, x, y, y, z, z))
+    c.executemany(f"INSERT OR REPLACE INTO {table}_rtree (id, min_x, max_x, min_y, max_y, min_z, max_z) VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+
+def index_new_events(c: sqlite3.Cursor) -> None:
+    # index the events inserted since the last one indexed
+    c.execute('''
+        SELECT id, ra, dec FROM events
+        WHERE id > (SELECT COALESCE(MAX(id), 0) FROM events_rtree) AND ra IS NOT NULL AND dec IS NOT NULL
+    ''')
+    index_positions('events', [(row['id'], row['ra'], row['dec']) for row in c.fetchall()], c)
+
+# rollups of the statistics dashboard (see migration16), kept up to date by the insert and delivery paths so that
+# reading them never scans the events or xmatches:
+# - stats_daily: what happened each (UTC) day, one counter per metric (STATS_DAILY_METRICS)
+# - stats_events: the number of xmatches of each event, as seen by the admins (all of them, including the archival ones
+#   in the cold tier) and by the other users (the non archival ones within DT_XMATCH_NONADMIN of the event)
+# - stats_totals: the daily counters summed over all days, and the sums of stats_events (STATS_EVENT_TOTALS)
+STATS_DAILY_METRICS = [
+    'events_inserted',
+    'xmatches_inserted',
+    'archival_xmatches_inserted',
+    'prompt_xmatches_inserted',
+    'fritz_posted',
+    'fritz_skipped',
+    'fritz_failed',
+    'fritz_dead',
+]
+STATS_EVENT_COUNTS = ['num_xmatches', 'num_archival_xmatches', 'num_prompt_xmatches']
+STATS_EVENT_TOTALS = {
+    # total: (count of stats_events, True to count the events with at least one xmatch instead of the xmatches)
+    'xmatches': ('num_xmatches', False),
+    'archival_xmatches': ('num_archival_xmatches', False),
+    'prompt_xmatches': ('num_prompt_xmatches', False),
+    'events_with_xmatches': ('num_xmatches', True),
+    'events_with_archival_xmatches': ('num_archival_xmatches', True),
+    'events_with_prompt_xmatches': ('num_prompt_xmatches', True),
+}
+
+def _add_totals(totals: dict, c: sqlite3.Cursor) -> None:
+    c.executemany(
+        "INSERT INTO stats_totals (metric, value) VALUES (?, ?) ON CONFLICT (metric) DO UPDATE SET value = value + excluded.value",
+        [(metric, value) for metric, value in totals.items() if value != 0]
+    )
+
+def bump_stats(values: dict, c: sqlite3.Cursor) -> None:
+    # adds the values (by metric of STATS_DAILY_METRICS) to the counters of the current day, and to the totals
+    c.executemany(
+        "INSERT INTO stats_daily (day, metric, value) VALUES (date('now'), ?, ?) ON CONFLICT (day, metric) DO UPDATE SET value = value + excluded.value",
+        [(metric, value) for metric, value in values.items() if value != 0]
+    )
+    _add_totals(values, c)
+
+def refresh_event_stats(event_ids: list, c: sqlite3.Cursor) -> None:
+    # recounts the xmatches of the events (using the event_id index), and updates the totals with the difference
+    if not event_ids:
+        return
+    event_ids = list(event_ids)
+    placeholders = ','.join('?'*len(event_ids))
+    old = {
+        row['event_id']: row
+        for row in c.execute(f'SELECT * FROM stats_events WHERE event_id IN ({placeholders})', tuple(event_ids)).fetchall()
+    }
+    new = c.execute(f'''
+        SELECT
+            events.id AS event_id,
+            COALESCE(SUM(xmatches.archival = 0), 0) AS num_xmatches,
+            COALESCE(SUM(xmatches.archival = 1), 0) + COALESCE(events.cold_archival_xmatches, 0) AS num_archival_xmatches,
+            COALESCE(SUM(xmatches.archival = 0 AND abs(xmatches.delta_t) <= ?), 0) AS num_prompt_xmatches
+        FROM events
+        LEFT JOIN xmatches ON xmatches.event_id = events.id
+        WHERE events.id IN ({placeholders})
+        GROUP BY events.id
+    ''', (DT_XMATCH_NONADMIN, *event_ids)).fetchall()
+    totals = {metric: 0 for metric in STATS_EVENT_TOTALS}
+    empty = {column: 0 for column in STATS_EVENT_COUNTS}
+    for row in new:
+        previous = old.get(row['event_id'], empty)
+        for metric, (column, per_event) in STATS_EVENT_TOTALS.items():
+            if per_event:
+                totals[metric] += (row[column] > 0) - (previous[column] > 0)
+            else:
+                totals[metric] += row[column] - previous[column]
+    c.executemany(
+        f"INSERT OR REPLACE INTO stats_events (event_id, {', '.join(STATS_EVENT_COUNTS)}, updated_at) VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)",
+        [(row['event_id'], *[row[column] for column in STATS_EVENT_COUNTS]) for row in new]
+    )
+    _add_totals(totals, c)
+
+def add_event_stats(counts: dict, c: sqlite3.Cursor) -> None:
+    # adds the counts (by event id, then by column of STATS_EVENT_COUNTS) of newly inserted xmatches to the rows of
+    # their events and to the totals, without recounting the xmatches. The events without a row yet are recounted
+    if not counts:
+        return
+    event_ids = list(counts)
+    old = {
+        row['event_id']: row
+        for row in c.execute(
+            'SELECT * FROM stats_events WHERE event_id IN ({})'.format(','.join('?'*len(event_ids))),
+            tuple(event_ids)
+        ).fetchall()
+    }
+    refresh_event_stats([event_id for event_id in event_ids if event_id not in old], c)
+    totals = {metric: 0 for metric in STATS_EVENT_TOTALS}
+    for event_id, previous in old.items():
+        for metric, (column, per_event) in STATS_EVENT_TOTALS.items():
+            added = counts[event_id].get(column, 0)
+            if per_event:
+                totals[metric] += (previous[column] + added > 0) - (previous[column] > 0)
+            else:
+                totals[metric] += added
+    c.executemany(
+        f"UPDATE stats_events SET {', '.join(f'{column} = {column} + ?' for column in STATS_EVENT_COUNTS)}, updated_at = CURRENT_TIMESTAMP WHERE event_id = ?",
+        [(*[counts[event_id].get(column, 0) for column in STATS_EVENT_COUNTS], event_id) for event_id in old]
+    )
+    _add_totals(totals, c)
+
+@metrics.timed('db_query_seconds')
+def fetch_stats(c: sqlite3.Cursor, days: int = 30) -> dict:
+    # the totals, and the daily counters of the last days (oldest first, the days without any are left out)
+    totals = {metric: 0 for metric in [*STATS_DAILY_METRICS, *STATS_EVENT_TOTALS]}
+    for row in c.execute('SELECT metric, value FROM stats_totals').fetchall():
+        totals[row['metric']] = row['value']
+    daily = {}
+    for row in c.execute(
+        "SELECT day, metric, value FROM stats_daily WHERE day > date('now', ?) ORDER BY day",
+        (f'-{int(days)} days',)
+    ).fetchall():
+        daily.setdefault(row['day'], {'day': row['day'], **{metric: 0 for metric in STATS_DAILY_METRICS}})[row['metric']] = row['value']
+    return {'totals': totals, 'daily': list(daily.values())}
+
+def fetch_event_stats(event_ids: list, c: sqlite3.Cursor) -> dict:
+    # the rows of stats_events of the events, by event id
+    if not event_ids:
+        return {}
+    return {
+        row['event_id']: row
+        for row in c.execute(
+            'SELECT * FROM stats_events WHERE event_id IN ({})'.format(','.join('?'*len(event_ids))),
+            tuple(event_ids)
+        ).fetchall()
+    }
+
+@metrics.timed('db_insert_seconds')
 def insert_events(events: list, c: sqlite3.Cursor, duplicate="skip") -> None:
+    inserted = 0
     for event in events:
         # the obs_start is a string in the format 'YYYY-MM-DDTHH:MM:SSZ'
         # we need to convert it to a timestamp
@@ -81,34 +282,152 @@ def insert_events(events: list, c: sqlite3.Cursor, duplicate="skip") -> None:
         query = f"INSERT INTO events ({','.join(event.keys())}) VALUES ({','.join(['?']*len(event))})"
         try:
             c.execute(query, tuple(event.values()))
+            inserted += 1
         except sqlite3.IntegrityError as e:
             if duplicate == "skip":
                 continue
             elif duplicate == "update":
                 # update the event with the new values
                 c.execute(f"UPDATE events SET {','.join([f'{k}=?' for k in event.keys()])} WHERE id=?", (*event.values(), event['id']))
+                index_positions('events', [(event['id'], event.get('ra'), event.get('dec'))], c)
             else:
                 raise e
-
-def insert_xmatches(xmatches: list, c: sqlite3.Cursor) -> None:
+    index_new_events(c)
+    bump_stats({'events_inserted': inserted}, c)
+
+@metrics.timed('db_query_seconds')
+def fetch_event_keys(c: sqlite3.Cursor) -> set:
+    # the (name, version) of all the events, read from the unique index only
+    return {(str(row['name']), str(row['version'])) for row in c.execute('SELECT name, version FROM events').fetchall()}
+
+@metrics.timed('db_insert_seconds')
+def bulk_insert_events(events: list, c: sqlite3.Cursor) -> None:
+    # insert all the events at once (events that already exist are skipped), without modifying the input
+    rows = []
+    for event in events:
+        row = []
+        for col in ALLOWED_EVENT_COLUMNS:
+            value = event.get(col)
+            if col == 'obs_start':
+                # the obs_start is a string in the format 'YYYY-MM-DDTHH:MM:SSZ', we store it as a timestamp
+                value = datetime.strptime(value, '%Y-%m-%dT%H:%M:%SZ').strftime('%Y-%m-%d %H:%M:%S')
+            row.append(value)
+        rows.append(tuple(row))
+    c.executemany(
+        f"INSERT OR IGNORE INTO events ({','.join(ALLOWED_EVENT_COLUMNS)}) VALUES ({','.join(['?']*len(ALLOWED_EVENT_COLUMNS))})",
+        rows
+    )
+    bump_stats({'events_inserted': c.rowcount}, c)
+    index_new_events(c)
+
+@metrics.timed('db_insert_seconds')
+def insert_xmatches(xmatches: list, c: sqlite3.Cursor) -> list:
+    # returns the ids of the xmatches that were actually inserted
+    inserted_ids = []
+    positions = []
+    timings = []
+    stats = {'xmatches_inserted': 0, 'archival_xmatches_inserted': 0, 'prompt_xmatches_inserted': 0}
+    event_counts = {}
     for xmatch in xmatches:
         query = f"INSERT INTO xmatches ({','.join(xmatch.keys())}) VALUES ({','.join(['?']*len(xmatch))})"
         try:
             c.execute(query, tuple(xmatch.values()))
+            inserted_ids.append(c.lastrowid)
+            positions.append((c.lastrowid, xmatch.get('ra'), xmatch.get('dec')))
+            timings.append((xmatch.get('event_id'), c.lastrowid))
         except sqlite3.IntegrityError:
             # skip the xmatch if it already exists
             continue
+        counts = event_counts.setdefault(xmatch.get('event_id'), {column: 0 for column in STATS_EVENT_COUNTS})
+        if xmatch.get('archival'):
+            stats['archival_xmatches_inserted'] += 1
+            counts['num_archival_xmatches'] += 1
+        else:
+            stats['xmatches_inserted'] += 1
+            counts['num_xmatches'] += 1
+            if xmatch.get('delta_t') is not None and abs(xmatch['delta_t']) <= DT_XMATCH_NONADMIN:
+                stats['prompt_xmatches_inserted'] += 1
+                counts['num_prompt_xmatches'] += 1
+    index_positions('xmatches', positions, c)
+    record_timings(timings, 'xmatch_inserted', c)
+    bump_stats(stats, c)
+    # the new xmatches are added to the counts of their events, recounting them all would make
+    # inserting the xmatches of an event one at a time quadratic
+    add_event_stats(event_counts, c)
+    return inserted_ids
 
 def update_event_status(event_id: int, status: str, c: sqlite3.Cursor) -> None:
     # when we update the query_status, we also want to update the updated_at timestamp, and the last_queried timestamp
     c.execute(f"UPDATE events SET query_status=?, updated_at=CURRENT_TIMESTAMP, last_queried=CURRENT_TIMESTAMP WHERE id=?", (status, event_id))
 
-def remove_xmatches_by_event_id(event_id: int, c: sqlite3.Cursor, keep_archival = False) -> None:
+def remove_xmatches_by_event_id(event_id: int, c: sqlite3.Cursor, keep_archival = False) -> list:
+    # returns the paths of the event's cold tier partitions, to delete once committed (see tiering.drop_cold)
+    cold_paths = []
     if keep_archival:
         c.execute(f"DELETE FROM xmatches WHERE event_id=? AND archival=0", (event_id,))
     else:
         c.execute(f"DELETE FROM xmatches WHERE event_id=?", (event_id,))
-
+        from tiering import drop_cold
+        cold_paths = drop_cold([event_id], c)
+    refresh_event_stats([event_id], c)
+    return cold_paths
+
+# statuses of the events reset by a reprocess job: 'reprocess' reruns both the archival and
+# non archival cone searches, 'reprocess_archival' only the archival ones
+REPROCESS_STATUSES = ['reprocess', 'reprocess_archival']
+
+REPROCESS_JOB_COLUMNS = ['obs_start_min', 'obs_start_max', 'event_names', 'archival_only', 'created_by']
+
+def create_reprocess_job(job: dict, c: sqlite3.Cursor) -> int:
+    # job has the scope of the reprocessing (see REPROCESS_JOB_COLUMNS), returns the id of the new job
+    columns = [col for col in REPROCESS_JOB_COLUMNS if job.get(col) is not None]
+    c.execute(
+        f"INSERT INTO reprocess_jobs ({','.join(columns)}) VALUES ({','.join(['?']*len(columns))})",
+        tuple(json.dumps(job[col]) if col == 'event_names' else job[col] for col in columns)
+    )
+    return c.lastrowid
+
+@metrics.timed('db_query_seconds')
+def fetch_reprocess_job(job_id: int, c: sqlite3.Cursor) -> dict:
+    # the job, with the number of its events that are still waiting to be reprocessed
+    job = c.execute('SELECT * FROM reprocess_jobs WHERE id = ?', (job_id,)).fetchone()
+    if job is None:
+        return None
+    job['event_names'] = json.loads(job['event_names']) if job['event_names'] else None
+    job['events_pending'] = c.execute(
+        'SELECT COUNT(*) AS count FROM events WHERE reprocess_job_id = ? AND query_status IN (?, ?)',
+        (job_id, *REPROCESS_STATUSES)
+    ).fetchone()['count']
+    return job
+
+@metrics.timed('db_query_seconds')
+def fetch_reprocess_jobs(c: sqlite3.Cursor, limit: int = 20) -> list:
+    job_ids = [row['id'] for row in c.execute('SELECT id FROM reprocess_jobs ORDER BY id DESC LIMIT ?', (limit,)).fetchall()]
+    return [fetch_reprocess_job(job_id, c) for job_id in job_ids]
+
+@metrics.timed('db_query_seconds')
+def fetch_next_reprocess_job(c: sqlite3.Cursor) -> dict:
+    # the job to run: one that was interrupted while running, or else the oldest pending one
+    return c.execute('''
+        SELECT * FROM reprocess_jobs WHERE state IN ('running', 'pending')
+        ORDER BY state = 'running' DESC, id LIMIT 1
+    ''').fetchone()
+
+def update_reprocess_job(job_id: int, c: sqlite3.Cursor, **values) -> None:
+    c.execute(
+        f"UPDATE reprocess_jobs SET {','.join([f'{k}=?' for k in values.keys()])}, updated_at=CURRENT_TIMESTAMP WHERE id=?",
+        (*values.values(), job_id)
+    )
+
+def cancel_reprocess_job(job_id: int, c: sqlite3.Cursor) -> bool:
+    # returns True if the job was cancelled (it must not be finished yet)
+    c.execute(
+        "UPDATE reprocess_jobs SET state='cancelled', finished_at=CURRENT_TIMESTAMP, updated_at=CURRENT_TIMESTAMP WHERE id=? AND state IN ('pending', 'running')",
+        (job_id,)
+    )
+    return c.rowcount > 0
+
+@metrics.timed('db_query_seconds')
 def fetch_events(event_names: list, c: sqlite3.Cursor, **kwargs) -> Tuple[list, int]:
     query = 'SELECT * FROM events'
     count_query = 'SELECT COUNT(*) FROM events'
@@ -142,8 +461,8 @@ def fetch_events(event_names: list, c: sqlite3.Cursor, **kwargs) -> Tuple[list,
         # conditions.append(' query_status = ?')
         # conditions.append(' obs_start > ?')
         # conditions.append(' last_queried < ?')
-        conditions.append(' (query_status = ? OR (query_status = ? AND obs_start >= ? AND last_queried < ?)) ')
-        parameters.append('reprocess')  # for the reprocess case
+        conditions.append(' (query_status IN (?, ?) OR (query_status = ? AND obs_start >= ? AND last_queried < ?)) ')
+        parameters += REPROCESS_STATUSES  # for the reprocess case
         parameters.append('done')
         parameters.append(datetime.utcnow() - timedelta(days=31))
         parameters.append(datetime.utcnow() - timedelta(minutes=10))
@@ -162,7 +481,11 @@ def fetch_events(event_names: list, c: sqlite3.Cursor, **kwargs) -> Tuple[list,
             tmp_condition += ' AND archival=0 '  # only consider non-archival xmatches using the ar
 
         tmp_condition += f' GROUP BY event_id'
-        conditions.append(f' id IN ({tmp_condition}) ')
+        if kwargs.get('matchesOnlyIgnoreArchival', False) != True and not (isinstance(kwargs.get('matchesMaxDeltaT'), int | float) and kwargs.get('matchesMaxDeltaT') > 0):
+            # the archival xmatches in the cold tier count too (see tiering.py)
+            conditions.append(f' (id IN ({tmp_condition}) OR cold_archival_xmatches > 0) ')
+        else:
+            conditions.append(f' id IN ({tmp_condition}) ')
     
     if len(conditions) > 0:
         query += ' WHERE' + ' AND'.join(conditions)
@@ -179,6 +502,7 @@ def fetch_events(event_names: list, c: sqlite3.Cursor, **kwargs) -> Tuple[list,
 
     return events, count
 
+@metrics.timed('db_query_seconds')
 def fetch_event(event_name: str, c: sqlite3.Cursor, **kwargs) -> list:
     query = 'SELECT * FROM events'
     conditions = [' name = ?']
@@ -192,14 +516,36 @@ def fetch_event(event_name: str, c: sqlite3.Cursor, **kwargs) -> list:
     c.execute(query, tuple(parameters))
     return c.fetchone()
 
+@metrics.timed('db_query_seconds')
+def fetch_event_version(event_name: str, c: sqlite3.Cursor, **kwargs) -> dict:
+    # what the API needs to tell if an event (and its xmatches) changed, without reading the xmatches:
+    # the event's id and updated_at, and the version and updated_at of its xmatches (see migration10)
+    query = '''
+        SELECT events.id, events.updated_at,
+            COALESCE(event_xmatches_versions.version, 0) AS xmatches_version,
+            event_xmatches_versions.updated_at AS xmatches_updated_at
+        FROM events
+        LEFT JOIN event_xmatches_versions ON event_xmatches_versions.event_id = events.id
+    '''
+    conditions = [' events.name = ?']
+    parameters = [event_name]
+    if kwargs.get('version') is not None:
+        conditions.append(' events.version = ?')
+        parameters.append(kwargs.get('version'))
+
+    query += ' WHERE' + ' AND'.join(conditions)
+
+    c.execute(query, tuple(parameters))
+    return c.fetchone()
+
+@metrics.timed('db_query_seconds')
 def fetch_event_by_id(event_id: int, c: sqlite3.Cursor) -> list:
     query = 'SELECT * FROM events WHERE id = ?'
     c.execute(query, (event_id,))
     return c.fetchone()
 
+@metrics.timed('db_query_seconds')
 def fetch_xmatches(event_ids: list, c: sqlite3.Cursor, **kwargs) -> list:
-    query = 'SELECT * FROM xmatches'
-    count_query = 'SELECT COUNT(*) FROM xmatches'
     conditions = []
     parameters = []
 
@@ -215,10 +561,16 @@ def fetch_xmatches(event_ids: list, c: sqlite3.Cursor, **kwargs) -> list:
     else:
         event_ids = []
 
+    table = 'xmatches'
     if len(event_ids) > 0:
         conditions.append('event_id IN ({})'.format(','.join('?'*len(event_ids))))
         parameters += event_ids
-    
+        if kwargs.get('archival') is not False and load_cold_xmatches(event_ids, c):
+            # some of the archival xmatches are in the cold tier, we query them along with the ones in the database
+            table = '(SELECT * FROM main.xmatches UNION ALL SELECT * FROM temp.cold_xmatches) AS xmatches'
+    query = f'SELECT * FROM {table}'
+    count_query = f'SELECT COUNT(*) FROM {table}'
+
     if isinstance(kwargs.get('maxDeltaT'), int | float) and kwargs.get('maxDeltaT') > 0:
         conditions.append('delta_t <= ?')
         parameters.append(kwargs.get('maxDeltaT'))
@@ -288,9 +640,291 @@ def fetch_xmatches(event_ids: list, c: sqlite3.Cursor, **kwargs) -> list:
     xmatches = c.execute(query, tuple(parameters)).fetchall()
     return xmatches, count
 
+def load_cold_xmatches(event_ids: list, c: sqlite3.Cursor) -> bool:
+    # loads the xmatches in the cold tier of the events (see tiering.py) in the temp.cold_xmatches table
+    # of the connection, returns False if none of the events are in the cold tier
+    events = c.execute(
+        "SELECT id, obs_start FROM events WHERE id IN ({}) AND tier = 'cold'".format(','.join('?'*len(event_ids))),
+        tuple(event_ids)
+    ).fetchall()
+    if not events:
+        return False
+    from tiering import read_cold_xmatches
+    rows = read_cold_xmatches(events)
+    # an xmatch can be in a partition and still in the database, if the transaction of tiering.tier_event that moved it
+    # failed after the partition was written: the one in the database is used until a later pass moves it again.
+    # They are matched on (event_id, candid), the ids of the xmatches moved to a partition can be reused
+    hot_keys = {
+        (row['event_id'], row['candid']) for row in c.execute(
+            'SELECT event_id, candid FROM main.xmatches WHERE event_id IN ({})'.format(','.join('?'*len(events))),
+            tuple(event['id'] for event in events)
+        ).fetchall()
+    }
+    rows = [row for row in rows if (row['event_id'], row['candid']) not in hot_keys]
+    # the table is created from the current xmatches columns, the files written before a column was added don't have it
+    in_transaction = c.connection.in_transaction
+    c.execute('DROP TABLE IF EXISTS temp.cold_xmatches')
+    c.execute('CREATE TEMP TABLE cold_xmatches AS SELECT * FROM main.xmatches WHERE 0')
+    if rows:
+        columns = [row['name'] for row in c.execute('PRAGMA table_info(xmatches)').fetchall() if row['name'] in rows[0]]
+        c.executemany(
+            'INSERT INTO temp.cold_xmatches ({}) VALUES ({})'.format(','.join(columns), ','.join('?'*len(columns))),
+            [tuple(row[column] for column in columns) for row in rows]
+        )
+    if not in_transaction:
+        # the inserts started a transaction, which would keep the database locked for the writers until the connection is closed
+        c.connection.commit()
+    return True
+
+@metrics.timed('db_query_seconds')
+def fetch_xmatches_since(event_ids: list, event_names: list, c: sqlite3.Cursor, since_id: int = None, since_seq: int = None, limit: int = 1000) -> list:
+    # the xmatches of several events (by id, or by name for all their versions) that are new or updated since a cursor:
+    # - since_id only: xmatches with an id > since_id, in id order (i.e. the new ones)
+    # - since_seq: xmatches with a change_seq > since_seq, in that order (i.e. the new and updated ones, see migration17)
+    # the last row of a page gives the cursor of the next one. Deleted xmatches are not reported
+    query = '''
+        SELECT xmatches.*, events.name AS event_name, events.version AS event_version
+        FROM xmatches
+        JOIN events ON events.id = xmatches.event_id
+    '''
+    event_conditions = []
+    parameters = []
+    if event_ids:
+        event_conditions.append('id IN ({})'.format(','.join('?'*len(event_ids))))
+        parameters += [int(event_id) for event_id in event_ids]
+    if event_names:
+        event_conditions.append('name IN ({})'.format(','.join('?'*len(event_names))))
+        parameters += [str(event_name) for event_name in event_names]
+    if not event_conditions:
+        return []
+    conditions = [' xmatches.event_id IN (SELECT id FROM events WHERE {})'.format(' OR '.join(event_conditions))]
+
+    if since_seq is not None:
+        conditions.append(' xmatches.change_seq > ?')
+        parameters.append(int(since_seq))
+        order_by = 'xmatches.change_seq'
+    else:
+        if since_id is not None:
+            conditions.append(' xmatches.id > ?')
+            parameters.append(int(since_id))
+        order_by = 'xmatches.id'
+
+    query += ' WHERE' + ' AND'.join(conditions) + f' ORDER BY {order_by} LIMIT ?'
+    parameters.append(int(limit))
+
+    c.execute(query, tuple(parameters))
+    return c.fetchall()
+
+def _cone_search(table: str, ra: float, dec: float, radius: float, c: sqlite3.Cursor, conditions: list, parameters: list, limit: int) -> list:
+    # rows of the events or xmatches table within radius (in arcmin) of ra, dec (in degrees), closest first,
+    # with their distance to the center (distance_center_arcmin)
+    import numpy as np
+    from ep_xmatch import great_circle_distance
+
+    # coarse lookup: the box around the cone on the unit sphere, whose half size is the chord of the radius
+    x, y, z = unit_vector(ra, dec)
+    chord = 2 * math.sin(math.radians(min(radius / 60, 180)) / 2)
+    query = f'''
+        SELECT {table}.* FROM {table}_rtree
+        JOIN {table} ON {table}.id = {table}_rtree.id
+        WHERE {table}_rtree.min_x <= ? AND {table}_rtree.max_x >= ?
+        AND {table}_rtree.min_y <= ? AND {table}_rtree.max_y >= ?
+        AND {table}_rtree.min_z <= ? AND {table}_rtree.max_z >= ?
+    '''
+    query += ''.join(f' AND {condition}' for condition in conditions)
+    c.execute(query, (x + chord, x - chord, y + chord, y - chord, z + chord, z - chord, *parameters))
+    rows = c.fetchall()
+    if not rows:
+        return []
+
+    # exact cut on the candidates
+    distances = great_circle_distance(
+        ra, dec,
+        np.array([row['ra'] for row in rows], dtype=float),
+        np.array([row['dec'] for row in rows], dtype=float),
+    ) * 60
+    matches = []
+    for i in np.argsort(distances):
+        if distances[i] > radius or len(matches) >= limit:
+            break
+        rows[i]['distance_center_arcmin'] = float(distances[i])
+        matches.append(rows[i])
+    return matches
+
+@metrics.timed('db_query_seconds')
+def cone_search_xmatches(ra: float, dec: float, radius: float, c: sqlite3.Cursor, archival: bool = None, maxDeltaT: float = None, limit: int = 1000) -> list:
+    # xmatches within radius (in arcmin) of ra, dec (in degrees), closest first
+    conditions = []
+    parameters = []
+    if archival is not None:
+        conditions.append('xmatches.archival = ?')
+        parameters.append(1 if archival else 0)
+    if maxDeltaT is not None:
+        conditions.append('abs(xmatches.delta_t) <= ?')
+        parameters.append(maxDeltaT)
+    return _cone_search('xmatches', ra, dec, radius, c, conditions, parameters, limit)
+
+@metrics.timed('db_query_seconds')
+def cone_search_events(ra: float, dec: float, radius: float, c: sqlite3.Cursor, limit: int = 1000) -> list:
+    # events within radius (in arcmin) of ra, dec (in degrees), closest first
+    return _cone_search('events', ra, dec, radius, c, [], [], limit)
+
 def set_xmatch_as_processed(xmatch_id: int, c: sqlite3.Cursor) -> None:
     # set the xmatch as processed
-    c.execute(f"UPDATE xmatches SET to_skyportal=1 WHERE id=?", (xmatch_id,))
+    c.execute(f"UPDATE xmatches SET to_skyportal=1, updated_at=CURRENT_TIMESTAMP WHERE id=?", (xmatch_id,))
+
+def enqueue_fritz_outbox(xmatch_ids: list, c: sqlite3.Cursor) -> None:
+    # add the xmatches to the Fritz delivery queue, xmatches that are already queued are left untouched
+    c.executemany("INSERT OR IGNORE INTO fritz_outbox (xmatch_id) VALUES (?)", [(xmatch_id,) for xmatch_id in xmatch_ids])
+
+FRITZ_PRIORITY_TERMS = {
+    # lower is more urgent, each term is multiplied by its weight and summed up
+    'delta_t': 'abs(COALESCE(xmatches.delta_t, 0))',
+    'distance_ratio': 'COALESCE(xmatches.distance_ratio, 0)',
+    'drb': '(1 - COALESCE(xmatches.drb, 0))',
+    'age': 'COALESCE(xmatches.age, 0)',
+    'event_age': "(julianday('now') - julianday(events.obs_start))",
+}
+
+@metrics.timed('db_query_seconds')
+def claim_fritz_outbox(c: sqlite3.Cursor, limit: int = 10, lease_seconds: int = 300, priority_weights: dict = None) -> list:
+    # grab the pending deliveries that are due (using the state + next_attempt_at index), with their xmatch
+    # if priority weights are given, the most urgent deliveries (see FRITZ_PRIORITY_TERMS) are claimed first
+    order_by = 'fritz_outbox.next_attempt_at'
+    parameters = []
+    if priority_weights:
+        terms = []
+        for term, weight in priority_weights.items():
+            if term not in FRITZ_PRIORITY_TERMS:
+                raise ValueError(f"Invalid priority term: {term}, must be one of {list(FRITZ_PRIORITY_TERMS.keys())}")
+            terms.append(f'? * {FRITZ_PRIORITY_TERMS[term]}')
+            parameters.append(float(weight))
+        order_by = f"({' + '.join(terms)}), {order_by}"
+
+    entries = c.execute(f'''
+        SELECT fritz_outbox.id AS outbox_id, fritz_outbox.attempts AS outbox_attempts, xmatches.*
+        FROM fritz_outbox
+        INNER JOIN xmatches ON xmatches.id = fritz_outbox.xmatch_id
+        LEFT JOIN events ON events.id = xmatches.event_id
+        WHERE fritz_outbox.state = 'pending' AND fritz_outbox.next_attempt_at <= CURRENT_TIMESTAMP
+        ORDER BY {order_by}
+        LIMIT ?
+    ''', (*parameters, limit)).fetchall()
+    if len(entries) == 0:
+        return entries
+
+    # we lease them: if the poster dies while processing, they become due again once the lease expires
+    c.execute(
+        f"""
+        UPDATE fritz_outbox SET attempts = attempts + 1, next_attempt_at = datetime('now', ?), updated_at = CURRENT_TIMESTAMP
+        WHERE id IN ({','.join('?'*len(entries))})
+        """,
+        (f'+{int(lease_seconds)} seconds', *[entry['outbox_id'] for entry in entries])
+    )
+    for entry in entries:
+        entry['outbox_attempts'] += 1
+    return entries
+
+def complete_fritz_outbox(outbox_id: int, c: sqlite3.Cursor, skipped: bool = False) -> None:
+    c.execute(
+        "UPDATE fritz_outbox SET state = ?, last_error = NULL, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+        ('skipped' if skipped else 'done', outbox_id)
+    )
+    bump_stats({'fritz_skipped' if skipped else 'fritz_posted': 1}, c)
+
+def fail_fritz_outbox(outbox_id: int, error: str, c: sqlite3.Cursor, max_attempts: int = 8, backoff_seconds: float = 60.0, max_backoff_seconds: float = 6 * 60 * 60) -> bool:
+    # schedule the next attempt with an exponential backoff, or dead-letter the delivery
+    # once it used all of its attempts. Returns True if the delivery was dead-lettered.
+    attempts = c.execute("SELECT attempts FROM fritz_outbox WHERE id = ?", (outbox_id,)).fetchone()
+    if attempts is None:
+        return False
+    attempts = attempts['attempts']
+    if attempts >= max_attempts:
+        c.execute(
+            "UPDATE fritz_outbox SET state = 'dead', last_error = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+            (error, outbox_id)
+        )
+        bump_stats({'fritz_failed': 1, 'fritz_dead': 1}, c)
+        return True
+    delay = min(backoff_seconds * 2 ** max(attempts - 1, 0), max_backoff_seconds)
+    c.execute(
+        "UPDATE fritz_outbox SET next_attempt_at = datetime('now', ?), last_error = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+        (f'+{int(delay)} seconds', error, outbox_id)
+    )
+    bump_stats({'fritz_failed': 1}, c)
+    return False
+
+def release_fritz_outbox(outbox_ids: list, c: sqlite3.Cursor, delay_seconds: float = 0) -> None:
+    # put claimed deliveries back in the queue without counting the attempt (e.g. Fritz is down)
+    if len(outbox_ids) == 0:
+        return
+    c.execute(
+        f"""
+        UPDATE fritz_outbox SET attempts = MAX(attempts - 1, 0), next_attempt_at = datetime('now', ?), updated_at = CURRENT_TIMESTAMP
+        WHERE id IN ({','.join('?'*len(outbox_ids))}) AND state = 'pending'
+        """,
+        (f'+{int(delay_seconds)} seconds', *outbox_ids)
+    )
+
+# stages of the pipeline timings ledger (see migration14), in order: when ep_listener first saw the event,
+# when ep_xmatch first queried Kowalski for it, and for each xmatch when it was inserted, posted to Fritz as a candidate,
+# and when its annotations were written. Only the first time a stage is reached is kept
+PIPELINE_STAGES = ['ep_seen', 'queried', 'xmatch_inserted', 'candidate_posted', 'annotation_written']
+
+def record_timings(timings: list, stage: str, c: sqlite3.Cursor, ts: float = None) -> None:
+    # timings is a list of (event_id, xmatch_id), with xmatch_id = 0 for the event level stages
+    ts = time.time() if ts is None else ts
+    c.executemany(
+        "INSERT OR IGNORE INTO pipeline_timings (event_id, xmatch_id, stage, ts) VALUES (?, ?, ?, ?)",
+        [(event_id, xmatch_id, stage, ts) for event_id, xmatch_id in timings]
+    )
+
+def record_events_seen(events: list, c: sqlite3.Cursor, ts: float = None) -> None:
+    # the events are identified by their name and version, as received from the EP API
+    ts = time.time() if ts is None else ts
+    c.executemany(
+        "INSERT OR IGNORE INTO pipeline_timings (event_id, xmatch_id, stage, ts) SELECT id, 0, 'ep_seen', ? FROM events WHERE name = ? AND version = ?",
+        [(ts, event['name'], event['version']) for event in events]
+    )
+
+@metrics.timed('db_query_seconds')
+def fetch_pipeline_delays(c: sqlite3.Cursor, since: float, archival: bool = None) -> dict:
+    # for each stage, the sorted delays (in seconds) since the event was first seen, of the timings recorded since the given unix time
+    # the stages are listed so that the (stage, ts) index is used for the window. The xmatch level stages only count the
+    # xmatches found on the first pass over their event: the ones found weeks later by a reprocess job (its events have a
+    # reprocess_job_id) or by backfill.py (which doesn't record their insertion) would skew the latencies
+    conditions = [
+        f"timings.stage IN ({','.join('?'*len(PIPELINE_STAGES[1:]))})",
+        'timings.ts >= ?',
+        '''(timings.xmatch_id = 0 OR (
+            events.reprocess_job_id IS NULL
+            AND EXISTS (
+                SELECT 1 FROM pipeline_timings AS inserted
+                WHERE inserted.event_id = timings.event_id AND inserted.xmatch_id = timings.xmatch_id AND inserted.stage = 'xmatch_inserted'
+            )
+        ))''',
+    ]
+    parameters = [*PIPELINE_STAGES[1:], since]
+    join = ''
+    if archival is not None:
+        # the event level stages are kept, the xmatch level ones must be of the right kind
+        join = 'LEFT JOIN xmatches ON xmatches.id = timings.xmatch_id'
+        conditions.append('(timings.xmatch_id = 0 OR xmatches.archival = ?)')
+        parameters.append(1 if archival else 0)
+    rows = c.execute(f'''
+        SELECT timings.stage, timings.ts - seen.ts AS delay
+        FROM pipeline_timings AS timings
+        INNER JOIN pipeline_timings AS seen ON seen.event_id = timings.event_id AND seen.xmatch_id = 0 AND seen.stage = 'ep_seen'
+        INNER JOIN events ON events.id = timings.event_id
+        {join}
+        WHERE {' AND '.join(conditions)}
+    ''', tuple(parameters)).fetchall()
+    delays = {stage: [] for stage in PIPELINE_STAGES[1:]}
+    for row in rows:
+        delays.setdefault(row['stage'], []).append(row['delay'])
+    for stage_delays in delays.values():
+        stage_delays.sort()
+    return delays
 
 
 if __name__ == "__main__":
@@ -305,4 +939,4 @@ if __name__ == "__main__":
         db_init(args.adminusername, args.adminpassword)
         print("---Completed database initialization---")
     else:
-        print("Nothing to do.")
\ No newline at end of file
+        print("Nothing to do.")
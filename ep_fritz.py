@@ -1,10 +1,17 @@
-from db import is_db_initialized, get_db_connection, fetch_events, fetch_xmatches, set_xmatch_as_processed
+from db import (
+    is_db_initialized, get_db_connection, fetch_events, set_xmatch_as_processed,
+    claim_fritz_outbox, complete_fritz_outbox, fail_fritz_outbox, release_fritz_outbox, record_timings, FRITZ_PRIORITY_TERMS
+)
+import metrics
+from profiling import LoopProfiler
+from circuit_breaker import CircuitBreaker, CircuitOpenError, ServiceUnavailableError
+from notify import Listener, EP_FRITZ_CHANNEL
 from datetime import datetime, timezone, timedelta
 import sqlite3
 import time
 import urllib.parse
 import requests
-from astropy.time import Time
+from timeconv import datetime_to_jd, iso_to_mjd, jd_to_isot
 import os
 
 
@@ -14,6 +21,16 @@ FRITZ_FILTER_ID = os.getenv("FRITZ_FILTER_ID")
 FRITZ_IMPORT_GROUP_ID = os.getenv("FRITZ_IMPORT_GROUP_ID")
 MAX_EVENT_AGE = os.getenv("MAX_EVENT_AGE", 31.0)  # in days, default is 31 days
 MAX_CREATED_AFTER = os.getenv("MAX_CREATED_AFTER", 1.0)  # in days, default is 1 day
+MAX_DETECTION_AGE = 62.0  # in days, we only post candidates that are less than 2 months old
+FRITZ_MAX_ATTEMPTS = os.getenv("FRITZ_MAX_ATTEMPTS", 8)  # deliveries are dead-lettered after that many attempts
+FRITZ_RETRY_BACKOFF = os.getenv("FRITZ_RETRY_BACKOFF", 60.0)  # in seconds, doubled after each failed attempt
+FRITZ_BATCH_SIZE = os.getenv("FRITZ_BATCH_SIZE", 10)  # number of deliveries claimed at once
+FRITZ_POST_INTERVAL = os.getenv("FRITZ_POST_INTERVAL", 5.0)  # in seconds, pause after each xmatch posted
+FRITZ_TIMEOUT = os.getenv("FRITZ_TIMEOUT", 30.0)  # in seconds, timeout of each request to Fritz
+FRITZ_MAX_RETRIES = os.getenv("FRITZ_MAX_RETRIES", 5)  # retries of a request on rate limits, timeouts and 5xx
+# weights of the delivery priority score (lower score is posted first), as a comma-separated list of term=weight
+# small |delta_t| and distance_ratio, high drb, young candidates and recent events go first
+FRITZ_PRIORITY_WEIGHTS = os.getenv("FRITZ_PRIORITY_WEIGHTS", "delta_t=1.0,distance_ratio=1.0,drb=1.0,age=0.1,event_age=0.1")
 if FRITZ_HOST is None:
     raise Exception("FRITZ_HOST environment variable is not set.")
 if FRITZ_TOKEN is None or FRITZ_TOKEN == "<your-fritz-token>":
@@ -40,12 +57,46 @@ try:
     MAX_CREATED_AFTER = float(MAX_CREATED_AFTER)
 except ValueError:
     raise Exception("MAX_CREATED_AFTER environment variable is not a valid float.")
+try:
+    FRITZ_MAX_ATTEMPTS = int(FRITZ_MAX_ATTEMPTS)
+except ValueError:
+    raise Exception("FRITZ_MAX_ATTEMPTS environment variable is not a valid integer.")
+try:
+    FRITZ_RETRY_BACKOFF = float(FRITZ_RETRY_BACKOFF)
+except ValueError:
+    raise Exception("FRITZ_RETRY_BACKOFF environment variable is not a valid float.")
+try:
+    FRITZ_BATCH_SIZE = int(FRITZ_BATCH_SIZE)
+except ValueError:
+    raise Exception("FRITZ_BATCH_SIZE environment variable is not a valid integer.")
+try:
+    FRITZ_TIMEOUT = float(FRITZ_TIMEOUT)
+except ValueError:
+    raise Exception("FRITZ_TIMEOUT environment variable is not a valid float.")
+try:
+    FRITZ_MAX_RETRIES = int(FRITZ_MAX_RETRIES)
+except ValueError:
+    raise Exception("FRITZ_MAX_RETRIES environment variable is not a valid integer.")
+try:
+    FRITZ_POST_INTERVAL = float(FRITZ_POST_INTERVAL)
+except ValueError:
+    raise Exception("FRITZ_POST_INTERVAL environment variable is not a valid float.")
+try:
+    FRITZ_PRIORITY_WEIGHTS = {
+        term.split("=")[0].strip(): float(term.split("=")[1])
+        for term in FRITZ_PRIORITY_WEIGHTS.split(",") if term.strip() != ""
+    }
+except (ValueError, IndexError):
+    raise Exception("FRITZ_PRIORITY_WEIGHTS environment variable is not a valid list of term=weight.")
+if any(term not in FRITZ_PRIORITY_TERMS for term in FRITZ_PRIORITY_WEIGHTS):
+    raise Exception(f"FRITZ_PRIORITY_WEIGHTS environment variable must only use terms from {list(FRITZ_PRIORITY_TERMS.keys())}.")
 
 
 class SkyPortal():
     def __init__(self, host=None, token=None):
         self.host = host
         self.token = token
+        self.breaker = CircuitBreaker("fritz")
         # get the ZTF+EP filter id
         self.filter_id, self.group_id = self.get_ztf_ep_filter()
 
@@ -60,23 +111,46 @@ class SkyPortal():
         url = urllib.parse.urljoin(self.host, f"/api/{endpoint}")
         headers = {"Authorization": f"token {self.token}"} if self.token else None
 
-        status = 429
+        # the circuits are tracked per endpoint, e.g. "candidates" or "sources"
+        circuit = endpoint.split("/")[0]
 
-        while status in [429, 503]:
+        # the Retry-After of the last attempt, if it was rate limited
+        retry_after = None
+        for attempt in range(FRITZ_MAX_RETRIES + 1):
+            # fails fast with a CircuitOpenError if Fritz has been failing on that endpoint
+            self.breaker.before_request(circuit)
+            start = time.perf_counter()
             try:
-                response = requests.request(method, url, json=data, params=params, headers=headers)
-            # catch timeouts
-            except requests.exceptions.Timeout:
-                print("Request timed out. Waiting for 30 seconds...")
-                time.sleep(30)
+                response = requests.request(method, url, json=data, params=params, headers=headers, timeout=FRITZ_TIMEOUT)
+            # catch timeouts, connection errors, etc.
+            except requests.exceptions.RequestException as e:
+                metrics.observe('fritz_request_seconds', time.perf_counter() - start, endpoint=circuit, method=method, status=type(e).__name__)
+                self.breaker.record_failure(circuit)
+                retry_after = None
+                print(f"Request to {endpoint} failed ({type(e).__name__}). Waiting for {min(2 ** attempt, 30)} seconds...")
+                time.sleep(min(2 ** attempt, 30))
                 continue
             status = response.status_code
+            metrics.observe('fritz_request_seconds', time.perf_counter() - start, endpoint=circuit, method=method, status=status)
             if status == 429:
-                print("Rate limit exceeded. Waiting for 1 second...")
-                time.sleep(1)
-            elif status == 503:
-                print("Service unavailable. Waiting for 30 seconds...")
-                time.sleep(30)
+                metrics.inc('fritz_rate_limited', endpoint=circuit)
+                # being rate limited means that Fritz is up, we just need to slow down
+                self.breaker.record_success(circuit)
+                retry_after = response.headers.get("Retry-After", "1")
+                retry_after = float(retry_after) if retry_after.replace(".", "", 1).isdigit() else 1.0
+                print(f"Rate limit exceeded. Waiting for {retry_after} second(s)...")
+                time.sleep(retry_after)
+                continue
+            if status in [502, 503, 504]:
+                self.breaker.record_failure(circuit)
+                retry_after = None
+                print(f"Service unavailable ({status}). Waiting for {min(2 ** attempt, 30)} seconds...")
+                time.sleep(min(2 ** attempt, 30))
+                continue
+            self.breaker.record_success(circuit)
+            break
+        else:
+            raise ServiceUnavailableError(circuit, f"Fritz did not answer {method} {endpoint} after {FRITZ_MAX_RETRIES} retries", retry_after=retry_after)
 
         if raw_response:
             return response
@@ -115,7 +189,7 @@ class SkyPortal():
     ):
         
         passed_at_jd = alert.get("jd")
-        passed_at = Time(passed_at_jd, format="jd").isot
+        passed_at = jd_to_isot(passed_at_jd)
         
         payload = {
             "id": alert["object_id"],
@@ -129,7 +203,7 @@ class SkyPortal():
         }
 
         # Send the POST request to SkyPortal
-        status_code, response = sp.api(
+        status_code, response = self.api(
             "POST",
             "candidates",
             data=payload,
@@ -196,7 +270,7 @@ class SkyPortal():
             annotation for annotation in annotations if annotation['origin'] == 'ZTF+EP'
         ]
 
-        ep_mjd = Time(event['obs_start'], format='iso').mjd
+        ep_mjd = iso_to_mjd(event['obs_start'])
 
         payload = {
             "obj_id": alert["object_id"],
@@ -316,6 +390,21 @@ class SkyPortal():
         return False
 
 def process_xmatch(xmatch, c: sqlite3.Cursor):
+    # returns (processed, skipped), and raises an exception with the reason if the xmatch could not be processed
+
+    # Only process xmatches that were created in the last N days (MAX_CREATED_AFTER)
+    # and candidates that are less than MAX_DETECTION_AGE days old
+    created_after = datetime.now(timezone.utc) - timedelta(days=MAX_CREATED_AFTER)
+    created_at = datetime.strptime(xmatch["created_at"], "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc)
+    if created_at < created_after:
+        print(f"Xmatch {xmatch['object_id']} (candid {xmatch['candid']}) was created more than {MAX_CREATED_AFTER} days ago. Skipping.")
+        return True, True
+    detected_after = datetime_to_jd(
+        datetime.now(timezone.utc) - timedelta(days=MAX_DETECTION_AGE)
+    )
+    if xmatch["jd"] < detected_after:
+        print(f"Xmatch {xmatch['object_id']} (candid {xmatch['candid']}) was detected more than {MAX_DETECTION_AGE} days ago. Skipping.")
+        return True, True
 
     # 1. Grab the event for that match
     events, count = fetch_events(
@@ -324,8 +413,7 @@ def process_xmatch(xmatch, c: sqlite3.Cursor):
         c=c,
     )
     if count == 0:
-        print(f"Failed to find event {xmatch['event_id']} for xmatch {xmatch['object_id']} (candid {xmatch['candid']}).")
-        return False, False
+        raise Exception(f"Failed to find event {xmatch['event_id']} for xmatch {xmatch['object_id']} (candid {xmatch['candid']}).")
     event = events[0]
 
     # Check if the event is older than X days
@@ -338,8 +426,8 @@ def process_xmatch(xmatch, c: sqlite3.Cursor):
     # 2. Post the candidate to SkyPortal
     posted, already_posted = sp.post_candidate(xmatch)
     if not posted:
-        print(f"Failed to post candidate {xmatch['object_id']}.")
-        return False, False
+        raise Exception(f"Failed to post candidate {xmatch['object_id']}.")
+    record_timings([(xmatch["event_id"], xmatch["id"])], "candidate_posted", c)
     
     # Check if we have a candidate with the same object_id 
     # but a higher JD that was already posted
@@ -359,18 +447,73 @@ def process_xmatch(xmatch, c: sqlite3.Cursor):
     if not already_posted and newer_xmatches_processed_count == 0:
         imported = sp.import_from_kowalski(xmatch)
         if not imported:
-            print(f"Failed to import object {xmatch['object_id']} from Kowalski.")
-            return False, False
+            raise Exception(f"Failed to import object {xmatch['object_id']} from Kowalski.")
 
     # 4. Post the annotations
     posted = sp.post_annotations(xmatch, event)
     if not posted:
-        print(f"Failed to post/update annotations for {xmatch['object_id']}.")
-        return False, False
+        raise Exception(f"Failed to post/update annotations for {xmatch['object_id']}.")
+    record_timings([(xmatch["event_id"], xmatch["id"])], "annotation_written", c)
     
     print(f"Processed xmatch {xmatch['object_id']} successfully.")
     return True, False
 
+def service(conn: sqlite3.Connection) -> int:
+    # drain the deliveries that are due from the outbox, a small batch at a time and most urgent first,
+    # so that a new high priority xmatch doesn't have to wait for a long backlog to be posted
+    processed_count = 0
+    while True:
+        entries = claim_fritz_outbox(conn, limit=FRITZ_BATCH_SIZE, priority_weights=FRITZ_PRIORITY_WEIGHTS)
+        conn.commit()
+        if len(entries) == 0:
+            break
+
+        print(f"Claimed {len(entries)} xmatches to process.")
+
+        for i, entry in enumerate(entries):
+            try:
+                with metrics.timer('fritz_xmatch_seconds'):
+                    processed, skipped = process_xmatch(entry, conn)
+                if processed:
+                    complete_fritz_outbox(entry["outbox_id"], conn, skipped=skipped)
+                    if not skipped:
+                        set_xmatch_as_processed(entry["id"], conn)
+                        processed_count += 1
+                conn.commit()
+                metrics.inc('fritz_deliveries', outcome='skipped' if skipped else 'posted' if processed else 'pending')
+                if processed and not skipped:
+                    time.sleep(FRITZ_POST_INTERVAL)
+            except CircuitOpenError as e:
+                # Fritz is down: put the rest of the batch back in the queue without counting the attempt,
+                # and stop until the circuit lets us probe Fritz again
+                release_fritz_outbox([entry["outbox_id"] for entry in entries[i:]], conn, delay_seconds=e.retry_after)
+                conn.commit()
+                print(f"{e}, stopping until Fritz is back.")
+                return processed_count
+            except ServiceUnavailableError as e:
+                # Fritz failed to answer (or kept rate limiting us): the rest of the batch goes back in the queue
+                # without counting the attempt, for as long as Fritz asked us to wait, or FRITZ_RETRY_BACKOFF.
+                # We stop there rather than claiming it again right away
+                delay = e.retry_after if e.retry_after is not None else FRITZ_RETRY_BACKOFF
+                release_fritz_outbox([entry["outbox_id"] for entry in entries[i:]], conn, delay_seconds=delay)
+                conn.commit()
+                print(f"Error processing xmatch {entry['object_id']}: {e}, retrying in {delay:.0f}s.")
+                return processed_count
+            except Exception as e:
+                print(f"Error processing xmatch {entry['object_id']} (attempt {entry['outbox_attempts']}): {e}")
+                dead = fail_fritz_outbox(
+                    entry["outbox_id"], str(e), conn,
+                    max_attempts=FRITZ_MAX_ATTEMPTS,
+                    backoff_seconds=FRITZ_RETRY_BACKOFF,
+                )
+                conn.commit()
+                metrics.inc('fritz_deliveries', outcome='dead' if dead else 'failed')
+                if dead:
+                    print(f"Xmatch {entry['object_id']} (candid {entry['candid']}) failed {entry['outbox_attempts']} times, moved to dead-letter.")
+                continue
+
+    return processed_count
+
 if __name__ == "__main__":
     # Check if the database is initialized
     if not is_db_initialized():
@@ -386,47 +529,22 @@ if __name__ == "__main__":
         print(f"Failed to initialize SkyPortal: {e}")
         exit(1)
 
-    while True:
-        with get_db_connection() as conn:
-            # Fetch events and xmatches from the database
-
-            # Only process xmatches that were created in the last N hours (MAX_CREATED_AFTER)
-            created_after = datetime.now(timezone.utc) - timedelta(days=MAX_CREATED_AFTER)
-
-            # Only process candidates that are less than 2 months old
-            detected_after = float(Time(
-                datetime.now(timezone.utc) - timedelta(days=62)
-            ).jd)
-
-            xmatches, count = fetch_xmatches(
-                event_ids=None,
-                c=conn,
-                to_skyportal=False,
-                created_after=created_after,
-                detected_after=detected_after,
-                eventAgeDays=MAX_EVENT_AGE,
-            )
+    # ep_xmatch notifies us when new xmatches are queued, polling remains as a fallback
+    listener = Listener(EP_FRITZ_CHANNEL)
 
-            print(f"Found {count} xmatches to process.")
-
-            # find the number of unique candid and unique objectid, just for logging
-            unique_candid = len(set([xmatch["candid"] for xmatch in xmatches]))
-            unique_objectid = len(set([xmatch["object_id"] for xmatch in xmatches]))
-            print(f"Found {unique_candid} unique candidates and {unique_objectid} unique object ids.")
-
-            for xmatch in xmatches:
-                try:
-                    processed, skipped = process_xmatch(xmatch, conn)
-                    if processed and skipped:
-                        continue
-                    if processed:
-                        set_xmatch_as_processed(xmatch["id"], conn)
-                        conn.commit()
-                    time.sleep(5)
-                except Exception as e:
-                    print(f"Error processing xmatch {xmatch['object_id']}: {e}")
-                    continue
-
-        print("All xmatches processed, sleeping for 1 minute.")
-        time.sleep(60)
+    # profiles the service on SIGUSR1 (see profiling.py)
+    profiler = LoopProfiler('ep_fritz')
 
+    metrics.configure('ep_fritz')
+
+    while True:
+        try:
+            with profiler.iteration(), get_db_connection() as conn, metrics.timer('service_pass_seconds'):
+                processed_count = service(conn)
+        except Exception as e:
+            print(f"Failed to run service: {e}")
+            processed_count = 0
+
+        metrics.flush()
+        print(f"Processed {processed_count} xmatches, sleeping for 1 minute (or until new xmatches are queued).")
+        listener.wait(60)
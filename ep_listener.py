@@ -1,10 +1,21 @@
+import base64
+import hashlib
+import json
 import os
 import time
 import traceback
+from typing import TYPE_CHECKING
 import requests
+from requests.adapters import HTTPAdapter
 
-from penquins import Kowalski
-from db import is_db_initialized, get_db_connection, insert_events, ALLOWED_EVENT_COLUMNS
+import metrics
+from profiling import LoopProfiler
+from db import is_db_initialized, get_db_connection, fetch_event_keys, bulk_insert_events, record_events_seen, ALLOWED_EVENT_COLUMNS
+from notify import notify, EP_XMATCH_CHANNEL
+
+# penquins is only imported to run the service
+if TYPE_CHECKING:
+    from penquins import Kowalski
 
 EP_BASE_URL = "https://ep.bao.ac.cn/ep"
 EP_TOKEN_URL = f"{EP_BASE_URL}/api/get_tokenp"
@@ -13,70 +24,191 @@ EP_EVENTS_URL = f"{EP_BASE_URL}/data_center/api/unverified_candidates"
 EP_EMAIL = os.getenv('EP_EMAIL')
 EP_PASSWORD = os.getenv('EP_PASSWORD')
 
-def get_ep_token():
-    if EP_EMAIL is None or EP_PASSWORD is None:
-        raise ValueError('EP_USERNAME or EP_PASSWORD not set')
-    response = requests.post(
-        url=EP_TOKEN_URL,
-        json={"email": EP_EMAIL, "password": EP_PASSWORD},
-        headers={"Content-Type": "application/json"}
-    )
-    response.raise_for_status()  
-    token = response.json().get("token") 
-    return token
-
-def get_new_events():
-    token = get_ep_token()
-
-    response = requests.get(
-                url=EP_EVENTS_URL,
-                headers={"tdic-token": token},  
-                params={"token": token}
-            )
-    response.raise_for_status()
+EP_TIMEOUT = float(os.getenv('EP_TIMEOUT', 30.0))  # in seconds, timeout of each request to the EP API
+EP_TOKEN_TTL = float(os.getenv('EP_TOKEN_TTL', 60 * 60))  # in seconds, used when the token doesn't say when it expires
+
+# the EP API is polled every EP_POLL_MIN_INTERVAL right after new events are found,
+# and the interval grows by EP_POLL_BACKOFF after each poll without new events, up to EP_POLL_MAX_INTERVAL
+EP_POLL_MIN_INTERVAL = float(os.getenv('EP_POLL_MIN_INTERVAL', 30.0))  # in seconds
+EP_POLL_MAX_INTERVAL = float(os.getenv('EP_POLL_MAX_INTERVAL', 5 * 60.0))  # in seconds
+EP_POLL_BACKOFF = float(os.getenv('EP_POLL_BACKOFF', 2.0))
+
+def get_token_expiry(token: str):
+    # EP tokens are JWTs, if we can read the expiration time from it we use it
     try:
-        events = response.json()
-    except ValueError:
-        events = []
-    return events
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        exp = json.loads(base64.urlsafe_b64decode(payload)).get('exp')
+        return float(exp) if exp is not None else None
+    except Exception:
+        return None
 
-def service(k: Kowalski, last_event_fetch: float) -> float:
-    with get_db_connection() as conn:
-        c = conn.cursor()
-
-        # GET NEW EP EVENTS
-        if (
-            last_event_fetch is None or
-            time.time() - last_event_fetch > 5 * 60
-        ):
-            print('Fetching new events...')
-            try:
-                new_events = get_new_events()
-                last_event_fetch = time.time()
-            except Exception as e:
-                traceback.print_exc()
-                print(f'Failed to get new events: {e}')
-                new_events = []
-            # check that they each have the allowed columns we need
-            for i in range(len(new_events)):
-                missing = [col for col in ALLOWED_EVENT_COLUMNS if col not in new_events[i]]
-                if missing:
-                    print(f'Event does not have all required columns: {missing}')
-                    raise ValueError('Event does not have all required columns: ' + ', '.join(missing))
-                new_events[i] = {k: v for k, v in new_events[i].items() if k in ALLOWED_EVENT_COLUMNS}
-                    
-            if len(new_events) > 0:
-                print(f'Inserting {len(new_events)} events (skips existing ones)')
-                try:
-                    insert_events(new_events, c)
-                    conn.commit()
-                except Exception as e:
-                    traceback.print_exc()
-                    print(f'Failed to insert events: {e}')
-
-    return last_event_fetch
+class EPClient():
+    # EP API client, keeping the token until it expires (or is rejected)
+    # and reusing the connections to the EP API between polls
+    def __init__(self, email=None, password=None, timeout=EP_TIMEOUT):
+        self.email = email
+        self.password = password
+        self.timeout = timeout
+        self.token = None
+        self.token_expires_at = 0.0
+        # what we know about the last candidates payload we processed
+        self.etag = None
+        self.last_modified = None
+        self.content_hash = None
+        self._pending = None
+
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=2))
+
+    def get_ep_token(self, refresh=False) -> str:
+        # renew the token a minute before it expires, to not race with the expiration
+        if not refresh and self.token is not None and time.time() < self.token_expires_at - 60:
+            return self.token
+        if self.email is None or self.password is None:
+            raise ValueError('EP_USERNAME or EP_PASSWORD not set')
+        response = self.session.post(
+            url=EP_TOKEN_URL,
+            json={"email": self.email, "password": self.password},
+            headers={"Content-Type": "application/json"},
+            timeout=self.timeout,
+        )
+        response.raise_for_status()
+        token = response.json().get("token")
+        if token is None:
+            raise ValueError('EP API did not return a token')
+        self.token = token
+        self.token_expires_at = get_token_expiry(token) or time.time() + EP_TOKEN_TTL
+        return token
+
+    def get_new_events(self):
+        # returns the list of candidates, or None if it didn't change since the last processed poll
+        # (so that we skip parsing and validating the same payload over and over)
+        token = self.get_ep_token()
+        response = self._get_events(token)
+        if response.status_code == 401:
+            # the token was revoked or expired early, login again and retry once
+            print('EP token rejected, logging in again...')
+            token = self.get_ep_token(refresh=True)
+            response = self._get_events(token)
+        if response.status_code == 304:
+            return None
+        response.raise_for_status()
+
+        content_hash = hashlib.sha256(response.content).hexdigest()
+        if content_hash == self.content_hash:
+            return None
+        # only remembered once the caller processed the events (see mark_processed),
+        # so that a payload that failed to be ingested is not skipped on the next poll
+        self._pending = (response.headers.get('ETag'), response.headers.get('Last-Modified'), content_hash)
+
+        try:
+            events = response.json()
+        except ValueError:
+            events = []
+        return events
+
+    def mark_processed(self) -> None:
+        if self._pending is not None:
+            self.etag, self.last_modified, self.content_hash = self._pending
+            self._pending = None
+
+    def _get_events(self, token: str) -> requests.Response:
+        headers = {"tdic-token": token}
+        # conditional request, if the EP API supports it we get a 304 when nothing changed
+        if self.etag is not None:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified is not None:
+            headers["If-Modified-Since"] = self.last_modified
+        return self.session.get(
+            url=EP_EVENTS_URL,
+            headers=headers,
+            params={"token": token},
+            timeout=self.timeout,
+        )
+
+class AdaptivePoller():
+    # polls fast right after new events are found, and backs off during quiet periods
+    def __init__(self, min_interval=EP_POLL_MIN_INTERVAL, max_interval=EP_POLL_MAX_INTERVAL, backoff=EP_POLL_BACKOFF):
+        self.min_interval = min_interval
+        self.max_interval = max(max_interval, min_interval)
+        self.backoff = backoff
+        self.interval = min_interval
+        self.next_poll_at = 0.0  # poll right away on startup
+
+    def is_due(self) -> bool:
+        return time.time() >= self.next_poll_at
+
+    def time_until_due(self) -> float:
+        return max(self.next_poll_at - time.time(), 0.0)
+
+    def update(self, found_new_events: bool) -> None:
+        if found_new_events:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * self.backoff, self.max_interval)
+        self.next_poll_at = time.time() + self.interval
+
+def service(k: 'Kowalski', ep: EPClient, poller: AdaptivePoller, known_event_keys: set) -> None:
+    # GET NEW EP EVENTS
+    if not poller.is_due():
+        return
+
+    print('Fetching new events...')
+    try:
+        with metrics.timer('ep_poll_seconds'):
+            new_events = ep.get_new_events()
+        seen_at = time.time()
+    except Exception as e:
+        traceback.print_exc()
+        print(f'Failed to get new events: {e}')
+        poller.update(found_new_events=False)
+        return
+
+    if new_events is None:
+        poller.update(found_new_events=False)
+        print(f'No changes in the EP candidates, next poll in {poller.interval:.0f}s.')
+        return
+
+    # check that they each have the allowed columns we need
+    for event in new_events:
+        missing = [col for col in ALLOWED_EVENT_COLUMNS if col not in event]
+        if missing:
+            print(f'Event does not have all required columns: {missing}')
+            poller.update(found_new_events=False)
+            raise ValueError('Event does not have all required columns: ' + ', '.join(missing))
+
+    # only keep the events we don't know about yet (by name and version, compared as text like in the database)
+    unknown_events = {}
+    for event in new_events:
+        key = (str(event['name']), str(event['version']))
+        if key not in known_event_keys and key not in unknown_events:
+            unknown_events[key] = event
+
+    if len(unknown_events) > 0:
+        print(f'Inserting {len(unknown_events)} new events (out of {len(new_events)})')
+        try:
+            with get_db_connection() as conn:
+                c = conn.cursor()
+                bulk_insert_events(list(unknown_events.values()), c)
+                record_events_seen(list(unknown_events.values()), c, ts=seen_at)
+                conn.commit()
+            known_event_keys.update(unknown_events.keys())
+            metrics.inc('events_inserted', len(unknown_events))
+            # wake up ep_xmatch right away, instead of waiting for its next poll
+            notify(EP_XMATCH_CHANNEL)
+        except Exception as e:
+            traceback.print_exc()
+            print(f'Failed to insert events: {e}')
+            poller.update(found_new_events=False)
+            return
+
+    ep.mark_processed()
+    poller.update(found_new_events=len(unknown_events) > 0)
 
 if __name__ == "__main__":
+    from penquins import Kowalski
+
     protocol = 'https'
     host = 'kowalski.caltech.edu'
     port = 443
@@ -95,15 +227,29 @@ if __name__ == "__main__":
         print('Waiting for database to be initialized...')
         time.sleep(15)
 
-    last_event_fetch = None
+    ep = EPClient(email=EP_EMAIL, password=EP_PASSWORD)
+
+    # the (name, version) of the events already in the database, kept up to date as we insert new ones
+    with get_db_connection() as conn:
+        known_event_keys = fetch_event_keys(conn.cursor())
+    print(f'Loaded {len(known_event_keys)} known events.')
+
+    poller = AdaptivePoller()
+
+    # profiles the service on SIGUSR1 (see profiling.py)
+    profiler = LoopProfiler('ep_listener')
+
+    metrics.configure('ep_listener')
 
     print('Starting service...')
     while True:
         try:
-            last_event_fetch = service(k, last_event_fetch)
+            with profiler.iteration():
+                service(k, ep, poller, known_event_keys)
         except Exception as e:
             traceback.print_exc()
             print(f'Failed to run service: {e}')
-        time.sleep(5)
+        metrics.flush()
+        time.sleep(max(poller.time_until_due(), 1))
         print('Service loop')
 
@@ -1,11 +1,21 @@
+import operator
 import os
 import time
-from astropy.time import Time
 import traceback
-import numpy as np
+from typing import TYPE_CHECKING
 
-from penquins import Kowalski
-from db import is_db_initialized, get_db_connection, fetch_events, update_event_status, insert_xmatches
+import requests
+
+import metrics
+from profiling import LoopProfiler
+from db import is_db_initialized, get_db_connection, fetch_events, update_event_status, insert_xmatches, enqueue_fritz_outbox, record_timings, REPROCESS_STATUSES
+from timeconv import iso_to_jd
+from circuit_breaker import CircuitBreaker, CircuitOpenError, ServiceUnavailableError
+from notify import notify, Listener, EP_XMATCH_CHANNEL, EP_FRITZ_CHANNEL
+
+# penquins is only imported to run the service, the API imports this module for great_circle_distance
+if TYPE_CHECKING:
+    from penquins import Kowalski
 
 RADIUS_MULTIPLIER_DEFAULT = 1.0
 RADIUS_MULTIPLIER = float(os.getenv('RADIUS_MULTIPLIER', RADIUS_MULTIPLIER_DEFAULT))
@@ -16,6 +26,49 @@ DELTA_T = float(os.getenv('DELTA_T', DELTA_T_DEFAULT))
 DELTA_T_ARCHIVAL = 31.0 # 31 JD (a month) by default
 DELTA_T_ARCHIVAL = float(os.getenv('DELTA_T_ARCHIVAL', DELTA_T_ARCHIVAL))
 
+# the alerts considered as counterparts of an event: the filter of the Kowalski queries (see alert_filter), also
+# applied to the alerts of local dumps by backfill.py (see passes_alert_filter), the two must stay in sync
+RB_MIN = float(os.getenv('RB_MIN', 0.3)) # remove bogus detections (random forest)
+DRB_MIN = float(os.getenv('DRB_MIN', 0.5)) # remove bogus detections (deep learning)
+ISDIFFPOS_TRUE = ["t", "T", "true", "True", True, "1", 1] # positive subtractions only
+# remove known solar system objects: those closer than SS_DISTNR_MIN arcsec and brighter than SS_MAGNR_MIN
+SS_DISTNR_MIN = float(os.getenv('SS_DISTNR_MIN', 12))
+SS_MAGNR_MIN = float(os.getenv('SS_MAGNR_MIN', 21))
+# remove known stars: those with a PS1 counterpart closer than DISTPSNR_STAR arcsec with an sgscore of at least SGSCORE_STAR
+SGSCORE_STAR = float(os.getenv('SGSCORE_STAR', 0.7))
+DISTPSNR_STAR = float(os.getenv('DISTPSNR_STAR', 2))
+
+# the fields of the alerts kept for each match (name: path in the alert), besides the candid
+ALERT_FIELDS = {
+    "object_id": "objectId",
+    "jd": "candidate.jd",
+    "ra": "candidate.ra",
+    "dec": "candidate.dec",
+    "fid": "candidate.fid",
+    "magpsf": "candidate.magpsf",
+    "sigmapsf": "candidate.sigmapsf",
+    "drb": "candidate.drb",
+    "jdstarthist": "candidate.jdstarthist",
+    "sgscore": "candidate.sgscore1",
+    "distpsnr": "candidate.distpsnr1",
+    "ssdistnr": "candidate.ssdistnr",
+    "ssmagnr": "candidate.ssmagnr",
+    "ndethist": "candidate.ndethist",
+    # we grab some extra fields to remove
+    # potential stars later on
+    "srmag": "candidate.srmag1",
+    "simag": "candidate.simag1",
+    "szmag": "candidate.szmag1",
+}
+FILTER_ONLY_FIELDS = ["srmag", "simag", "szmag"]
+
+# max number of events reset by a reprocess job that we query per pass
+REPROCESS_MAX_EVENTS_PER_PASS = int(os.getenv('REPROCESS_MAX_EVENTS_PER_PASS', 5))
+
+# shared by all the cone searches, so that a Kowalski outage makes us fail fast
+# instead of timing out on every event
+kowalski_breaker = CircuitBreaker('kowalski')
+
 def great_circle_distance(ra1_deg, dec1_deg, ra2_deg, dec2_deg):
     """
         Distance between two points on the sphere
@@ -26,6 +79,9 @@ def great_circle_distance(ra1_deg, dec1_deg, ra2_deg, dec2_deg):
     :return: distance in degrees
     """
     # this is orders of magnitude faster than astropy.coordinates.Skycoord.separation
+    # numpy is imported here, so that importing this module (e.g. for the API's cone searches) stays cheap
+    import numpy as np
+
     DEGRA = np.pi / 180.0
     ra1, dec1, ra2, dec2 = (
         ra1_deg * DEGRA,
@@ -81,25 +137,152 @@ def is_red_star(match):
     
     return False
 
-def cone_searches(events: list, k: Kowalski, archival: bool = False):
+def search_window(event: dict, archival: bool = False) -> tuple:
+    # the (start, end) jd of the alerts matched to the event, both included
+    obs_start = event["obs_start"] # datetime string
+    # convert to jd
+    jd = iso_to_jd(obs_start) # jd
+
+    if archival:
+        # for archival searches, look for candidates BEFORE the event time
+        return jd - DELTA_T - DELTA_T_ARCHIVAL, jd - DELTA_T
+    # for normal searches, look for candidates after the event time
+    return jd - DELTA_T, jd + DELTA_T_ARCHIVAL
+
+def search_radius(event: dict) -> float:
+    # the radius of the cone search around the event, in arcsec
+    return event["pos_err"] * 60 * 60 * RADIUS_MULTIPLIER # degrees to arcsec
+
+def alert_filter(jd_start: float, jd_end: float) -> dict:
+    # the filter of the Kowalski queries on the ZTF_alerts catalog
+    return {
+        "candidate.jd": { # only consider alerts a the time window of the event
+            "$gte": jd_start,
+            "$lte": jd_end,
+        },
+        "candidate.rb": {
+            "$gt": RB_MIN # remove bogus detections (random forest)
+        },
+        "candidate.drb": {
+            "$gt": DRB_MIN # remove bogus detections (deep learning)
+        },
+        "candidate.isdiffpos": {
+            "$in": ISDIFFPOS_TRUE
+        },
+        "$and": [
+            { # remove known solar system objects
+                "$or": [
+                    {
+                    "candidate.ssdistnr": {
+                        "$lt": 0
+                    }
+                    },
+                    {
+                    "candidate.ssdistnr": {
+                        "$gte": SS_DISTNR_MIN
+                    }
+                    },
+                    {
+                    "candidate.ssmagnr": {
+                        "$lt": 0
+                    }
+                    },
+                    {
+                    "candidate.ssmagnr": {
+                        "$gte": SS_MAGNR_MIN
+                    }
+                    }
+                ]
+            },
+            { # remove known stars based on sgscore and associated distance
+                "$or": [
+                    {
+                        "candidate.sgscore1": {
+                            "$lt": SGSCORE_STAR
+                        }
+                    },
+                    {
+                        "candidate.distpsnr1": {
+                            "$gt": DISTPSNR_STAR
+                        }
+                    },
+                    {
+                        "candidate.distpsnr1": {
+                            "$lt": 0
+                        }
+                    }
+
+                ]
+            }
+        ]
+    }
+
+def _compare(value, bound, op) -> bool:
+    # like in MongoDB, a missing or null value never passes a comparison
+    return value is not None and op(value, bound)
+
+def passes_alert_filter(candidate: dict) -> bool:
+    # the conditions of alert_filter (except the time window) on the candidate of an alert
+    return (
+        _compare(candidate.get('rb'), RB_MIN, operator.gt)
+        and _compare(candidate.get('drb'), DRB_MIN, operator.gt)
+        and candidate.get('isdiffpos') in ISDIFFPOS_TRUE
+        and (
+            _compare(candidate.get('ssdistnr'), 0, operator.lt)
+            or _compare(candidate.get('ssdistnr'), SS_DISTNR_MIN, operator.ge)
+            or _compare(candidate.get('ssmagnr'), 0, operator.lt)
+            or _compare(candidate.get('ssmagnr'), SS_MAGNR_MIN, operator.ge)
+        )
+        and (
+            _compare(candidate.get('sgscore1'), SGSCORE_STAR, operator.lt)
+            or _compare(candidate.get('distpsnr1'), DISTPSNR_STAR, operator.gt)
+            or _compare(candidate.get('distpsnr1'), 0, operator.lt)
+        )
+    )
+
+def project_alert(alert: dict) -> dict:
+    # the fields of ALERT_FIELDS of an alert, like the projection of the Kowalski queries (the missing ones are left out)
+    match = {"candid": alert.get("candid")}
+    for name, path in ALERT_FIELDS.items():
+        value = alert
+        for key in path.split('.'):
+            value = value.get(key) if isinstance(value, dict) else None
+        if value is not None:
+            match[name] = value
+    return match
+
+def format_match(match: dict, event: dict, archival: bool = False) -> dict:
+    # turns an alert matching the event (with the fields of ALERT_FIELDS) into an xmatch of the event
+    # remove the extra fields we just needed for filtering
+    for field in FILTER_ONLY_FIELDS:
+        match.pop(field, None)
+
+    obs_start = event["obs_start"] # datetime string
+    jd = iso_to_jd(obs_start) # jd
+
+    match['delta_t'] = match['jd'] - jd
+    match['distance_arcmin'] = great_circle_distance(
+        event['ra'], event['dec'], match['ra'], match['dec']
+    ) * 60
+    # and a distance_arcmin / pos_err ratio
+    match['distance_ratio'] = match['distance_arcmin'] / (event['pos_err'] * 60)
+
+    # compute the age
+    jdstarthist = match.pop('jdstarthist', None)
+    match['age'] = match['jd'] - jdstarthist if jdstarthist is not None else None
+    if archival:
+        match['archival'] = 1 # mark this as archival match
+
+    match['event_id'] = event['id'] # set the event_id for this match
+    return match
+
+def cone_searches(events: list, k: 'Kowalski', archival: bool = False):
     queries = []
 
     results = {}
 
     for event in events:
-        obs_start = event["obs_start"] # datetime string
-        # convert to jd
-        jd = Time(obs_start).jd # jd
-        
-        if archival:
-            # for archival searches, look for candidates BEFORE the event time
-            jd_start = jd - DELTA_T - DELTA_T_ARCHIVAL
-            jd_end = jd - DELTA_T
-        else:
-            # for normal searches, look for candidates after the event time
-            jd_start = jd - DELTA_T
-            jd_end = jd + DELTA_T_ARCHIVAL 
-        radius = event["pos_err"] * 60 * 60 # degrees to arcsec
+        jd_start, jd_end = search_window(event, archival)
         queries.append(
             {
                 "query_type": "cone_search",
@@ -111,94 +294,16 @@ def cone_searches(events: list, k: Kowalski, archival: bool = False):
                                 event["dec"]
                             ]
                         },
-                        "cone_search_radius": radius * RADIUS_MULTIPLIER,
+                        "cone_search_radius": search_radius(event),
                         "cone_search_unit": "arcsec",
                     },
                     "catalogs": {
                         "ZTF_alerts": {
-                            "filter": {
-                                "candidate.jd": { # only consider alerts a the time window of the event
-                                    "$gte": jd_start,
-                                    "$lte": jd_end,
-                                },
-                                "candidate.rb": {
-                                    "$gt": 0.3 # remove bogus detections (random forest)
-                                },
-                                "candidate.drb": {
-                                    "$gt": 0.5 # remove bogus detections (deep learning)
-                                },
-                                "candidate.isdiffpos": {
-                                    "$in": ["t", "T", "true", "True", True, "1", 1]
-                                },
-                                "$and": [
-                                    { # remove known solar system objects
-                                        "$or": [
-                                            {
-                                            "candidate.ssdistnr": {
-                                                "$lt": 0
-                                            }
-                                            },
-                                            {
-                                            "candidate.ssdistnr": {
-                                                "$gte": 12
-                                            }
-                                            },
-                                            {
-                                            "candidate.ssmagnr": {
-                                                "$lt": 0
-                                            }
-                                            },
-                                            {
-                                            "candidate.ssmagnr": {
-                                                "$gte": 21
-                                            }
-                                            }
-                                        ]
-                                    },
-                                    { # remove known stars based on sgscore and associated distance
-                                        "$or": [
-                                            {
-                                                "candidate.sgscore1": {
-                                                    "$lt": 0.7
-                                                }
-                                            },
-                                            {
-                                                "candidate.distpsnr1": {
-                                                    "$gt": 2
-                                                }
-                                            },
-                                            {
-                                                "candidate.distpsnr1": {
-                                                    "$lt": 0
-                                                }
-                                            }
-
-                                        ]
-                                    }
-                                ]
-                            },
+                            "filter": alert_filter(jd_start, jd_end),
                             "projection": {
                                 "_id": 0,
                                 "candid": 1,
-                                "object_id": "$objectId",
-                                "jd": "$candidate.jd",
-                                "ra": "$candidate.ra",
-                                "dec": "$candidate.dec",
-                                "fid": "$candidate.fid",
-                                "magpsf": "$candidate.magpsf",
-                                "sigmapsf": "$candidate.sigmapsf",
-                                "drb": "$candidate.drb",
-                                "jdstarthist": "$candidate.jdstarthist",
-                                "sgscore": "$candidate.sgscore1",
-                                "distpsnr": "$candidate.distpsnr1",
-                                "ssdistnr": "$candidate.ssdistnr",
-                                "ssmagnr": "$candidate.ssmagnr",
-                                "ndethist": "$candidate.ndethist",
-                                # we grab some extra fields to remove
-                                # potential stars later on
-                                "srmag": "$candidate.srmag1",
-                                "simag": "$candidate.simag1",
-                                "szmag": "$candidate.szmag1",
+                                **{name: f"${path}" for name, path in ALERT_FIELDS.items()},
                             }
                         }
                     }
@@ -207,7 +312,17 @@ def cone_searches(events: list, k: Kowalski, archival: bool = False):
         )
 
     # now we submit the queries in parallel, with up to 8 threads
-    responses = k.query(queries=queries, use_batch_query=True, max_n_threads=4)
+    # if Kowalski can't be reached, we raise a ServiceUnavailableError so that the events stay queued.
+    # Only the transport errors count as an outage, any other error is a bug and is raised as is
+    kowalski_breaker.before_request('queries')
+    try:
+        with metrics.timer('kowalski_query_seconds', archival=archival):
+            responses = k.query(queries=queries, use_batch_query=True, max_n_threads=4)
+    except (requests.exceptions.RequestException, ServiceUnavailableError) as e:
+        kowalski_breaker.record_failure('queries')
+        metrics.inc('kowalski_query_errors', archival=archival)
+        raise ServiceUnavailableError('kowalski/queries', f'Kowalski query failed: {e}')
+    kowalski_breaker.record_success('queries')
 
     results = {
         event["name"]: [] for event in events
@@ -235,36 +350,15 @@ def cone_searches(events: list, k: Kowalski, archival: bool = False):
                 if is_red_star(match):
                     print(f'Found a red star candidate {match["object_id"]}, skipping...')
                     continue
-                # remove the extra fields we just needed for filtering
-                del match['srmag']
-                del match['simag']
-                del match['szmag']
-
-                event = [e for e in events if e['name'] == event_name][0]
-                obs_start = event["obs_start"] # datetime string
-                jd = Time(obs_start).jd # jd
-
-                match['delta_t'] = match['jd'] - jd
-                match['distance_arcmin'] = great_circle_distance(
-                    event['ra'], event['dec'], match['ra'], match['dec']
-                ) * 60
-                # and a distance_arcmin / pos_err ratio
-                match['distance_ratio'] = match['distance_arcmin'] / (event['pos_err'] * 60)
-
-                # compute the age
-                match['age'] = match['jd'] - match['jdstarthist']
-                del match['jdstarthist']
-                if archival:
-                    match['archival'] = 1 # mark this as archival match
-
-                match['event_id'] = event_id # set the event_id for this match
-                formatted_matches.append(match)
+
+                event = [e for e in events if e['id'] == event_id][0]
+                formatted_matches.append(format_match(match, event, archival))
 
             results[event_name] = formatted_matches
 
     return results
 
-def service(k: Kowalski) -> float:
+def service(k: 'Kowalski') -> float:
     with get_db_connection() as conn:
         c = conn.cursor()
             
@@ -280,22 +374,39 @@ def service(k: Kowalski) -> float:
         if not events_to_reprocess:
             events_to_reprocess = []
 
+        # the events reset by a reprocess job are throttled, so that a large job doesn't flood Kowalski
+        # or delay the new events: the others are picked up on the next passes
+        reprocess_job_events = [e for e in events_to_reprocess if e['query_status'] in REPROCESS_STATUSES]
+        if len(reprocess_job_events) > REPROCESS_MAX_EVENTS_PER_PASS:
+            skipped_ids = {e['id'] for e in reprocess_job_events[REPROCESS_MAX_EVENTS_PER_PASS:]}
+            events_to_reprocess = [e for e in events_to_reprocess if e['id'] not in skipped_ids]
+            print(f'Throttling reprocessing, {len(skipped_ids)} events left for the next passes.')
+
         if not new_events and not events_to_reprocess:
             print('No events to process or reprocess.')
             return
 
         print(f'Found {len(new_events)} events to process (and {len(events_to_reprocess)} to reprocess)')
 
+        # events for which Kowalski could not be queried, they stay queued for the next pass
+        unavailable_event_ids = set()
+
         # for the new events only and those with a reprocess status, we perform archival searches
-        for event in new_events + [e for e in events_to_reprocess if e['query_status'] == 'reprocess']:
+        for event in new_events + [e for e in events_to_reprocess if e['query_status'] in REPROCESS_STATUSES]:
+            queued = 0
             try:
                 archival_results = cone_searches([event], k, archival=True)
+                record_timings([(event['id'], 0)], 'queried', c)
                 xmatches = archival_results[event["name"]]
+                metrics.observe('matches_per_event', len(xmatches), buckets=metrics.COUNT_BUCKETS, archival=True)
                 if len(xmatches) > 0:
                     print(f'Found {len(archival_results[event["name"]])} archival matches for event {event["name"]}')
                     for xmatch in xmatches:
                         try:
-                            insert_xmatches([xmatch], c)
+                            # queue the new xmatches for delivery to Fritz
+                            xmatch_ids = insert_xmatches([xmatch], c)
+                            enqueue_fritz_outbox(xmatch_ids, c)
+                            queued += len(xmatch_ids)
                         except Exception as e:
                             # if the xmatch already exists, we can ignore the error
                             if 'UNIQUE constraint failed' in str(e):
@@ -303,27 +414,48 @@ def service(k: Kowalski) -> float:
                             else:
                                 print(f'Failed to insert archival xmatch {xmatch["candid"]} for event {event["name"]}: {e}')
                                 traceback.print_exc()
+                if event['query_status'] == 'reprocess_archival':
+                    # only the archival searches had to be run again
+                    update_event_status(event['id'], 'done', c)
+            except CircuitOpenError as e:
+                print(f'{e}, leaving the events queued until Kowalski is back.')
+                conn.commit()
+                return
+            except ServiceUnavailableError as e:
+                print(f'Failed to process archival event {event["name"]}: {e}, will retry.')
+                unavailable_event_ids.add(event['id'])
             except Exception as e:
                 traceback.print_exc()
                 print(f'Failed to process archival event {event["name"]}: {e}')
                 update_event_status(event['id'], f'failed: {str(e)}', c)
 
             conn.commit()
+            metrics.inc('xmatches_inserted', queued)
+            if queued > 0:
+                # wake up ep_fritz right away to post the new xmatches
+                notify(EP_FRITZ_CHANNEL)
 
         # for all events (new and those to reprocess), perform the non archival cone searches
         for event in new_events + events_to_reprocess:
+            if event['id'] in unavailable_event_ids or event['query_status'] == 'reprocess_archival':
+                continue
+            queued = 0
             try:
                 if event['query_status'] == 'pending':
                     update_event_status(event['id'], 'processing', c)
 
                 results = cone_searches([event], k)
+                record_timings([(event['id'], 0)], 'queried', c)
                 
                 xmatches = results[event["name"]]
+                metrics.observe('matches_per_event', len(xmatches), buckets=metrics.COUNT_BUCKETS, archival=False)
                 if len(xmatches) > 0:
                     print(f'Found {len(xmatches)} matches for event {event["name"]}')
                     for xmatch in xmatches:
                         try:
-                            insert_xmatches([xmatch], c)
+                            xmatch_ids = insert_xmatches([xmatch], c)
+                            enqueue_fritz_outbox(xmatch_ids, c)
+                            queued += len(xmatch_ids)
                         except Exception as e:
                             # if the xmatch already exists, we can ignore the error
                             if 'UNIQUE constraint failed' in str(e):
@@ -333,14 +465,29 @@ def service(k: Kowalski) -> float:
                                 traceback.print_exc()
 
                 update_event_status(event['id'], 'done', c)
+            except ServiceUnavailableError as e:
+                # put the event back in its previous state, it will be picked up again
+                update_event_status(event['id'], event['query_status'], c)
+                conn.commit()
+                if isinstance(e, CircuitOpenError):
+                    print(f'{e}, leaving the events queued until Kowalski is back.')
+                    return
+                print(f'Failed to process event {event["name"]}: {e}, will retry.')
+                continue
             except Exception as e:
                 traceback.print_exc()
                 print(f'Failed to process event {event["name"]}: {e}')
                 update_event_status(event['id'], f'failed: {str(e)}', c)
 
             conn.commit()
+            metrics.inc('xmatches_inserted', queued)
+            if queued > 0:
+                # wake up ep_fritz right away to post the new xmatches
+                notify(EP_FRITZ_CHANNEL)
 
 if __name__ == "__main__":
+    from penquins import Kowalski
+
     protocol = 'https'
     host = 'kowalski.caltech.edu'
     port = 443
@@ -359,13 +506,23 @@ if __name__ == "__main__":
         print('Waiting for database to be initialized...')
         time.sleep(15)
 
+    # ep_listener notifies us when new events are inserted, polling remains as a fallback
+    listener = Listener(EP_XMATCH_CHANNEL)
+
+    # profiles the service on SIGUSR1 (see profiling.py)
+    profiler = LoopProfiler('ep_xmatch')
+
+    metrics.configure('ep_xmatch')
+
     print('Starting service...')
     while True:
         try:
-            service(k)
+            with profiler.iteration(), metrics.timer('service_pass_seconds'):
+                service(k)
         except Exception as e:
             traceback.print_exc()
             print(f'Failed to run service: {e}')
-        time.sleep(5)
+        metrics.flush()
+        listener.wait(5)
         print('Service loop')
 
@@ -0,0 +1,179 @@
+import csv
+import io
+import json
+import os
+import sqlite3
+import sys
+
+from db import DATABASE_PATH
+
+# streaming exports of the xmatches (optionally with their event), as NDJSON, CSV or Arrow IPC
+# the rows are read from the database in chunks, each its own query keyed on the last id read, and each chunk
+# is serialized and yielded as soon as it is read, so the memory used stays constant and the first bytes go out
+# right away, whatever the size of the export. A cursor kept open for the whole export would hold the database's
+# read lock for as long as the download lasts, and the services couldn't commit in the meantime
+
+EXPORT_CHUNK_SIZE = int(os.getenv('EXPORT_CHUNK_SIZE', 5000))
+
+EXPORT_FORMATS = {
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+    'csv': ('text/csv', 'csv'),
+    'arrow': ('application/vnd.apache.arrow.stream', 'arrow'),
+}
+
+# the event columns added to each xmatch, prefixed with event_
+EVENT_COLUMNS = ['name', 'version', 'ra', 'dec', 'pos_err', 'obs_start', 'query_status']
+
+def _columns(conn: sqlite3.Connection, with_events: bool) -> list:
+    # (sql expression, output name, declared type) of the exported columns
+    columns = [
+        (f'xmatches.{name}', name, type)
+        for _, name, type, _, _, _ in conn.execute('PRAGMA table_info(xmatches)').fetchall()
+    ]
+    if with_events:
+        event_types = {name: type for _, name, type, _, _, _ in conn.execute('PRAGMA table_info(events)').fetchall()}
+        columns += [(f'events.{name}', f'event_{name}', event_types[name]) for name in EVENT_COLUMNS]
+    return columns
+
+def iter_xmatches(conn: sqlite3.Connection, columns: list, with_events=False, event_names=None, archival=None, since_id=None, chunk_size=EXPORT_CHUNK_SIZE):
+    # yields lists of rows (tuples, in the order of the columns), at most chunk_size at a time, by id.
+    # The xmatches inserted after the export started are left out, so that it ends even if they keep coming
+    query = 'SELECT ' + ', '.join(expression for expression, _, _ in columns) + ' FROM xmatches'
+    if with_events:
+        query += ' JOIN events ON events.id = xmatches.event_id'
+    conditions = []
+    parameters = []
+    if event_names:
+        conditions.append(' xmatches.event_id IN (SELECT id FROM events WHERE name IN ({}))'.format(','.join('?'*len(event_names))))
+        parameters += event_names
+    if archival is not None:
+        conditions.append(' xmatches.archival = ?')
+        parameters.append(1 if archival else 0)
+    conditions.append(' xmatches.id > ? AND xmatches.id <= ?')
+    query += ' WHERE' + ' AND'.join(conditions) + ' ORDER BY xmatches.id LIMIT ?'
+
+    id_index = [expression for expression, _, _ in columns].index('xmatches.id')
+    last_id = int(since_id or 0)
+    max_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM xmatches').fetchone()[0]
+    while True:
+        rows = conn.execute(query, (*parameters, last_id, max_id, chunk_size)).fetchall()
+        if not rows:
+            break
+        last_id = rows[-1][id_index]
+        yield rows
+
+def _ndjson_chunks(names, chunks):
+    for rows in chunks:
+        yield ''.join(json.dumps(dict(zip(names, row))) + '\n' for row in rows).encode()
+
+def _csv_chunks(names, chunks):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(names)
+    yield buffer.getvalue().encode()
+    for rows in chunks:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(rows)
+        yield buffer.getvalue().encode()
+
+def arrow_type(pa, declared_type):
+    declared_type = (declared_type or '').upper()
+    if 'INT' in declared_type:
+        return pa.int64()
+    if 'REAL' in declared_type or 'FLOA' in declared_type or 'DOUB' in declared_type:
+        return pa.float64()
+    return pa.string()
+
+def _arrow_chunks(columns, chunks):
+    import pyarrow as pa
+    # the types come from the declared types of the columns, as sqlite values aren't typed
+    schema = pa.schema([(name, arrow_type(pa, type)) for _, name, type in columns])
+    # the writer keeps writing to the same sink, so we hand it one we can drain after each batch
+    sink = _DrainableSink()
+    writer = pa.ipc.new_stream(sink, schema)
+    yield sink.drain()
+    for rows in chunks:
+        arrays = [
+            pa.array([row[i] for row in rows], type=field.type)
+            for i, field in enumerate(schema)
+        ]
+        writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=schema))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+class _DrainableSink(io.RawIOBase):
+    # file-like sink for the arrow stream writer, emptied after each batch
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._buffer += data
+        return len(data)
+
+    def drain(self):
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        return data
+
+def export_xmatches(format='ndjson', with_events=False, event_names=None, archival=None, since_id=None, chunk_size=EXPORT_CHUNK_SIZE, database_path=None):
+    # returns a generator of the bytes of the export, raises a ValueError right away if the format can't be used
+    if format not in EXPORT_FORMATS:
+        raise ValueError(f'Invalid format {format}, must be one of {list(EXPORT_FORMATS)}')
+    if format == 'arrow':
+        try:
+            import pyarrow # noqa: F401
+        except ImportError:
+            raise ValueError('The arrow format requires pyarrow to be installed')
+    return _export(format, with_events, event_names, archival, since_id, chunk_size, database_path or DATABASE_PATH)
+
+def _export(format, with_events, event_names, archival, since_id, chunk_size, database_path):
+    # the generator opens its own connection, closed once the export is done (or abandoned),
+    # so that it can be streamed after the request that started it returned
+    conn = sqlite3.connect(database_path)
+    try:
+        columns = _columns(conn, with_events)
+        names = [name for _, name, _ in columns]
+        chunks = iter_xmatches(
+            conn, columns,
+            with_events=with_events, event_names=event_names, archival=archival, since_id=since_id, chunk_size=chunk_size,
+        )
+        if format == 'ndjson':
+            yield from _ndjson_chunks(names, chunks)
+        elif format == 'csv':
+            yield from _csv_chunks(names, chunks)
+        else:
+            yield from _arrow_chunks(columns, chunks)
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Export the xmatches as NDJSON, CSV or Arrow IPC.')
+    parser.add_argument('--format', choices=list(EXPORT_FORMATS), default='ndjson', help='Output format.')
+    parser.add_argument('--output', default='-', help='Output file, - for stdout.')
+    parser.add_argument('--with-events', action='store_true', help='Add the columns of the event of each xmatch.')
+    parser.add_argument('--event-names', nargs='*', default=None, help='Only export the xmatches of these events.')
+    parser.add_argument('--archival', choices=['0', '1'], default=None, help='Only export the (non) archival xmatches.')
+    parser.add_argument('--since-id', type=int, default=None, help='Only export the xmatches with a greater id.')
+    parser.add_argument('--chunk-size', type=int, default=EXPORT_CHUNK_SIZE, help='Number of rows read at a time.')
+    args = parser.parse_args()
+
+    output = sys.stdout.buffer if args.output == '-' else open(args.output, 'wb')
+    try:
+        for data in export_xmatches(
+            format=args.format,
+            with_events=args.with_events,
+            event_names=args.event_names,
+            archival=None if args.archival is None else args.archival == '1',
+            since_id=args.since_id,
+            chunk_size=args.chunk_size,
+        ):
+            output.write(data)
+    finally:
+        if output is not sys.stdout.buffer:
+            output.close()
@@ -0,0 +1,138 @@
+import itertools
+import random
+import threading
+import time
+from collections import Counter
+
+from flask import Flask, request
+
+# a minimal stand-in for the SkyPortal (Fritz) endpoints used by ep_fritz.py,
+# so that the poster can be load-tested locally without hitting production
+
+DUPLICATE_CANDIDATE_MESSAGE = 'duplicate key value violates unique constraint "candidates_main_index"'
+
+def make_app(
+    filter_id: int = 1,
+    group_id: int = 1,
+    latency: float = 0.0,
+    latency_jitter: float = 0.0,
+    rate_429: float = 0.0,
+    rate_503: float = 0.0,
+    duplicate_rate: float = 0.0,
+    seed: int = None,
+):
+    app = Flask(__name__)
+
+    rng = random.Random(seed)
+    lock = threading.Lock()
+    # in-memory state: the candidates posted (object_id, candid), and the annotations per object
+    candidates = set()
+    annotations = {}
+    annotation_ids = itertools.count(1)
+    stats = Counter()
+    app.config['STATS'] = stats
+
+    def _endpoint_name():
+        # the first part of the path after /api/, e.g. "candidates" or "sources"
+        return request.path.split('/')[2] if request.path.count('/') >= 2 else request.path
+
+    @app.before_request
+    def inject_faults():
+        if not request.path.startswith('/api/'):
+            return None
+        with lock:
+            stats[f'{request.method} {_endpoint_name()}'] += 1
+            stats['total'] += 1
+            draw = rng.random()
+            delay = max(latency + rng.uniform(-latency_jitter, latency_jitter), 0.0)
+        if delay > 0:
+            time.sleep(delay)
+        if draw < rate_429:
+            with lock:
+                stats['429'] += 1
+            return {'status': 'error', 'message': 'Too many requests'}, 429
+        if draw < rate_429 + rate_503:
+            with lock:
+                stats['503'] += 1
+            return {'status': 'error', 'message': 'Service unavailable'}, 503
+        return None
+
+    @app.route('/api/filters', methods=['GET'])
+    def filters():
+        return {
+            'status': 'success',
+            'data': [{'id': filter_id, 'group_id': group_id, 'name': 'ZTF+EP'}],
+        }
+
+    @app.route('/api/candidates', methods=['POST'])
+    def post_candidate():
+        data = request.get_json(silent=True) or {}
+        key = (data.get('id'), data.get('passing_alert_id'))
+        with lock:
+            duplicate = key in candidates or rng.random() < duplicate_rate
+            candidates.add(key)
+        if duplicate:
+            return {'status': 'error', 'message': DUPLICATE_CANDIDATE_MESSAGE}, 400
+        return {'status': 'success', 'data': {'ids': [data.get('id')]}}
+
+    @app.route('/api/alerts/<object_id>', methods=['POST'])
+    def import_alert(object_id):
+        return {'status': 'success', 'data': {'id': object_id}}
+
+    @app.route('/api/sources/<object_id>/annotations', methods=['GET', 'POST'])
+    def source_annotations(object_id):
+        if request.method == 'GET':
+            with lock:
+                return {'status': 'success', 'data': list(annotations.get(object_id, {}).values())}
+        data = request.get_json(silent=True) or {}
+        with lock:
+            annotation_id = next(annotation_ids)
+            annotations.setdefault(object_id, {})[annotation_id] = {
+                'id': annotation_id,
+                'obj_id': object_id,
+                'origin': data.get('origin'),
+                'data': data.get('data', {}),
+                'author_id': 1,
+            }
+        return {'status': 'success', 'data': {'annotation_id': annotation_id}}
+
+    @app.route('/api/sources/<object_id>/annotations/<int:annotation_id>', methods=['PUT'])
+    def update_annotation(object_id, annotation_id):
+        data = request.get_json(silent=True) or {}
+        with lock:
+            annotation = annotations.get(object_id, {}).get(annotation_id)
+            if annotation is None:
+                return {'status': 'error', 'message': 'Annotation not found'}, 404
+            annotation['data'] = data.get('data', annotation['data'])
+        return {'status': 'success'}
+
+    @app.route('/stats', methods=['GET'])
+    def get_stats():
+        with lock:
+            return dict(stats)
+
+    return app
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Run a local stand-in of the SkyPortal API used by ep_fritz.')
+    parser.add_argument('--port', type=int, default=5050, help='Port to listen on.')
+    parser.add_argument('--filter-id', type=int, default=1, help='Id of the ZTF+EP filter.')
+    parser.add_argument('--group-id', type=int, default=1, help='Id of the group of the filter.')
+    parser.add_argument('--latency', type=float, default=0.0, help='Latency added to every request, in seconds.')
+    parser.add_argument('--latency-jitter', type=float, default=0.0, help='Random +/- jitter on the latency, in seconds.')
+    parser.add_argument('--rate-429', type=float, default=0.0, help='Fraction of requests answered with a 429.')
+    parser.add_argument('--rate-503', type=float, default=0.0, help='Fraction of requests answered with a 503.')
+    parser.add_argument('--duplicate-rate', type=float, default=0.0, help='Fraction of new candidates reported as duplicates.')
+    args = parser.parse_args()
+
+    app = make_app(
+        filter_id=args.filter_id,
+        group_id=args.group_id,
+        latency=args.latency,
+        latency_jitter=args.latency_jitter,
+        rate_429=args.rate_429,
+        rate_503=args.rate_503,
+        duplicate_rate=args.duplicate_rate,
+    )
+    app.run(port=args.port, threaded=True)
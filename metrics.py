@@ -0,0 +1,187 @@
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# counters and histograms shared by all the services (ep_listener, ep_xmatch, ep_fritz, reprocess and the API workers)
+# each process records its metrics in memory, and once configured (see configure) regularly writes a snapshot
+# of them to METRICS_DIR (one json file per process). The API reads all the snapshots and serves them, summed per service,
+# in the Prometheus text format on /metrics
+
+METRICS_DIR = os.getenv('METRICS_DIR', './run/metrics')
+METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', 10.0))  # in seconds
+
+# in seconds
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# for counts, e.g. the number of matches per event
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+_lock = threading.Lock()
+_counters = {}  # (name, labels) -> value
+_histograms = {}  # (name, labels) -> [buckets, bucket counts, sum, count]
+_last_flush = 0.0
+_service = None  # set by configure, until then nothing is written
+
+def configure(service: str) -> None:
+    # name of the service the metrics of this process are reported under. The processes that don't call it
+    # (migrate.py, scripts, tests...) still record their metrics, but never write them
+    global _service
+    _service = service
+
+def _key(name, labels):
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def inc(name: str, value: float = 1, **labels) -> None:
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+    _maybe_flush()
+
+def observe(name: str, value: float, buckets: tuple = LATENCY_BUCKETS, **labels) -> None:
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [tuple(buckets), [0] * len(buckets), 0.0, 0]
+        for i, bound in enumerate(histogram[0]):
+            if value <= bound:
+                histogram[1][i] += 1
+                break
+        histogram[2] += value
+        histogram[3] += 1
+    _maybe_flush()
+
+@contextmanager
+def timer(name: str, **labels):
+    # observes the time spent in the block, in seconds
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+def timed(name: str, **labels):
+    # decorator observing the time spent in the function, with its name as the function label
+    def _timed(f):
+        @functools.wraps(f)
+        def __timed(*args, **kwargs):
+            with timer(name, function=f.__name__, **labels):
+                return f(*args, **kwargs)
+        return __timed
+    return _timed
+
+def _snapshot():
+    with _lock:
+        return {
+            'service': _service,
+            'pid': os.getpid(),
+            'counters': [[name, dict(labels), value] for (name, labels), value in _counters.items()],
+            'histograms': [
+                [name, dict(labels), list(buckets), list(counts), total, count]
+                for (name, labels), (buckets, counts, total, count) in _histograms.items()
+            ],
+        }
+
+def flush() -> None:
+    # write the snapshot of this process' metrics, if it is configured. Never raises
+    global _last_flush
+    if _service is None:
+        return
+    _last_flush = time.monotonic()
+    path = os.path.join(METRICS_DIR, f'{_service}-{os.getpid()}.json')
+    try:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        with open(f'{path}.tmp', 'w') as f:
+            json.dump(_snapshot(), f)
+        os.replace(f'{path}.tmp', path)
+    except OSError as e:
+        print(f'Failed to write metrics: {e}')
+
+def _maybe_flush():
+    if time.monotonic() - _last_flush >= METRICS_FLUSH_INTERVAL:
+        flush()
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def read_snapshots() -> list:
+    # the snapshots of all the running processes, the ones of processes that exited are removed
+    snapshots = []
+    try:
+        entries = list(os.scandir(METRICS_DIR))
+    except FileNotFoundError:
+        return snapshots
+    for entry in entries:
+        if not entry.name.endswith('.json'):
+            continue
+        try:
+            with open(entry.path) as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if not _is_alive(snapshot.get('pid', 0)):
+            try:
+                os.unlink(entry.path)
+            except OSError:
+                pass
+            continue
+        snapshots.append(snapshot)
+    return snapshots
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in sorted(labels.items())) + '}'
+
+def prometheus_text() -> str:
+    # all the metrics of all the services, summed over the processes of each service
+    flush()
+    counters = {}
+    histograms = {}
+    for snapshot in read_snapshots():
+        service = snapshot['service']
+        for name, labels, value in snapshot['counters']:
+            key = _key(name, {**labels, 'service': service})
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, buckets, counts, total, count in snapshot['histograms']:
+            key = (*_key(name, {**labels, 'service': service}), tuple(buckets))
+            if key not in histograms:
+                histograms[key] = [[0] * len(buckets), 0.0, 0]
+            histogram = histograms[key]
+            histogram[0] = [a + b for a, b in zip(histogram[0], counts)]
+            histogram[1] += total
+            histogram[2] += count
+
+    lines = []
+    typed = set()
+    for (name, labels), value in sorted(counters.items()):
+        name = f'ep_{name}_total'
+        if name not in typed:
+            lines.append(f'# TYPE {name} counter')
+            typed.add(name)
+        lines.append(f'{name}{_format_labels(dict(labels))} {value}')
+    for (name, labels, buckets), (counts, total, count) in sorted(histograms.items()):
+        name = f'ep_{name}'
+        if name not in typed:
+            lines.append(f'# TYPE {name} histogram')
+            typed.add(name)
+        labels = dict(labels)
+        cumulative = 0
+        for bound, bucket_count in zip(buckets, counts):
+            cumulative += bucket_count
+            lines.append(f'{name}_bucket{_format_labels({**labels, "le": bound})} {cumulative}')
+        lines.append(f'{name}_bucket{_format_labels({**labels, "le": "+Inf"})} {count}')
+        lines.append(f'{name}_sum{_format_labels(labels)} {total}')
+        lines.append(f'{name}_count{_format_labels(labels)} {count}')
+    return '\n'.join(lines) + '\n'
@@ -1,9 +1,12 @@
+import inspect
+import os
 import sqlite3
+import time
 
-def migration1():
-    conn = sqlite3.connect('./data/database.db')
-    c = conn.cursor()
+DATABASE_PATH = os.getenv('DATABASE_PATH', './data/database.db')
+MIGRATION_CHUNK_PAUSE = float(os.getenv('MIGRATION_CHUNK_PAUSE', 0.05))  # in seconds, between the chunks of a migration
 
+def migration1(c: sqlite3.Cursor):
     try:
         c.execute('''
             CREATE TABLE users (
@@ -74,15 +77,9 @@ def migration1():
         ''')
     except sqlite3.OperationalError:
         print("xmatches table already exists.")
-
-    conn.commit()
-    conn.close()
     return
 
-def migration2():
-    conn = sqlite3.connect('./data/database.db')
-    c = conn.cursor()
-
+def migration2(c: sqlite3.Cursor):
     # add the age column to the xmatches table
     try:
         c.execute('ALTER TABLE xmatches ADD COLUMN age REAL')
@@ -121,17 +118,10 @@ def migration2():
         ''')
     except sqlite3.OperationalError:
         print("archival_xmatches table already exists.")
-
-    # commit the changes and close the connection
-    conn.commit()
-    conn.close()
     return
 
 # third migration adds the ndethist column to the xmatches and archival_xmatches tables
-def migration3():
-    conn = sqlite3.connect('./data/database.db')
-    c = conn.cursor()
-
+def migration3(c: sqlite3.Cursor):
     # add the ndethist column to the xmatches table
     try:
         c.execute('ALTER TABLE xmatches ADD COLUMN ndethist INTEGER')
@@ -142,17 +132,10 @@ def migration3():
         c.execute('ALTER TABLE archival_xmatches ADD COLUMN ndethist INTEGER')
     except sqlite3.OperationalError:
         print("archival_xmatches table already has ndethist column.")
-
-    # commit the changes and close the connection
-    conn.commit()
-    conn.close()
     return
 
 # fourth migration adds the distpsnr, ssdistnr, ssmagnr to the xmatches and archival_xmatches tables
-def migration4():
-    conn = sqlite3.connect('./data/database.db')
-    c = conn.cursor()
-
+def migration4(c: sqlite3.Cursor):
     # add the distpsnr, ssdistnr, ssmagnr columns to the xmatches table
     for column in ['distpsnr', 'ssdistnr', 'ssmagnr']:
         try:
@@ -165,16 +148,10 @@ def migration4():
             c.execute(f'ALTER TABLE archival_xmatches ADD COLUMN {column} REAL')
         except sqlite3.OperationalError:
             print(f"archival_xmatches table already has {column} column.")
-    # commit the changes and close the connection
-    conn.commit()
-    conn.close()
     return
 
 # In the fifth migration, we remove the archival_xmatches table, and simply add an archival flag to the `xmatches` table as a boolean column.
-def migration5():
-    conn = sqlite3.connect('./data/database.db')
-    c = conn.cursor()
-
+def migration5(c: sqlite3.Cursor):
     # add the archival flag to the xmatches table
     try:
         c.execute('ALTER TABLE xmatches ADD COLUMN archival INTEGER DEFAULT 0') # 0 for False, 1 for True
@@ -187,20 +164,13 @@ def migration5():
     except sqlite3.OperationalError:
         print("Failed to drop archival_xmatches table.")
 
-    # commit the changes and close the connection
-    conn.commit()
-    conn.close()
-
 # in the sixth migration, we edit the user types. We rename normal and admin to external and caltech
 # and then add a new type called partner
-def migration6():
-    conn = sqlite3.connect('./data/database.db')
-    c = conn.cursor()
-
+def migration6(c: sqlite3.Cursor):
     # first check if the type column is already in the new format
     c.execute('SELECT type FROM users LIMIT 1')
-    type = c.fetchone()[0]
-    if type in ['external', 'partner', 'caltech']:
+    type = c.fetchone()
+    if type is not None and type[0] in ['external', 'partner', 'caltech']:
         print("users table type column already has the new types.")
         return
 
@@ -215,22 +185,339 @@ def migration6():
     except sqlite3.OperationalError:
         raise sqlite3.OperationalError("error updating users table type column.")
 
-    conn.commit()
-
 # the seventh migration adds a to_skyportal column on the xmatches table which is a boolean column
-def migration7():
-    conn = sqlite3.connect('./data/database.db')
-    c = conn.cursor()
-
+def migration7(c: sqlite3.Cursor):
     # add the to_skyportal column to the xmatches table
     try:
         c.execute('ALTER TABLE xmatches ADD COLUMN to_skyportal INTEGER DEFAULT 0') # 0 for False, 1 for True
     except sqlite3.OperationalError:
         print("xmatches table already has to_skyportal column.")
 
-    # commit the changes and close the connection
-    conn.commit()
-    conn.close()
+# the eighth migration adds the fritz_outbox table, a delivery queue for the xmatches to post to Fritz
+# each xmatch gets one row tracking its delivery state, number of attempts, next attempt time and last error
+def migration8(c: sqlite3.Cursor):
+    try:
+        c.execute('''
+            CREATE TABLE fritz_outbox (
+                id INTEGER PRIMARY KEY,
+                xmatch_id INTEGER NOT NULL,
+                state TEXT DEFAULT 'pending' CHECK (state IN ('pending', 'done', 'skipped', 'dead')),
+                attempts INTEGER DEFAULT 0,
+                next_attempt_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                last_error TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                UNIQUE (xmatch_id)
+            )
+        ''')
+    except sqlite3.OperationalError:
+        print("fritz_outbox table already exists.")
+
+    # the poster only ever looks for the pending rows that are due
+    c.execute('CREATE INDEX IF NOT EXISTS fritz_outbox_due ON fritz_outbox (state, next_attempt_at)')
+
+    # when an xmatch is deleted (e.g. reprocessing), its delivery is dropped as well
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS fritz_outbox_xmatch_deleted
+        AFTER DELETE ON xmatches
+        BEGIN
+            DELETE FROM fritz_outbox WHERE xmatch_id = OLD.id;
+        END
+    ''')
+
+    # enqueue the xmatches that the poster would still have picked up (created in the last day, not sent yet)
+    c.execute('''
+        INSERT OR IGNORE INTO fritz_outbox (xmatch_id)
+        SELECT id FROM xmatches
+        WHERE to_skyportal = 0 AND created_at >= datetime('now', '-1 day')
+    ''')
+
+# the ninth migration adds change counters for the events and xmatches tables, bumped by triggers
+# on every change, so that the API can cheaply tell if its cached pages are still up to date
+def migration9(c: sqlite3.Cursor):
+    try:
+        c.execute('''
+            CREATE TABLE change_counters (
+                name TEXT PRIMARY KEY,
+                version INTEGER DEFAULT 0
+            )
+        ''')
+    except sqlite3.OperationalError:
+        print("change_counters table already exists.")
+
+    c.execute("INSERT OR IGNORE INTO change_counters (name, version) VALUES ('events', 0), ('xmatches', 0)")
+
+    # the xmatches are only ever updated to flag them as sent to Fritz, which isn't shown anywhere,
+    # so we only track their inserts and deletes
+    for table, operations in [('events', ['INSERT', 'UPDATE', 'DELETE']), ('xmatches', ['INSERT', 'DELETE'])]:
+        for operation in operations:
+            c.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS {table}_{operation.lower()}_change_counter
+                AFTER {operation} ON {table}
+                BEGIN
+                    UPDATE change_counters SET version = version + 1 WHERE name = '{table}';
+                END
+            ''')
+
+# the tenth migration adds a per event xmatch change counter, bumped by triggers whenever one of
+# the event's xmatches is inserted, updated or deleted, so that the API can build ETags without querying the xmatches
+# (it lives in its own table rather than in events, so that it doesn't bump the events change counter)
+def migration10(c: sqlite3.Cursor):
+    try:
+        c.execute('''
+            CREATE TABLE event_xmatches_versions (
+                event_id INTEGER PRIMARY KEY,
+                version INTEGER DEFAULT 0,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+    except sqlite3.OperationalError:
+        print("event_xmatches_versions table already exists.")
+
+    for operation, row in [('INSERT', 'NEW'), ('UPDATE', 'NEW'), ('DELETE', 'OLD')]:
+        c.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS xmatches_{operation.lower()}_event_version
+            AFTER {operation} ON xmatches
+            BEGIN
+                INSERT INTO event_xmatches_versions (event_id, version) VALUES ({row}.event_id, 1)
+                ON CONFLICT (event_id) DO UPDATE SET version = version + 1, updated_at = CURRENT_TIMESTAMP;
+            END
+        ''')
+
+    # when an event is deleted, so is its counter
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS event_xmatches_versions_event_deleted
+        AFTER DELETE ON events
+        BEGIN
+            DELETE FROM event_xmatches_versions WHERE event_id = OLD.id;
+        END
+    ''')
+
+# the eleventh migration adds the indexes used to fetch the xmatches of several events since a cursor
+# (the new ones by id, the new and updated ones by updated_at)
+def migration11(c: sqlite3.Cursor):
+    c.execute('CREATE INDEX IF NOT EXISTS xmatches_event_id_id ON xmatches (event_id, id)')
+    c.execute('CREATE INDEX IF NOT EXISTS xmatches_event_id_updated_at ON xmatches (event_id, updated_at, id)')
+
+# the twelfth migration adds a spatial index (R*Tree of the positions on the unit sphere) of the events and xmatches,
+# used by the cone searches. The rows are indexed when inserted (see db.index_positions), here we index the existing ones,
+# one chunk per transaction
+def migration12(c: sqlite3.Cursor):
+    from db import index_positions
+
+    for table in ['events', 'xmatches']:
+        try:
+            c.execute(f'CREATE VIRTUAL TABLE {table}_rtree USING rtree (id, min_x, max_x, min_y, max_y, min_z, max_z)')
+        except sqlite3.OperationalError:
+            print(f"{table}_rtree table already exists.")
+
+        c.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_rtree_deleted
+            AFTER DELETE ON {table}
+            BEGIN
+                DELETE FROM {table}_rtree WHERE id = OLD.id;
+            END
+        ''')
+
+        # index the existing rows in chunks, from the last one indexed (so that it's a no-op once done)
+        last_id = c.execute(f'SELECT COALESCE(MAX(id), 0) FROM {table}_rtree').fetchone()[0]
+        while True:
+            rows = c.execute(f'''
+                SELECT id, ra, dec FROM {table}
+                WHERE id > ? AND ra IS NOT NULL AND dec IS NOT NULL
+                ORDER BY id LIMIT 10000
+            ''', (last_id,)).fetchall()
+            if not rows:
+                break
+            index_positions(table, rows, c)
+            last_id = rows[-1][0]
+            yield
+
+# the thirteenth migration adds the reprocess_jobs table, tracking the reprocessing requests run in the background by reprocess.py
+# and the reprocess_job_id column of the events, set to the job that last reset them
+def migration13(c: sqlite3.Cursor):
+    try:
+        c.execute('''
+            CREATE TABLE reprocess_jobs (
+                id INTEGER PRIMARY KEY,
+                state TEXT DEFAULT 'pending' CHECK (state IN ('pending', 'running', 'done', 'failed', 'cancelled')),
+                obs_start_min TIMESTAMP,
+                obs_start_max TIMESTAMP,
+                event_names TEXT,
+                archival_only INTEGER DEFAULT 0,
+                events_total INTEGER DEFAULT 0,
+                events_reset INTEGER DEFAULT 0,
+                xmatches_deleted INTEGER DEFAULT 0,
+                error TEXT,
+                created_by TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                started_at TIMESTAMP,
+                finished_at TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+    except sqlite3.OperationalError:
+        print("reprocess_jobs table already exists.")
+
+    try:
+        c.execute('ALTER TABLE events ADD COLUMN reprocess_job_id INTEGER')
+    except sqlite3.OperationalError:
+        print("events table already has reprocess_job_id column.")
+
+# the fourteenth migration adds the pipeline_timings table, the ledger of when each event and xmatch first reached
+# each stage of the pipeline (see db.PIPELINE_STAGES), as unix timestamps. The event level stages have xmatch_id = 0
+def migration14(c: sqlite3.Cursor):
+    try:
+        c.execute('''
+            CREATE TABLE pipeline_timings (
+                event_id INTEGER NOT NULL,
+                xmatch_id INTEGER NOT NULL DEFAULT 0,
+                stage TEXT NOT NULL,
+                ts REAL NOT NULL,
+                PRIMARY KEY (event_id, xmatch_id, stage)
+            ) WITHOUT ROWID
+        ''')
+    except sqlite3.OperationalError:
+        print("pipeline_timings table already exists.")
+
+    # to summarize the latencies of the timings recorded in a time window
+    c.execute('CREATE INDEX IF NOT EXISTS pipeline_timings_stage_ts ON pipeline_timings (stage, ts)')
+
+    # the timings of the deleted events and xmatches are deleted with them
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS pipeline_timings_event_deleted
+        AFTER DELETE ON events
+        BEGIN
+            DELETE FROM pipeline_timings WHERE event_id = OLD.id;
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS pipeline_timings_xmatch_deleted
+        AFTER DELETE ON xmatches
+        BEGIN
+            DELETE FROM pipeline_timings WHERE event_id = OLD.event_id AND xmatch_id = OLD.id;
+        END
+    ''')
+
+# the fifteenth migration adds the tier of the events: 'cold' once their archival xmatches are moved out
+# of the database (see tiering.py), with their number in cold_archival_xmatches
+def migration15(c: sqlite3.Cursor):
+    try:
+        c.execute("ALTER TABLE events ADD COLUMN tier TEXT DEFAULT 'hot'")
+    except sqlite3.OperationalError:
+        print("events table already has tier column.")
+    try:
+        c.execute('ALTER TABLE events ADD COLUMN cold_archival_xmatches INTEGER DEFAULT 0')
+    except sqlite3.OperationalError:
+        print("events table already has cold_archival_xmatches column.")
+
+# the sixteenth migration adds the rollups of the statistics dashboard (see db.STATS_DAILY_METRICS), and fills them
+# from the existing rows: the counts of each event, a chunk of events at a time, then the daily counters (the xmatches
+# that were deleted since and the failed Fritz attempts can't be counted anymore) and the totals
+def migration16(c: sqlite3.Cursor):
+    from db import DT_XMATCH_NONADMIN, STATS_DAILY_METRICS, dict_factory, refresh_event_stats
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS stats_daily (
+            day TEXT,
+            metric TEXT,
+            value INTEGER DEFAULT 0,
+            PRIMARY KEY (day, metric)
+        ) WITHOUT ROWID
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS stats_events (
+            event_id INTEGER PRIMARY KEY,
+            num_xmatches INTEGER DEFAULT 0,
+            num_archival_xmatches INTEGER DEFAULT 0,
+            num_prompt_xmatches INTEGER DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS stats_totals (
+            metric TEXT PRIMARY KEY,
+            value INTEGER DEFAULT 0
+        ) WITHOUT ROWID
+    ''')
+
+    # the totals of the events are updated along with their counts, the events counted before an interruption are skipped.
+    # The db helpers expect dict rows, they get their own cursor (in the same transaction)
+    d = c.connection.cursor()
+    d.row_factory = dict_factory
+    last_id = 0
+    while True:
+        event_ids = [row['id'] for row in d.execute(
+            'SELECT id FROM events WHERE id > ? AND id NOT IN (SELECT event_id FROM stats_events) ORDER BY id LIMIT 1000',
+            (last_id,)
+        ).fetchall()]
+        if not event_ids:
+            break
+        refresh_event_stats(event_ids, d)
+        last_id = event_ids[-1]
+        yield
+
+    c.execute("DELETE FROM stats_daily")
+    c.execute(f"DELETE FROM stats_totals WHERE metric IN ({','.join('?'*len(STATS_DAILY_METRICS))})", STATS_DAILY_METRICS)
+    c.execute("INSERT INTO stats_daily (day, metric, value) SELECT date(created_at), 'events_inserted', COUNT(*) FROM events GROUP BY 1")
+    c.execute('''
+        INSERT INTO stats_daily (day, metric, value)
+        SELECT date(created_at), CASE WHEN archival = 1 THEN 'archival_xmatches_inserted' ELSE 'xmatches_inserted' END, COUNT(*)
+        FROM xmatches GROUP BY 1, 2
+    ''')
+    c.execute('''
+        INSERT INTO stats_daily (day, metric, value)
+        SELECT date(created_at), 'prompt_xmatches_inserted', COUNT(*)
+        FROM xmatches WHERE archival = 0 AND abs(delta_t) <= ? GROUP BY 1
+    ''', (DT_XMATCH_NONADMIN,))
+    c.execute('''
+        INSERT INTO stats_daily (day, metric, value)
+        SELECT date(updated_at), CASE state WHEN 'done' THEN 'fritz_posted' WHEN 'skipped' THEN 'fritz_skipped' ELSE 'fritz_dead' END, COUNT(*)
+        FROM fritz_outbox WHERE state IN ('done', 'skipped', 'dead') GROUP BY 1, 2
+    ''')
+    c.execute('''
+        INSERT INTO stats_daily (day, metric, value)
+        SELECT date(updated_at), 'fritz_failed', COUNT(*) FROM fritz_outbox WHERE state = 'dead' GROUP BY 1
+    ''')
+    c.execute("INSERT INTO stats_totals (metric, value) SELECT metric, SUM(value) FROM stats_daily GROUP BY metric")
+
+# the seventeenth migration adds the change sequence of the xmatches, the cursor of fetch_xmatches_since:
+# updated_at has a one second resolution and is taken when the statement runs, not when it commits, so a client could
+# read past rows that were committed later with an older updated_at. change_seq is stamped by triggers from a counter
+# instead, and since sqlite has a single writer at a time, it increases in commit order. The existing xmatches get
+# their id (the counter starts after the largest one), in chunks
+def migration17(c: sqlite3.Cursor):
+    try:
+        c.execute('ALTER TABLE xmatches ADD COLUMN change_seq INTEGER')
+    except sqlite3.OperationalError:
+        print("xmatches table already has change_seq column.")
+
+    c.execute("INSERT OR IGNORE INTO change_counters (name, version) SELECT 'xmatches_seq', COALESCE(MAX(id), 0) FROM xmatches")
+
+    # sqlite can't set a column of NEW, so the row is updated after it is written. The update trigger
+    # skips the updates that set change_seq themselves (this one, and the backfill below)
+    for operation, condition in [('INSERT', ''), ('UPDATE', 'WHEN NEW.change_seq IS OLD.change_seq')]:
+        c.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS xmatches_{operation.lower()}_change_seq
+            AFTER {operation} ON xmatches {condition}
+            BEGIN
+                UPDATE change_counters SET version = version + 1 WHERE name = 'xmatches_seq';
+                UPDATE xmatches SET change_seq = (SELECT version FROM change_counters WHERE name = 'xmatches_seq') WHERE id = NEW.id;
+            END
+        ''')
+
+    c.execute('DROP INDEX IF EXISTS xmatches_event_id_updated_at')
+    c.execute('CREATE INDEX IF NOT EXISTS xmatches_event_id_change_seq ON xmatches (event_id, change_seq)')
+
+    last_id = 0
+    while True:
+        row = c.execute('''
+            SELECT MAX(id) FROM (SELECT id FROM xmatches WHERE id > ? AND change_seq IS NULL ORDER BY id LIMIT 10000)
+        ''', (last_id,)).fetchone()
+        if row[0] is None:
+            break
+        c.execute('UPDATE xmatches SET change_seq = id WHERE id > ? AND id <= ? AND change_seq IS NULL', (last_id, row[0]))
+        last_id = row[0]
+        yield
 
 migrations = [
     migration1,
@@ -239,20 +526,67 @@ migrations = [
     migration4,
     migration5,
     migration6,
-    migration7
+    migration7,
+    migration8,
+    migration9,
+    migration10,
+    migration11,
+    migration12,
+    migration13,
+    migration14,
+    migration15,
+    migration16,
+    migration17,
 ]
 
+# the version of the schema is the number of migrations applied, recorded in the schema_version table.
+# Each migration is applied once, in a transaction that also records it, so a migration that fails leaves nothing behind.
+# A migration that backfills a large table can be a generator: it yields after each chunk, which is then committed,
+# so that the services can write in between. It must be resumable, it is run from the start again if interrupted
+SCHEMA_VERSION = len(migrations)
+
+def get_schema_version(c: sqlite3.Cursor) -> int:
+    try:
+        return c.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version').fetchone()[0]
+    except sqlite3.OperationalError:
+        return 0
+
 def run_migrations():
-    prv_migrated = False
-    for migration in migrations:
-        try:
-            migration()
-            prv_migrated = True
-        except Exception as e:
-            print(f"Migration {migration.__name__} failed: {e}")
-            if prv_migrated:
+    # the transactions are explicit (isolation_level=None), so that the DDL statements are part of them
+    conn = sqlite3.connect(DATABASE_PATH, isolation_level=None)
+    c = conn.cursor()
+    try:
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                name TEXT,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        current_version = get_schema_version(c)
+        for version, migration in enumerate(migrations, start=1):
+            if version <= current_version:
+                continue
+            print(f"Applying {migration.__name__}...")
+            try:
+                c.execute('BEGIN IMMEDIATE')
+                if inspect.isgeneratorfunction(migration):
+                    for _ in migration(c):
+                        c.execute('COMMIT')
+                        time.sleep(MIGRATION_CHUNK_PAUSE)
+                        c.execute('BEGIN IMMEDIATE')
+                else:
+                    migration(c)
+                c.execute('INSERT INTO schema_version (version, name) VALUES (?, ?)', (version, migration.__name__))
+                c.execute('COMMIT')
+            except Exception as e:
+                if conn.in_transaction:
+                    c.execute('ROLLBACK')
+                print(f"Migration {migration.__name__} failed: {e}")
                 exit(1)
-    print("All migrations completed successfully.")
+    finally:
+        conn.close()
+    print(f"All migrations completed successfully (schema version {SCHEMA_VERSION}).")
 
 if __name__ == "__main__":
     run_migrations()
\ No newline at end of file
@@ -0,0 +1,76 @@
+import os
+import select
+import socket
+
+# local wake-up notifications between the services (ep_listener -> ep_xmatch -> ep_fritz)
+# each service listening for work binds a unix datagram socket in NOTIFY_DIR, and the upstream
+# service sends it a datagram as soon as new work is committed to the database.
+# the notifications are best effort: the services keep polling the database as a fallback,
+# so a lost notification (or a service that isn't running) only delays the work until the next poll
+
+NOTIFY_DIR = os.getenv('NOTIFY_DIR', './run')
+
+EP_XMATCH_CHANNEL = 'ep-xmatch'
+EP_FRITZ_CHANNEL = 'ep-fritz'
+REPROCESS_CHANNEL = 'reprocess'
+
+# in the single process runtime (runtime.py), the services running in the same process
+# are woken up in memory, by the callbacks registered here, instead of over their socket
+_local_callbacks = {}
+
+def register_local(channel: str, callback) -> None:
+    _local_callbacks[channel] = callback
+
+def _socket_path(channel: str) -> str:
+    return os.path.join(NOTIFY_DIR, f'{channel}.sock')
+
+def notify(channel: str) -> None:
+    # wake up the service listening on that channel, if any. Never raises
+    callback = _local_callbacks.get(channel)
+    if callback is not None:
+        callback()
+        return
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as s:
+            s.setblocking(False)
+            s.sendto(b'1', _socket_path(channel))
+    except OSError:
+        # nobody is listening, or its queue is full (in which case it will wake up anyway)
+        pass
+
+class Listener():
+    def __init__(self, channel: str):
+        self.channel = channel
+        self.path = _socket_path(channel)
+        os.makedirs(NOTIFY_DIR, exist_ok=True)
+        # remove the socket left behind by a previous run
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.bind(self.path)
+        self.socket.setblocking(False)
+
+    def wait(self, timeout: float) -> bool:
+        # sleep until notified or until the timeout, returns True if we were notified
+        readable, _, _ = select.select([self.socket], [], [], timeout)
+        if not readable:
+            return False
+        self.drain()
+        return True
+
+    def drain(self) -> None:
+        # drain all the pending notifications, one wake up is enough for all of them
+        while True:
+            try:
+                self.socket.recv(16)
+            except (BlockingIOError, InterruptedError):
+                break
+
+    def close(self) -> None:
+        self.socket.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
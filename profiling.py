@@ -0,0 +1,156 @@
+import cProfile
+import io
+import os
+import pstats
+import re
+import signal
+import time
+from contextlib import contextmanager
+
+# on-demand profiling of the service loops and of the API requests, with cProfile. Nothing is profiled unless asked to:
+# - a service profiles its next PROFILE_SIGNAL_ITERATIONS loop iterations when it receives SIGUSR1
+#   (kill -USR1 <pid>), or its first PROFILE_ITERATIONS iterations if set
+# - the API profiles every request while the PROFILE_API_FLAG file exists (toggled with POST /api/profiling),
+#   for PROFILE_API_DURATION seconds at most: past that the flag is removed, in case it was left on by mistake
+# each profile is written to PROFILE_DIR as a stats file (.prof, to open with pstats or snakeviz)
+# and a summary of the top functions by cumulative time (.txt). Only the latest PROFILE_KEEP profiles are kept
+
+PROFILE_DIR = os.getenv('PROFILE_DIR', './log/profiles')
+PROFILE_ITERATIONS = int(os.getenv('PROFILE_ITERATIONS', 0))  # iterations profiled at startup
+PROFILE_SIGNAL_ITERATIONS = int(os.getenv('PROFILE_SIGNAL_ITERATIONS', 5))  # iterations profiled on SIGUSR1
+PROFILE_TOP = int(os.getenv('PROFILE_TOP', 40))  # number of functions in the summaries
+PROFILE_KEEP = int(os.getenv('PROFILE_KEEP', 200))  # number of profiles kept, the older ones are deleted
+PROFILE_API_DURATION = float(os.getenv('PROFILE_API_DURATION', 10 * 60))  # in seconds, how long the API profiling stays on
+PROFILE_API_FLAG = os.path.join(PROFILE_DIR, 'api.enabled')
+PROFILE_API_CHECK_INTERVAL = 1.0  # in seconds, how often the API checks for the flag file
+
+def write_profile(profiler: cProfile.Profile, name: str) -> str:
+    # returns the path of the stats file, the summary is written next to it
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    name = re.sub(r'[^a-zA-Z0-9_.-]+', '_', name).strip('_')
+    now = time.time()
+    path = os.path.join(PROFILE_DIR, f"{name}-{time.strftime('%Y%m%dT%H%M%S', time.gmtime(now))}.{int(now * 1000) % 1000:03d}-{os.getpid()}")
+    profiler.dump_stats(f'{path}.prof')
+    summary = io.StringIO()
+    pstats.Stats(profiler, stream=summary).strip_dirs().sort_stats('cumulative').print_stats(PROFILE_TOP)
+    with open(f'{path}.txt', 'w') as f:
+        f.write(summary.getvalue())
+    prune_profiles()
+    return f'{path}.prof'
+
+def _profile_entries() -> list:
+    # the stats files, newest first
+    try:
+        entries = [entry for entry in os.scandir(PROFILE_DIR) if entry.name.endswith('.prof')]
+    except FileNotFoundError:
+        return []
+    entries.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+    return entries
+
+def prune_profiles(keep: int = PROFILE_KEEP) -> None:
+    # deletes the profiles (stats files and summaries) past the latest keep ones
+    for entry in _profile_entries()[keep:]:
+        for path in [entry.path, f'{entry.path[:-len(".prof")]}.txt']:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                # another worker pruned it first
+                pass
+
+class LoopProfiler:
+    # profiles a number of iterations of a service loop, the stats of all of them are written together once they are done
+    def __init__(self, name: str, iterations: int = PROFILE_ITERATIONS):
+        self.name = name
+        self.remaining = iterations
+        self.profiler = None
+        signal.signal(signal.SIGUSR1, self._on_signal)
+
+    def _on_signal(self, signum, frame):
+        print(f'Profiling the next {PROFILE_SIGNAL_ITERATIONS} iterations of {self.name}.')
+        self.remaining = PROFILE_SIGNAL_ITERATIONS
+
+    @contextmanager
+    def iteration(self):
+        if self.remaining <= 0:
+            yield
+            return
+        if self.profiler is None:
+            self.profiler = cProfile.Profile()
+        self.profiler.enable()
+        try:
+            yield
+        finally:
+            self.profiler.disable()
+            self.remaining -= 1
+            if self.remaining <= 0:
+                try:
+                    print(f'Profile of {self.name} written to {write_profile(self.profiler, self.name)}')
+                except OSError as e:
+                    print(f'Failed to write profile of {self.name}: {e}')
+                self.profiler = None
+
+class RequestProfiler:
+    # profiles the API requests while the flag file exists, it is checked at most every PROFILE_API_CHECK_INTERVAL seconds.
+    # The flag expires duration seconds after it was last turned on (its mtime), the first worker to notice removes it
+    def __init__(self, flag: str = PROFILE_API_FLAG, duration: float = PROFILE_API_DURATION):
+        self.flag = flag
+        self.duration = duration
+        self._enabled = False
+        self._checked_at = 0.0
+
+    def expires_at(self) -> float:
+        # the unix time at which the profiling turns off, or None if it is off
+        try:
+            return os.path.getmtime(self.flag) + self.duration
+        except FileNotFoundError:
+            return None
+
+    def is_enabled(self) -> bool:
+        now = time.monotonic()
+        if now - self._checked_at >= PROFILE_API_CHECK_INTERVAL:
+            expires_at = self.expires_at()
+            self._enabled = expires_at is not None and time.time() < expires_at
+            if expires_at is not None and not self._enabled:
+                print(f'Profiling of the API requests expired after {self.duration:.0f}s, turning it off.')
+                self._remove_flag()
+            self._checked_at = now
+        return self._enabled
+
+    def _remove_flag(self) -> None:
+        try:
+            os.unlink(self.flag)
+        except FileNotFoundError:
+            pass
+
+    def set_enabled(self, enabled: bool) -> None:
+        # turning it on again restarts the duration
+        if enabled:
+            os.makedirs(os.path.dirname(self.flag), exist_ok=True)
+            open(self.flag, 'a').close()
+            os.utime(self.flag)
+        else:
+            self._remove_flag()
+        self._checked_at = 0.0
+
+    def start(self):
+        # returns the profiler of the request, or None if profiling is off
+        if not self.is_enabled():
+            return None
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # another request of this worker is being profiled (only one profiler can be active per thread)
+            return None
+        return profiler
+
+    def stop(self, profiler: cProfile.Profile, name: str) -> None:
+        profiler.disable()
+        try:
+            write_profile(profiler, name)
+        except OSError as e:
+            print(f'Failed to write profile of {name}: {e}')
+
+def list_profiles(limit: int = 50) -> list:
+    # the latest stats files, newest first
+    return [entry.name for entry in _profile_entries()[:limit]]
@@ -0,0 +1,159 @@
+import os
+import sqlite3
+import time
+import traceback
+
+import metrics
+from profiling import LoopProfiler
+from db import (
+    is_db_initialized, get_db_connection, REPROCESS_STATUSES,
+    fetch_next_reprocess_job, fetch_reprocess_job, update_reprocess_job, refresh_event_stats,
+)
+from notify import notify, Listener, EP_XMATCH_CHANNEL, REPROCESS_CHANNEL
+from tiering import drop_cold, delete_partitions
+
+# runs the reprocessing jobs created with POST /api/reprocess, one at a time, in the background:
+# for each chunk of events in the job's scope, we delete their xmatches in small batches (committing
+# after each one, so that we never hold the write lock for long), then set their status so that
+# ep_xmatch queries them again. Events reset by a job keep its id (events.reprocess_job_id),
+# so an interrupted job resumes where it stopped, and its progress can be tracked
+
+REPROCESS_EVENTS_CHUNK = int(os.getenv('REPROCESS_EVENTS_CHUNK', 50))  # events reset at a time
+REPROCESS_DELETE_CHUNK = int(os.getenv('REPROCESS_DELETE_CHUNK', 1000))  # xmatches deleted per transaction
+REPROCESS_PAUSE = float(os.getenv('REPROCESS_PAUSE', 0.1))  # in seconds, between transactions, to let the other services write
+
+class JobCancelled(Exception):
+    pass
+
+def scope_conditions(job: dict):
+    # the conditions on the events table matching the scope of the job
+    conditions = []
+    parameters = []
+    if job['obs_start_min'] is not None:
+        conditions.append(' obs_start >= ?')
+        parameters.append(job['obs_start_min'])
+    if job['obs_start_max'] is not None:
+        conditions.append(' obs_start <= ?')
+        parameters.append(job['obs_start_max'])
+    if job['event_names']:
+        conditions.append(' name IN ({})'.format(','.join('?'*len(job['event_names']))))
+        parameters += job['event_names']
+    return conditions, parameters
+
+def check_cancelled(job_id: int, c) -> None:
+    state = c.execute('SELECT state FROM reprocess_jobs WHERE id = ?', (job_id,)).fetchone()['state']
+    if state == 'cancelled':
+        raise JobCancelled()
+
+def run_job(job_id: int, conn) -> None:
+    c = conn.cursor()
+    job = fetch_reprocess_job(job_id, c)
+    status = REPROCESS_STATUSES[1] if job['archival_only'] else REPROCESS_STATUSES[0]
+    conditions, parameters = scope_conditions(job)
+    where = (' WHERE' + ' AND'.join(conditions)) if conditions else ''
+
+    events_total = c.execute(f'SELECT COUNT(*) AS count FROM events{where}', tuple(parameters)).fetchone()['count']
+    update_reprocess_job(job_id, c, state='running', events_total=events_total, started_at=job['started_at'] or time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime()))
+    conn.commit()
+    print(f"Running reprocess job {job_id} ({events_total} events, archival only: {bool(job['archival_only'])})")
+
+    events_reset = job['events_reset']
+    xmatches_deleted = job['xmatches_deleted']
+    while True:
+        check_cancelled(job_id, c)
+        # the next events of the scope that this job didn't reset yet
+        event_ids = [
+            row['id'] for row in c.execute(
+                f"SELECT id FROM events WHERE{' AND'.join(conditions + [' reprocess_job_id IS NOT ?'])} ORDER BY id LIMIT ?",
+                (*parameters, job_id, REPROCESS_EVENTS_CHUNK)
+            ).fetchall()
+        ]
+        if not event_ids:
+            break
+
+        # delete their xmatches, a batch at a time
+        placeholders = ','.join('?'*len(event_ids))
+        archival_condition = ' AND archival = 1' if job['archival_only'] else ''
+        while True:
+            c.execute(
+                f'DELETE FROM xmatches WHERE id IN (SELECT id FROM xmatches WHERE event_id IN ({placeholders}){archival_condition} LIMIT ?)',
+                (*event_ids, REPROCESS_DELETE_CHUNK)
+            )
+            deleted = c.rowcount
+            metrics.inc('reprocess_xmatches_deleted', deleted)
+            xmatches_deleted += deleted
+            update_reprocess_job(job_id, c, xmatches_deleted=xmatches_deleted)
+            conn.commit()
+            if deleted < REPROCESS_DELETE_CHUNK:
+                break
+            time.sleep(REPROCESS_PAUSE)
+            check_cancelled(job_id, c)
+        # including the archival ones in the cold tier, whose files are deleted once committed
+        cold_paths = drop_cold(event_ids, c)
+        refresh_event_stats(event_ids, c)
+
+        # and queue them for ep_xmatch
+        c.execute(
+            f'UPDATE events SET query_status = ?, reprocess_job_id = ?, updated_at = CURRENT_TIMESTAMP WHERE id IN ({placeholders})',
+            (status, job_id, *event_ids)
+        )
+        events_reset += len(event_ids)
+        update_reprocess_job(job_id, c, events_reset=events_reset)
+        conn.commit()
+        delete_partitions(cold_paths)
+        notify(EP_XMATCH_CHANNEL)
+        time.sleep(REPROCESS_PAUSE)
+
+    update_reprocess_job(job_id, c, state='done', finished_at=time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime()))
+    conn.commit()
+    print(f'Reprocess job {job_id} done: {events_reset} events reset, {xmatches_deleted} xmatches deleted.')
+
+def service() -> bool:
+    # runs the next job if any, returns True if there was one
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        job = fetch_next_reprocess_job(c)
+        if job is None:
+            return False
+        try:
+            with metrics.timer('reprocess_job_seconds'):
+                run_job(job['id'], conn)
+        except JobCancelled:
+            conn.rollback()
+            print(f"Reprocess job {job['id']} was cancelled.")
+        except Exception as e:
+            conn.rollback()
+            if isinstance(e, sqlite3.OperationalError) and 'locked' in str(e):
+                # the job is still running, it resumes on the next pass
+                print(f"Database locked while running reprocess job {job['id']}, will retry.")
+                return False
+            traceback.print_exc()
+            update_reprocess_job(job['id'], c, state='failed', error=str(e), finished_at=time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime()))
+            conn.commit()
+        return True
+
+if __name__ == "__main__":
+    while not is_db_initialized():
+        print('Waiting for database to be initialized...')
+        time.sleep(15)
+
+    # the API notifies us when a job is created, polling remains as a fallback
+    listener = Listener(REPROCESS_CHANNEL)
+
+    # profiles the service on SIGUSR1 (see profiling.py)
+    profiler = LoopProfiler('reprocess')
+
+    metrics.configure('reprocess')
+
+    print('Starting service...')
+    while True:
+        try:
+            with profiler.iteration():
+                job_found = service()
+            if job_found:
+                continue
+        except Exception as e:
+            traceback.print_exc()
+            print(f'Failed to run service: {e}')
+        metrics.flush()
+        listener.wait(60)
@@ -0,0 +1,134 @@
+import asyncio
+import os
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from penquins import Kowalski
+
+import metrics
+import ep_fritz
+import ep_listener
+import ep_xmatch
+from db import is_db_initialized, get_db_connection, fetch_event_keys, reuse_connections
+from notify import Listener, register_local, EP_XMATCH_CHANNEL, EP_FRITZ_CHANNEL
+
+# runs ep_listener, ep_xmatch and ep_fritz together in a single process (python runtime.py), instead of one process
+# each under supervisord: the modules and clients are loaded once, each service runs its passes in its own thread
+# (with one long-lived database connection) driven by an asyncio task, and the handoffs between them are in memory:
+# when ep_listener inserts events or ep_xmatch queues xmatches, the next service is woken up right away.
+# The database remains the source of truth, so the work is never lost if the process dies.
+# The other processes (the API, reprocess.py) still wake ep_xmatch and ep_fritz up over their notify socket
+
+# in seconds, the longest each service sleeps without being woken up, same as in their own process
+EP_XMATCH_POLL_INTERVAL = 5.0
+EP_FRITZ_POLL_INTERVAL = 60.0
+
+class Wakeup():
+    # wakes up the task of a service, from any thread or when a notification arrives on its socket
+    def __init__(self, loop: asyncio.AbstractEventLoop, channel: str = None):
+        self.loop = loop
+        self.event = asyncio.Event()
+        self.listener = None
+        if channel is not None:
+            register_local(channel, self.set)
+            self.listener = Listener(channel)
+            loop.add_reader(self.listener.socket, self._on_notification)
+
+    def set(self) -> None:
+        self.loop.call_soon_threadsafe(self.event.set)
+
+    def _on_notification(self) -> None:
+        self.listener.drain()
+        self.event.set()
+
+    async def wait(self, timeout: float) -> bool:
+        # returns True if we were woken up before the timeout
+        try:
+            await asyncio.wait_for(self.event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self.event.clear()
+
+async def run_service(name: str, service_pass, wakeup: Wakeup, timeout) -> None:
+    # runs the passes of a service in its own thread, sleeping up to timeout() seconds between them
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=name)
+
+    def _pass():
+        with metrics.timer('service_pass_seconds', task=name):
+            service_pass()
+
+    while True:
+        try:
+            await loop.run_in_executor(executor, _pass)
+        except Exception as e:
+            traceback.print_exc()
+            print(f'[{name}] Failed to run service: {e}')
+        metrics.flush()
+        await wakeup.wait(timeout())
+
+def kowalski_client() -> Kowalski:
+    # each service thread gets its own client: they query Kowalski at the same time, and the client's
+    # requests session isn't guaranteed to be thread safe
+    return Kowalski(
+        protocol='https',
+        host='kowalski.caltech.edu',
+        port=443,
+        token=os.getenv('KOWALSKI_TOKEN'),
+        timeout=10,
+    )
+
+def fritz_pass() -> None:
+    with get_db_connection() as conn:
+        processed_count = ep_fritz.service(conn)
+    print(f'[ep_fritz] Processed {processed_count} xmatches.')
+
+async def main() -> None:
+    loop = asyncio.get_running_loop()
+
+    listener_k = kowalski_client()
+    xmatch_k = kowalski_client()
+    ep = ep_listener.EPClient(email=ep_listener.EP_EMAIL, password=ep_listener.EP_PASSWORD)
+    ep_fritz.sp = ep_fritz.SkyPortal(
+        host=ep_fritz.FRITZ_HOST,
+        token=ep_fritz.FRITZ_TOKEN,
+    )
+
+    with get_db_connection() as conn:
+        known_event_keys = fetch_event_keys(conn.cursor())
+    print(f'Loaded {len(known_event_keys)} known events.')
+    poller = ep_listener.AdaptivePoller()
+
+    print('Starting services...')
+    await asyncio.gather(
+        run_service(
+            'ep_listener',
+            lambda: ep_listener.service(listener_k, ep, poller, known_event_keys),
+            Wakeup(loop),
+            lambda: max(poller.time_until_due(), 1),
+        ),
+        run_service(
+            'ep_xmatch',
+            lambda: ep_xmatch.service(xmatch_k),
+            Wakeup(loop, EP_XMATCH_CHANNEL),
+            lambda: EP_XMATCH_POLL_INTERVAL,
+        ),
+        run_service(
+            'ep_fritz',
+            fritz_pass,
+            Wakeup(loop, EP_FRITZ_CHANNEL),
+            lambda: EP_FRITZ_POLL_INTERVAL,
+        ),
+    )
+
+if __name__ == "__main__":
+    while not is_db_initialized():
+        print('Waiting for database to be initialized...')
+        time.sleep(15)
+
+    metrics.configure('runtime')
+    reuse_connections()
+    asyncio.run(main())
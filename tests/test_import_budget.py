@@ -0,0 +1,16 @@
+import pytest
+
+from bench_imports import ENTRY_POINTS, FORBIDDEN_MODULES, FORBIDDEN_MODULES_API, IMPORT_BUDGET_MS, import_times
+
+# each entry point is imported in a fresh interpreter (see bench_imports.py), the fastest of a few runs is kept
+RUNS = 3
+
+@pytest.mark.parametrize('module', ENTRY_POINTS)
+def test_import_budget(module):
+    total, direct, loaded = min([import_times(module) for _ in range(RUNS)], key=lambda run: run[0])
+    slowest = ', '.join(f'{name}: {ms:.0f}ms' for name, ms in sorted(direct, key=lambda item: item[1], reverse=True)[:5])
+    assert total <= IMPORT_BUDGET_MS, f'{module} took {total:.0f}ms to import, more than the {IMPORT_BUDGET_MS:.0f}ms budget ({slowest})'
+
+    forbidden = FORBIDDEN_MODULES_API if module == 'api' else FORBIDDEN_MODULES
+    forbidden = [name for name in forbidden if name in loaded]
+    assert not forbidden, f'{module} imports {", ".join(forbidden)} at startup, it must be imported lazily'
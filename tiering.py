@@ -0,0 +1,164 @@
+import argparse
+import os
+import time
+import traceback
+from datetime import datetime, timedelta
+
+import metrics
+from db import is_db_initialized, get_db_connection
+
+# moves the archival xmatches of old events out of the database, into compressed Parquet files (the cold tier):
+# they are rarely looked at once an event is old, but they make up most of the xmatches table, so every scan
+# and count of it gets slower as it grows. Each event has its own file, in a directory per month of its obs_start:
+#   COLD_DIR/xmatches/YYYY-MM/event_<id>.parquet
+# the events whose archival xmatches are in the cold tier have tier = 'cold', and their number in
+# events.cold_archival_xmatches. db.fetch_xmatches reads them back when asked for the xmatches of such events,
+# so the pages of the API are unchanged. The non-archival xmatches always stay in the database.
+# Reprocessing an event drops its cold xmatches (see drop_cold), the new ones are tiered again on a later pass
+
+COLD_DIR = os.getenv('COLD_DIR', './data/cold')
+TIERING_MIN_EVENT_AGE_DAYS = float(os.getenv('TIERING_MIN_EVENT_AGE_DAYS', 180))  # events older than this are tiered
+TIERING_INTERVAL = float(os.getenv('TIERING_INTERVAL', 24 * 60 * 60))  # in seconds, between passes
+TIERING_PAUSE = float(os.getenv('TIERING_PAUSE', 0.1))  # in seconds, between events, to let the other services write
+
+def partition_path(event: dict) -> str:
+    # event with an id and an obs_start
+    return os.path.join(COLD_DIR, 'xmatches', str(event['obs_start'])[:7], f"event_{event['id']}.parquet")
+
+def _xmatches_columns(c) -> list:
+    return [(row['name'], row['type']) for row in c.execute('PRAGMA table_info(xmatches)').fetchall()]
+
+def write_partition(path: str, rows: list, columns: list) -> None:
+    # written next to it first, so that a partition is never read half written
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    from export import arrow_type
+    schema = pa.schema([(name, arrow_type(pa, type)) for name, type in columns])
+    table = pa.Table.from_pylist([{name: row.get(name) for name, _ in columns} for row in rows], schema=schema)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.tmp'
+    pq.write_table(table, tmp_path, compression='zstd')
+    os.replace(tmp_path, path)
+
+def read_partition(path: str) -> list:
+    import pyarrow.parquet as pq
+    try:
+        return pq.read_table(path).to_pylist()
+    except FileNotFoundError:
+        print(f'Missing cold tier partition {path}.')
+        return []
+
+def read_cold_xmatches(events: list) -> list:
+    # the archival xmatches in the cold tier of the events (with an id and an obs_start)
+    rows = []
+    for event in events:
+        rows += read_partition(partition_path(event))
+    return rows
+
+def tier_event(event: dict, conn) -> int:
+    # moves the archival xmatches of the event to its partition, returns the number of xmatches in it.
+    # If the event already has one (it got new archival xmatches since), they are added to it. The partition is
+    # replaced before the xmatches are deleted from the database: if that fails (e.g. the database is locked),
+    # they are in both until a later pass, and db.load_cold_xmatches leaves out the copies of the partition.
+    # The xmatches are told apart by candid, not id: the ids of the deleted ones can be given to new xmatches
+    c = conn.cursor()
+    path = partition_path(event)
+    columns = _xmatches_columns(c)
+    rows = c.execute('SELECT * FROM xmatches WHERE event_id = ? AND archival = 1 ORDER BY id', (event['id'],)).fetchall()
+    if event['tier'] == 'cold':
+        hot_candids = {row['candid'] for row in rows}
+        rows = [row for row in read_partition(path) if row['candid'] not in hot_candids] + rows
+    write_partition(path, rows, columns)
+    c.execute('DELETE FROM xmatches WHERE event_id = ? AND archival = 1', (event['id'],))
+    c.execute(
+        "UPDATE events SET tier = 'cold', cold_archival_xmatches = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+        (len(rows), event['id'])
+    )
+    conn.commit()
+    return len(rows)
+
+def drop_cold(event_ids: list, c) -> list:
+    # drops the cold tier of the events, for when their xmatches are deleted (e.g. to be reprocessed): they are hot again,
+    # and we return the paths of their partitions, to delete with delete_partitions once that is committed. If it is
+    # rolled back instead, the events are still cold and their partitions must still be there. A partition left behind
+    # (e.g. if we die in between) is overwritten when its event is tiered again
+    if not event_ids:
+        return []
+    placeholders = ','.join('?'*len(event_ids))
+    events = c.execute(
+        f"SELECT id, obs_start FROM events WHERE id IN ({placeholders}) AND tier = 'cold'",
+        tuple(event_ids)
+    ).fetchall()
+    if not events:
+        return []
+    c.execute(
+        "UPDATE events SET tier = 'hot', cold_archival_xmatches = 0, updated_at = CURRENT_TIMESTAMP WHERE id IN ({})".format(','.join('?'*len(events))),
+        tuple(event['id'] for event in events)
+    )
+    return [partition_path(event) for event in events]
+
+def delete_partitions(paths: list) -> None:
+    for path in paths:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+def fetch_events_to_tier(c, min_age_days: float = TIERING_MIN_EVENT_AGE_DAYS) -> list:
+    # the events older than min_age_days with archival xmatches in the database
+    return c.execute(
+        '''
+        SELECT id, name, version, obs_start, tier FROM events
+        WHERE obs_start < ? AND EXISTS (SELECT 1 FROM xmatches WHERE event_id = events.id AND archival = 1)
+        ORDER BY obs_start
+        ''',
+        (datetime.utcnow() - timedelta(days=min_age_days),)
+    ).fetchall()
+
+def service(min_age_days: float = TIERING_MIN_EVENT_AGE_DAYS, dry_run: bool = False) -> int:
+    # returns the number of xmatches moved to the cold tier
+    with get_db_connection() as conn:
+        events = fetch_events_to_tier(conn.cursor(), min_age_days)
+        print(f'{len(events)} events to tier.')
+        if dry_run:
+            for event in events:
+                print(f"{event['name']} (version {event['version']}, {event['obs_start']}): {partition_path(event)}")
+            return 0
+        xmatches_tiered = 0
+        for event in events:
+            try:
+                with metrics.timer('tiering_event_seconds'):
+                    xmatches_tiered += tier_event(event, conn)
+            except Exception as e:
+                conn.rollback()
+                traceback.print_exc()
+                print(f"Failed to tier event {event['name']} (version {event['version']}): {e}")
+            time.sleep(TIERING_PAUSE)
+        metrics.inc('xmatches_tiered', xmatches_tiered)
+    print(f'Moved {xmatches_tiered} xmatches of {len(events)} events to the cold tier.')
+    return xmatches_tiered
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Moves the archival xmatches of old events to the cold tier')
+    parser.add_argument('--once', action='store_true', help='run a single pass and exit')
+    parser.add_argument('--dry-run', action='store_true', help='list the events that would be tiered and exit')
+    parser.add_argument('--min-age-days', type=float, default=TIERING_MIN_EVENT_AGE_DAYS, help='age of the events to tier, in days')
+    args = parser.parse_args()
+
+    while not is_db_initialized():
+        print('Waiting for database to be initialized...')
+        time.sleep(15)
+
+    metrics.configure('tiering')
+    if args.once or args.dry_run:
+        service(args.min_age_days, dry_run=args.dry_run)
+        metrics.flush()
+    else:
+        while True:
+            try:
+                service(args.min_age_days)
+            except Exception as e:
+                traceback.print_exc()
+                print(f'Failed to run service: {e}')
+            metrics.flush()
+            time.sleep(TIERING_INTERVAL)
@@ -0,0 +1,36 @@
+from datetime import datetime, timedelta, timezone
+
+# conversions between UTC timestamps and julian dates, used instead of astropy.time in the services and the API:
+# importing astropy takes a few hundred ms and tens of MB per process, and we only ever need UTC <-> JD.
+# The results match astropy's (Time(...).jd, .mjd, .isot, .to_datetime()) except during a leap second
+
+JD_UNIX_EPOCH = 2440587.5  # julian date of 1970-01-01T00:00:00 UTC
+MJD_OFFSET = 2400000.5
+SECONDS_PER_DAY = 86400.0
+
+_UNIX_EPOCH = datetime(1970, 1, 1)
+
+def datetime_to_jd(value: datetime) -> float:
+    # naive datetimes are UTC
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return JD_UNIX_EPOCH + (value - _UNIX_EPOCH) / timedelta(days=1)
+
+def iso_to_jd(value: str) -> float:
+    # ISO timestamp (like the ones sqlite stores, 'YYYY-MM-DD HH:MM:SS', or 'YYYY-MM-DDTHH:MM:SS.sss'), UTC if no timezone
+    return datetime_to_jd(datetime.fromisoformat(str(value).replace('Z', '+00:00')))
+
+def iso_to_mjd(value: str) -> float:
+    return iso_to_jd(value) - MJD_OFFSET
+
+def now_jd() -> float:
+    return datetime_to_jd(datetime.now(timezone.utc))
+
+def jd_to_datetime(jd: float) -> datetime:
+    # naive UTC datetime, rounded to the microsecond
+    return _UNIX_EPOCH + timedelta(microseconds=round((jd - JD_UNIX_EPOCH) * SECONDS_PER_DAY * 1e6))
+
+def jd_to_isot(jd: float) -> str:
+    # 'YYYY-MM-DDTHH:MM:SS.sss', rounded to the millisecond
+    value = _UNIX_EPOCH + timedelta(milliseconds=round((jd - JD_UNIX_EPOCH) * SECONDS_PER_DAY * 1e3))
+    return f"{value.strftime('%Y-%m-%dT%H:%M:%S')}.{value.microsecond // 1000:03d}"